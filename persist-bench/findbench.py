@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import gc
+import shutil
+import tempfile
+import time
+
+from provd.devices.device import DeviceCollection
+from provd.devices.device import snapshot
+from provd.persist.document import is_frozen
+from provd.persist.json_backend import new_json_collection
+from provd.persist.id import numeric_id_generator
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--devices', type=int, default=10000,
+                        help='number of devices')
+    parser.add_argument('-l', '--loop', type=int, default=10,
+                        help='number of full table find to run')
+
+    parsed_args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='findbench-')
+    try:
+        collection = DeviceCollection(new_json_collection(directory, numeric_id_generator()))
+        collection.ensure_index(u'mac')
+        collection.ensure_index(u'tenant_uuid')
+        macs = []
+        for n in xrange(parsed_args.devices):
+            mac = u':'.join(u'%02x' % ((n >> shift) & 0xff) for shift in (40, 32, 24, 16, 8, 0))
+            macs.append(mac)
+            collection.insert({
+                u'mac': mac,
+                u'ip': u'10.%s.%s.%s' % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff),
+                u'vendor': u'Vendor',
+                u'model': u'Model%s' % (n % 10),
+                u'plugin': u'vendor-plugin',
+                u'config': u'config%s' % n,
+                u'configured': True,
+                u'options': {u'switchboard': False},
+                u'tenant_uuid': u'00000000-0000-0000-0000-%012x' % (n % 10),
+            })
+
+        def full_table_find():
+            return list(_result(collection.find({})))
+
+        def request_lookup():
+            # what a TFTP/HTTP request does: retrieve the device by MAC and
+            # keep a copy to detect modifications
+            result = []
+            for mac in macs[:1000]:
+                device = _result(collection.find_one({u'mac': mac}))
+                result.append((device, snapshot(device)))
+            return result
+
+        def count_per_tenant():
+            # what GET /dev_mgr/devices?count=true does for each tenant
+            tenant_uuids = [u'00000000-0000-0000-0000-%012x' % n for n in xrange(10)]
+            return [_result(collection.count({u'tenant_uuid': {u'$in': [tenant_uuid]}}))
+                    for tenant_uuid in tenant_uuids]
+
+        def sorted_page(sort_key):
+            # what GET /dev_mgr/devices?sort=<key>&limit=50 does
+            def aux():
+                return list(_result(collection.find({}, sort=(sort_key, 1), limit=50)))
+            return aux
+
+        def sorted_pages(sort_key):
+            # page through the first 20 pages of 50 devices using after
+            def aux():
+                result = []
+                after = None
+                for _ in xrange(20):
+                    page = list(_result(collection.find({}, sort=(sort_key, 1), limit=50,
+                                                        after=after)))
+                    last = page[-1]
+                    after = (last.get(sort_key), last[u'id'])
+                    result.extend(page)
+                return result
+            return aux
+
+        _run('full table find', parsed_args.loop, full_table_find)
+        _run('1000 request lookups', parsed_args.loop, request_lookup)
+        _run('count per tenant', parsed_args.loop, count_per_tenant)
+        _run('first sorted page (index)', parsed_args.loop, sorted_page(u'mac'))
+        _run('first sorted page (no index)', parsed_args.loop, sorted_page(u'ip'))
+        _run('20 sorted pages (index)', parsed_args.loop, sorted_pages(u'mac'))
+        _run('20 sorted pages (no index)', parsed_args.loop, sorted_pages(u'ip'))
+    finally:
+        shutil.rmtree(directory)
+
+
+def _result(deferred):
+    results = []
+    deferred.addCallback(results.append)
+    return results[0]
+
+
+def _count_copied_containers(obj):
+    # Return the number of dict and list objects in obj that are not shared
+    # with the stored documents
+    if is_frozen(obj):
+        return 0
+    elif isinstance(obj, dict):
+        return 1 + sum(_count_copied_containers(v) for v in dict.itervalues(obj))
+    elif isinstance(obj, (list, tuple)):
+        return int(isinstance(obj, list)) + sum(_count_copied_containers(v) for v in obj)
+    else:
+        return 0
+
+
+def _run(name, loop, fun):
+    elapsed = 0.0
+    for _ in xrange(loop):
+        gc.collect()
+        start_time = time.time()
+        result = fun()
+        elapsed += time.time() - start_time
+    print '%s: %.2f ms per run, %s copied containers' % (
+        name, elapsed * 1000.0 / loop, _count_copied_containers(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from provd.persist.journal_backend import JournalSimpleBackend
+from provd.persist.json_backend import JsonSimpleBackend
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--devices', type=int, default=10000,
+                        help='number of devices to generate')
+    parser.add_argument('-c', '--configs', type=int, default=1000,
+                        help='number of configs to generate')
+    parser.add_argument('-t', '--type', choices=['json', 'journal'], default='json',
+                        help='database type')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='number of load workers (json database only)')
+    parser.add_argument('--directory',
+                        help='database directory (default: temporary directory)')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not remove the database directory at exit')
+    parser.add_argument('--load-only', action='store_true',
+                        help=argparse.SUPPRESS)
+
+    parsed_args = parser.parse_args()
+
+    if parsed_args.load_only:
+        load(parsed_args.directory, parsed_args.type, parsed_args.workers)
+        return
+
+    directory = parsed_args.directory or tempfile.mkdtemp(prefix='loadbench-')
+    try:
+        if not os.listdir(directory):
+            print 'Generating %s devices and %s configs in %s...' % (
+                parsed_args.devices, parsed_args.configs, directory)
+            generate(directory, parsed_args.type, parsed_args.devices, parsed_args.configs)
+        args = [sys.executable, __file__, '--load-only', '--directory', directory,
+                '--type', parsed_args.type, '--workers', str(parsed_args.workers)]
+        result = json.loads(subprocess.check_output(args))
+        print 'Loaded %(documents)s documents in %(load_time).3f seconds' % result
+        print 'Peak RSS: %.1f MiB' % (result['max_rss'] / 1024.0)
+    finally:
+        if not parsed_args.keep and not parsed_args.directory:
+            shutil.rmtree(directory)
+
+
+def _new_backend(directory, type, collection_id, workers=0):
+    if type == 'json':
+        return JsonSimpleBackend(os.path.join(directory, collection_id), workers)
+    else:
+        return JournalSimpleBackend(os.path.join(directory, collection_id + '.journal'))
+
+
+def generate(directory, type, nb_devices, nb_configs):
+    configs = _new_backend(directory, type, 'configs')
+    for n in xrange(nb_configs):
+        id = u'%032x' % n
+        configs[id] = {
+            u'id': id,
+            u'parent_ids': [u'base'],
+            u'raw_config': {
+                u'sip_lines': {
+                    u'1': {
+                        u'username': u'user%s' % n,
+                        u'password': u'secret%s' % n,
+                        u'display_name': u'User %s' % n,
+                        u'number': unicode(1000 + n),
+                    },
+                },
+            },
+        }
+    configs.close()
+
+    devices = _new_backend(directory, type, 'devices')
+    for n in xrange(nb_devices):
+        id = u'%032x' % n
+        mac = u':'.join(u'%02x' % ((n >> shift) & 0xff) for shift in (40, 32, 24, 16, 8, 0))
+        devices[id] = {
+            u'id': id,
+            u'mac': mac,
+            u'ip': u'10.%s.%s.%s' % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff),
+            u'vendor': u'Vendor',
+            u'model': u'Model%s' % (n % 10),
+            u'version': u'1.0.%s' % (n % 3),
+            u'plugin': u'vendor-plugin',
+            u'config': u'%032x' % (n % max(nb_configs, 1)),
+            u'configured': True,
+            u'tenant_uuid': u'00000000-0000-0000-0000-%012x' % (n % 10),
+        }
+    devices.close()
+
+
+def load(directory, type, workers):
+    start_time = time.time()
+    backends = [_new_backend(directory, type, collection_id, workers)
+                for collection_id in ['configs', 'devices']]
+    load_time = time.time() - start_time
+    documents = sum(len(list(backend.itervalues())) for backend in backends)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    json.dump({'documents': documents, 'load_time': load_time, 'max_rss': max_rss},
+              sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import time
+
+from provd.persist.document import freeze
+from provd.persist.selector import compile_selector
+from provd.persist.util import _create_pred_from_selector
+
+TENANT_UUIDS = [u'00000000-0000-0000-0000-%012x' % n for n in xrange(10)]
+
+SELECTORS = [
+    {u'mac': u'00:00:00:00:01:00'},
+    {u'tenant_uuid': {u'$in': TENANT_UUIDS[:3]}},
+    {u'mac': u'00:00:00:00:01:00', u'tenant_uuid': {u'$in': TENANT_UUIDS[:3]}},
+    {u'config': {u'$in': [u'config%s' % n for n in xrange(50)]}},
+    {u'sn': {u'$exists': True}},
+    {u'options.switchboard': True},
+    {u'version': {u'$gt': u'1.0.1'}, u'vendor': u'Vendor'},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--documents', type=int, default=100000,
+                        help='number of documents')
+
+    parsed_args = parser.parse_args()
+
+    documents = [_new_document(n) for n in xrange(parsed_args.documents)]
+
+    for selector in SELECTORS:
+        reference_time = _run(_create_pred_from_selector, selector, documents)
+        compiled_time = _run(compile_selector, selector, documents)
+        print '%s\n    reference: %8.0f docs/s    compiled: %8.0f docs/s    (x%.1f)' % (
+            selector, len(documents) / reference_time, len(documents) / compiled_time,
+            reference_time / compiled_time)
+
+
+def _new_document(n):
+    return freeze({
+        u'id': u'%032x' % n,
+        u'mac': u':'.join(u'%02x' % ((n >> shift) & 0xff) for shift in (40, 32, 24, 16, 8, 0)),
+        u'ip': u'10.%s.%s.%s' % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff),
+        u'vendor': u'Vendor',
+        u'model': u'Model%s' % (n % 10),
+        u'version': u'1.0.%s' % (n % 3),
+        u'config': u'config%s' % n,
+        u'configured': True,
+        u'options': {u'switchboard': n % 100 == 0},
+        u'tenant_uuid': TENANT_UUIDS[n % 10],
+    })
+
+
+def _run(compile_fun, selector, documents):
+    start_time = time.time()
+    pred = compile_fun(selector)
+    for document in documents:
+        pred(document)
+    return time.time() - start_time
+
+
+if __name__ == '__main__':
+    main()
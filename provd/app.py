@@ -6,11 +6,15 @@ import copy
 import logging
 import functools
 import os.path
+import threading
+import time
 import urlparse
 from provd.devices.config import RawConfigError, DefaultConfigFactory
 from provd.devices.device import needs_reconfiguration
+from provd.devices.pgasso import get_association_score_cache
 from provd.localization import get_localization_service
-from provd.operation import OIP_PROGRESS, OIP_FAIL, OIP_SUCCESS
+from provd.metrics import Histogram
+from provd.operation import OIP_PROGRESS, OIP_FAIL, OIP_SUCCESS, OperationInProgress
 from provd.persist.common import (
     ID_KEY,
     InvalidIdError as PersistInvalidIdError,
@@ -19,8 +23,8 @@ from provd.persist.common import (
 from provd.plugins import PluginManager, PluginNotLoadedError
 from provd.services import InvalidParameterError, JsonConfigPersister, \
     PersistentConfigureServiceDecorator
-from provd.synchro import DeferredRWLock
-from twisted.internet import defer
+from provd.synchro import DeferredKeyedLock, LockManager
+from twisted.internet import defer, threads
 from provd.rest.server import auth
 from provd.rest.server.helpers.tenants import Tenant, Tokens
 
@@ -74,24 +78,49 @@ def _wlock_arg(rw_lock):
     return decorator
 
 
-def _rlock(fun):
-    # Decorator for instance method of ProvisioningApplication that need to
-    # acquire the read lock
-    @functools.wraps(fun)
-    def aux(self, *args, **kwargs):
-        d = self._rw_lock.read_lock.run(fun, self, *args, **kwargs)
-        return d
-    return aux
+_DEVICE = u'device'
+_CONFIG = u'config'
 
 
-def _wlock(fun):
+def _locked(mode, get_entities=None):
     # Decorator for instance method of ProvisioningApplication that need to
-    # acquire the write lock
-    @functools.wraps(fun)
-    def aux(self, *args, **kwargs):
-        d = self._rw_lock.write_lock.run(fun, self, *args, **kwargs)
-        return d
-    return aux
+    # acquire the global lock in the given mode and then the locks of the
+    # entities returned by get_entities, a function returning a list of
+    # (kind, key) tuples from the method arguments
+    def decorator(fun):
+        operation = fun.__name__
+
+        @functools.wraps(fun)
+        def aux(self, *args, **kwargs):
+            entities = []
+            if get_entities is not None:
+                try:
+                    entities = get_entities(*args, **kwargs)
+                except Exception:
+                    # let the method report the error
+                    pass
+            return self._locks.run(operation, mode, entities, fun, self, *args, **kwargs)
+        return aux
+    return decorator
+
+
+# Decorators for instance method of ProvisioningApplication that need to
+# acquire the read or write lock
+_rlock = _locked(LockManager.READ)
+_wlock = _locked(LockManager.WRITE)
+
+
+def _dev_lock(get_id):
+    # Decorator for instance method of ProvisioningApplication operating on
+    # a single device that need to acquire the read lock and the lock of the
+    # device, where get_id is a function returning the ID of the device from
+    # the method arguments
+    return _locked(LockManager.READ, lambda *args, **kwargs: [(_DEVICE, get_id(*args, **kwargs))])
+
+
+def _cfg_lock(get_id):
+    # Same as _dev_lock, but for a method operating on a single config
+    return _locked(LockManager.READ, lambda *args, **kwargs: [(_CONFIG, get_id(*args, **kwargs))])
 
 
 def _check_common_raw_config_validity(raw_config):
@@ -199,6 +228,8 @@ class ProvisioningApplication(object):
                                     config['general']['check_compat_max'])
         if 'plugin_server' in config['general']:
             self.pg_mgr.server = config['general']['plugin_server']
+        # shared by the plugin associators of the device updaters
+        self.pg_association_cache = get_association_score_cache(self.pg_mgr)
 
         # Do not move this line up unless you know what you are doing...
         cfg_service = ApplicationConfigureService(self.pg_mgr, self.proxies, self)
@@ -209,7 +240,15 @@ class ProvisioningApplication(object):
         self._base_raw_config = config['general']['base_raw_config']
         logger.info('Using base raw config %s', self._base_raw_config)
         _check_common_raw_config_validity(self._base_raw_config)
-        self._rw_lock = DeferredRWLock()
+        # device locks are acquired before config locks
+        self._locks = LockManager([_DEVICE, _CONFIG])
+        self._reconfigure_workers = config['general']['reconfigure_workers']
+        self._pg_call_locks = DeferredKeyedLock()
+        self.dev_reconfigure_oips = []
+        # map plugin ID to the histogram of the duration of its configure
+        # method, which might be called from the reconfigure workers
+        self._pg_configure_durations = {}
+        self._pg_configure_durations_lock = threading.Lock()
         self._cfg_factory = DefaultConfigFactory()
         self._pg_load_all(True)
 
@@ -232,6 +271,39 @@ class ProvisioningApplication(object):
     def tenant_uuid(self):
         return self._tenant_uuid
 
+    def lock_stats(self):
+        """Return a dictionary mapping operation names to statistics about
+        the time they spent waiting for and holding their locks.
+
+        """
+        return dict((operation, stats.as_dict()) for operation, stats in
+                    self._locks.stats.iteritems())
+
+    def collection_stats(self):
+        """Return a dictionary mapping collection names to statistics about
+        their number of documents and the size of their indexes.
+
+        """
+        return {
+            u'devices': self._dev_collection.stats(),
+            u'configs': self._cfg_collection.stats(),
+        }
+
+    def pg_configure_durations(self):
+        """Return a dictionary mapping plugin IDs to the histogram of the
+        duration of the configuration of devices by the plugin.
+
+        """
+        with self._pg_configure_durations_lock:
+            return dict(self._pg_configure_durations)
+
+    def _observe_pg_configure_duration(self, plugin_id, duration):
+        with self._pg_configure_durations_lock:
+            histogram = self._pg_configure_durations.get(plugin_id)
+            if histogram is None:
+                histogram = self._pg_configure_durations[plugin_id] = Histogram()
+            histogram.observe(duration)
+
     # device methods
 
     def _dev_get_plugin(self, device):
@@ -272,6 +344,7 @@ class ProvisioningApplication(object):
                          exc_info=True)
         else:
             _set_defaults_raw_config(raw_config)
+            start_time = time.time()
             try:
                 plugin.configure(device, raw_config)
             except Exception:
@@ -279,6 +352,8 @@ class ProvisioningApplication(object):
                              exc_info=True)
             else:
                 return True
+            finally:
+                self._observe_pg_configure_duration(plugin.id, time.time() - start_time)
         return False
 
     @defer.inlineCallbacks
@@ -341,8 +416,6 @@ class ProvisioningApplication(object):
         else:
             defer.returnValue(device)
 
-    @_wlock
-    @defer.inlineCallbacks
     def dev_insert(self, device):
         """Insert a new device into the provisioning application.
 
@@ -355,8 +428,8 @@ class ProvisioningApplication(object):
         The deferred will fire it's errback with an Exception if an 'id'
         key is specified but there's already one device with the same ID.
 
-        If device has no 'id' key, one will be added after the device is
-        successfully inserted.
+        If device has no 'id' key, one is generated and added to device
+        before it is inserted.
 
         Device will be automatically configured if there's enough information
         to do so.
@@ -368,6 +441,14 @@ class ProvisioningApplication(object):
           as the one which has been inserted.
 
         """
+        if ID_KEY not in device:
+            # the ID of the device is needed to acquire its lock
+            device[ID_KEY] = self._dev_collection.new_id()
+        return self._dev_insert(device)
+
+    @_dev_lock(lambda device: device[ID_KEY])
+    @defer.inlineCallbacks
+    def _dev_insert(self, device):
         logger.info('Inserting new device')
         try:
             # new device are never configured
@@ -392,7 +473,7 @@ class ProvisioningApplication(object):
             logger.error('Error while inserting device', exc_info=True)
             raise
 
-    @_wlock
+    @_dev_lock(lambda device, *args, **kwargs: device[ID_KEY])
     @defer.inlineCallbacks
     def dev_update(self, device, pre_update_hook=None):
         """Update the device.
@@ -441,19 +522,14 @@ class ProvisioningApplication(object):
                     # check if old device was using a transient config that is
                     # no more in use
                     if u'config' in old_device and old_device[u'config'] != device.get(u'config'):
-                        old_device_cfg_id = old_device[u'config']
-                        old_device_cfg = yield self._cfg_collection.retrieve(old_device_cfg_id)
-                        if old_device_cfg and old_device_cfg.get(u'transient'):
-                            # if no devices are using this transient config, delete it
-                            if not (yield self._dev_collection.find_one({u'config': old_device_cfg_id})):
-                                self._cfg_collection.delete(old_device_cfg_id)
+                        yield self._cfg_delete_if_unused_transient(old_device[u'config'])
                 else:
                     logger.info('Not updating device %s: not changed', id)
         except Exception:
             logger.error('Error while updating device', exc_info=True)
             raise
 
-    @_wlock
+    @_dev_lock(lambda id: id)
     @defer.inlineCallbacks
     def dev_delete(self, id):
         """Delete the device with the given ID.
@@ -472,16 +548,11 @@ class ProvisioningApplication(object):
             device = yield self._dev_get_or_raise(id)
             # Next line should never raise an exception since we successfully
             # retrieve the device with the same id just before and we are
-            # using the write lock
+            # holding the device lock
             yield self._dev_collection.delete(id)
             # check if device was using a transient config that is no more in use
             if u'config' in device:
-                device_cfg_id = device[u'config']
-                device_cfg = yield self._cfg_collection.retrieve(device_cfg_id)
-                if device_cfg and device_cfg.get(u'transient'):
-                    # if no devices are using this transient config, delete it
-                    if not (yield self._dev_collection.find_one({u'config': device_cfg_id})):
-                        self._cfg_collection.delete(device_cfg_id)
+                yield self._cfg_delete_if_unused_transient(device[u'config'])
             if device[u'configured']:
                 self._dev_deconfigure_if_possible(device)
         except Exception:
@@ -501,7 +572,27 @@ class ProvisioningApplication(object):
     def dev_find_one(self, selector, *args, **kwargs):
         return self._dev_collection.find_one(selector, *args, **kwargs)
 
-    @_wlock
+    def dev_count(self, selector):
+        return self._dev_collection.count(selector)
+
+    def dev_lookup(self, key, value):
+        """Return a deferred that fire with the list of devices whose key,
+        one of mac, ip, sn or uuid, is equal to value.
+
+        This is faster than dev_find, since the devices are looked up in
+        an in-memory index.
+
+        """
+        return self._dev_collection.lookup(key, value)
+
+    def dev_lookup_stats(self):
+        return {
+            u'hits': self._dev_collection.lookup_hits,
+            u'misses': self._dev_collection.lookup_misses,
+            u'hit_ratio': self._dev_collection.lookup_hit_ratio(),
+        }
+
+    @_dev_lock(lambda id: id)
     @defer.inlineCallbacks
     def dev_reconfigure(self, id):
         """Force the reconfiguration of the device. This is usually not
@@ -529,7 +620,7 @@ class ProvisioningApplication(object):
             logger.error('Error while reconfiguring device', exc_info=True)
             raise
 
-    @_rlock
+    @_dev_lock(lambda id: id)
     @defer.inlineCallbacks
     def dev_synchronize(self, id):
         """Synchronize the physical device with its config.
@@ -557,6 +648,124 @@ class ProvisioningApplication(object):
             logger.error('Error while synchronizing device', exc_info=True)
             raise
 
+    def _dev_reconfigure_device(self, device, plugin, raw_config):
+        # Deconfigure the device if it was configured, then configure it if
+        # raw_config is not None. Return true if the device is configured.
+        # This method might be called from a worker thread.
+        if device[u'configured']:
+            self._dev_deconfigure(device, plugin)
+        if raw_config is None:
+            return False
+        return self._dev_configure(device, plugin, raw_config)
+
+    def _dev_call_in_worker(self, plugin_id, fun, *args):
+        # Plugins are not thread-safe, so the calls made in worker threads
+        # are serialized per plugin, i.e. only the devices of different
+        # plugins are reconfigured in parallel.
+        if self._reconfigure_workers:
+            return self._pg_call_locks.run(plugin_id, threads.deferToThread, fun, *args)
+        else:
+            return defer.maybeDeferred(fun, *args)
+
+    @defer.inlineCallbacks
+    def _dev_reconfigure_devices(self, device_ids, cfg_ids=None):
+        # Reconfigure the devices with the given IDs, using a pool of
+        # workers, and return a deferred that will fire with None once
+        # every device has been reconfigured.
+        #
+        # Each device is retrieved, reconfigured with its current raw config
+        # and updated if its configured state changed while holding its
+        # device lock, and is skipped if it has been deleted or, when
+        # cfg_ids is not None, if it doesn't use one of these configs
+        # anymore.
+        device_ids = list(device_ids)
+        logger.info('Reconfiguring %s devices', len(device_ids))
+        oip = OperationInProgress(u'reconfigure', OIP_PROGRESS, 0, len(device_ids))
+        self.dev_reconfigure_oips.append(oip)
+        remaining_ids = iter(device_ids)
+
+        @defer.inlineCallbacks
+        def do_reconfigure_device(id):
+            device = yield self._dev_collection.retrieve(id)
+            if device is None:
+                return
+            if cfg_ids is not None and device.get(u'config') not in cfg_ids:
+                return
+            plugin = self._dev_get_plugin(device)
+            if plugin is None:
+                return
+            raw_config = None
+            if u'config' in device:
+                raw_config = yield self._cfg_collection.get_raw_config(device[u'config'],
+                                                                       self._base_raw_config)
+            configured = yield self._dev_call_in_worker(device[u'plugin'],
+                                                        self._dev_reconfigure_device,
+                                                        device, plugin, raw_config)
+            if device[u'configured'] != configured:
+                device[u'configured'] = configured
+                yield self._dev_collection.update(device)
+
+        def reconfigure_device(id):
+            return self._locks.run('_dev_reconfigure_devices', None, [(_DEVICE, id)],
+                                   do_reconfigure_device, id)
+
+        @defer.inlineCallbacks
+        def worker():
+            for id in remaining_ids:
+                try:
+                    yield reconfigure_device(id)
+                except Exception:
+                    logger.error('Error while reconfiguring device %s', id, exc_info=True)
+                oip.current += 1
+
+        try:
+            nb_workers = max(1, self._reconfigure_workers)
+            results = yield defer.DeferredList([worker() for _ in xrange(nb_workers)],
+                                               consumeErrors=True)
+            for success, result in results:
+                if not success:
+                    result.raiseException()
+        except Exception:
+            oip.state = OIP_FAIL
+            raise
+        else:
+            oip.state = OIP_SUCCESS
+            logger.info('Reconfigured %s devices', len(device_ids))
+        finally:
+            self.dev_reconfigure_oips.remove(oip)
+
+    @_rlock
+    @defer.inlineCallbacks
+    def _cfg_reconfigure_devices(self, cfg_ids):
+        # Reconfigure every device having a direct dependency on one of the
+        # given configs.
+        cfg_ids = set(cfg_ids)
+        devices = yield self._dev_collection.find({u'config': {u'$in': list(cfg_ids)}},
+                                                  fields=[ID_KEY])
+        device_ids = [device[ID_KEY] for device in devices]
+        yield self._dev_reconfigure_devices(device_ids, cfg_ids)
+
+    def _cfg_delete_if_unused_transient(self, id):
+        # Delete the config with the given ID if it's a transient config
+        # that is not used by any device. The caller might hold device locks,
+        # which are always acquired before config locks.
+        @defer.inlineCallbacks
+        def aux():
+            config = yield self._cfg_collection.retrieve(id)
+            if config and config.get(u'transient'):
+                # if no devices are using this transient config, delete it
+                if not (yield self._dev_collection.find_one({u'config': id})):
+                    yield self._cfg_collection.delete(id)
+        return self._locks.run('_cfg_delete_if_unused_transient', None, [(_CONFIG, id)], aux)
+
+    @defer.inlineCallbacks
+    def _cfg_get_affected_cfg_ids(self, id):
+        # Return a deferred that will fire with the set of IDs of the configs
+        # whose raw config depends on the config with the given ID
+        affected_cfg_ids = yield self._cfg_collection.get_descendants(id)
+        affected_cfg_ids.add(id)
+        defer.returnValue(affected_cfg_ids)
+
     # config methods
 
     @defer.inlineCallbacks
@@ -567,7 +776,6 @@ class ProvisioningApplication(object):
         else:
             defer.returnValue(config)
 
-    @_wlock
     @defer.inlineCallbacks
     def cfg_insert(self, config):
         """Insert a new config into the provisioning application.
@@ -585,6 +793,13 @@ class ProvisioningApplication(object):
         successfully inserted.
 
         """
+        id, affected_cfg_ids = yield self._cfg_insert(config)
+        yield self._cfg_reconfigure_devices(affected_cfg_ids)
+        defer.returnValue(id)
+
+    @_cfg_lock(lambda config: config[ID_KEY])
+    @defer.inlineCallbacks
+    def _cfg_insert(self, config):
         logger.info('Inserting config %s', config.get(ID_KEY))
         try:
             try:
@@ -592,38 +807,14 @@ class ProvisioningApplication(object):
             except PersistInvalidIdError, e:
                 raise InvalidIdError(e)
             else:
-                # configure each device that depend on the newly inserted config
-                # 1. get the set of affected configs
-                affected_cfg_ids = yield self._cfg_collection.get_descendants(id)
-                affected_cfg_ids.add(id)
-                # 2. get the raw_config of every affected config
-                raw_configs = {}
-                for affected_cfg_id in affected_cfg_ids:
-                    raw_configs[affected_cfg_id] = yield self._cfg_collection.get_raw_config(
-                                                             affected_cfg_id, self._base_raw_config)
-                # 3. reconfigure/deconfigure each affected devices
-                affected_devices = yield self._dev_collection.find({u'config': {u'$in': list(affected_cfg_ids)}})
-                for device in affected_devices:
-                    plugin = self._dev_get_plugin(device)
-                    if plugin is not None:
-                        raw_config = raw_configs[device[u'config']]
-                        assert raw_config is not None
-                        # deconfigure
-                        if device[u'configured']:
-                            self._dev_deconfigure(device, plugin)
-                        # configure
-                        configured = self._dev_configure(device, plugin, raw_config)
-                        # update device if it has changed
-                        if device[u'configured'] != configured:
-                            device[u'configured'] = configured
-                            yield self._dev_collection.update(device)
-                # 4. return the device id
-                defer.returnValue(id)
+                # the devices that depend on the newly inserted config are
+                # configured once the config lock is released
+                affected_cfg_ids = yield self._cfg_get_affected_cfg_ids(id)
+                defer.returnValue((id, affected_cfg_ids))
         except Exception:
             logger.error('Error while inserting config', exc_info=True)
             raise
 
-    @_wlock
     @defer.inlineCallbacks
     def cfg_update(self, config):
         """Update the config.
@@ -639,6 +830,13 @@ class ProvisioningApplication(object):
         Note that device might be reconfigured.
 
         """
+        affected_cfg_ids = yield self._cfg_update(config)
+        if affected_cfg_ids:
+            yield self._cfg_reconfigure_devices(affected_cfg_ids)
+
+    @_cfg_lock(lambda config: config[ID_KEY])
+    @defer.inlineCallbacks
+    def _cfg_update(self, config):
         try:
             try:
                 id = config[ID_KEY]
@@ -649,37 +847,15 @@ class ProvisioningApplication(object):
                 old_config = yield self._cfg_get_or_raise(id)
                 if old_config == config:
                     logger.info('config has not changed, ignoring update')
+                    defer.returnValue(None)
                 else:
                     yield self._cfg_collection.update(config)
-                    affected_cfg_ids = yield self._cfg_collection.get_descendants(id)
-                    affected_cfg_ids.add(id)
-                    # 2. get the raw_config of every affected config
-                    raw_configs = {}
-                    for affected_cfg_id in affected_cfg_ids:
-                        raw_configs[affected_cfg_id] = yield self._cfg_collection.get_raw_config(
-                                                                 affected_cfg_id, self._base_raw_config)
-                    # 3. reconfigure each device having a direct dependency on
-                    #    one of the affected cfg id
-                    affected_devices = yield self._dev_collection.find({u'config': {u'$in': list(affected_cfg_ids)}})
-                    for device in affected_devices:
-                        plugin = self._dev_get_plugin(device)
-                        if plugin is not None:
-                            raw_config = raw_configs[device[u'config']]
-                            assert raw_config is not None
-                            # deconfigure
-                            if device[u'configured']:
-                                self._dev_deconfigure(device, plugin)
-                            # configure
-                            configured = self._dev_configure(device, plugin, raw_config)
-                            # update device if it has changed
-                            if device[u'configured'] != configured:
-                                device[u'configured'] = configured
-                                yield self._dev_collection.update(device)
+                    affected_cfg_ids = yield self._cfg_get_affected_cfg_ids(id)
+                    defer.returnValue(affected_cfg_ids)
         except Exception:
             logger.error('Error while updating config', exc_info=True)
             raise
 
-    @_wlock
     @defer.inlineCallbacks
     def cfg_delete(self, id):
         """Delete the config with the given ID. Does not delete any reference
@@ -695,6 +871,12 @@ class ProvisioningApplication(object):
         automatically reconfigured if needed.
 
         """
+        affected_cfg_ids = yield self._cfg_delete(id)
+        yield self._cfg_reconfigure_devices(affected_cfg_ids)
+
+    @_cfg_lock(lambda id: id)
+    @defer.inlineCallbacks
+    def _cfg_delete(self, id):
         logger.info('Deleting config %s', id)
         try:
             try:
@@ -704,36 +886,10 @@ class ProvisioningApplication(object):
             except PersistNonDeletableError, e:
                 raise NonDeletableError(e)
             else:
-                # 1. get the set of affected configs
-                affected_cfg_ids = yield self._cfg_collection.get_descendants(id)
-                affected_cfg_ids.add(id)
-                # 2. get the raw_config of every affected config
-                raw_configs = {}
-                for affected_cfg_id in affected_cfg_ids:
-                    raw_configs[affected_cfg_id] = yield self._cfg_collection.get_raw_config(
-                                                             affected_cfg_id, self._base_raw_config)
-                # 3. reconfigure/deconfigure each affected devices
-                affected_devices = yield self._dev_collection.find({u'config': {u'$in': list(affected_cfg_ids)}})
-                for device in affected_devices:
-                    plugin = self._dev_get_plugin(device)
-                    if plugin is not None:
-                        raw_config = raw_configs[device[u'config']]
-                        # deconfigure
-                        if device[u'configured']:
-                            self._dev_deconfigure(device, plugin)
-                        # configure if device config is not the deleted config
-                        if device[u'config'] == id:
-                            assert raw_config is None
-                            # update device if it has changed
-                            if device[u'configured']:
-                                device[u'configured'] = False
-                                yield self._dev_collection.update(device)
-                        else:
-                            assert raw_config is not None
-                            configured = yield self._dev_configure(device, plugin, raw_config)
-                            # update device if it has changed
-                            if device[u'configured'] != configured:
-                                yield self._dev_collection.update(device)
+                # devices using the deleted config are deconfigured, since
+                # they have no raw config anymore
+                affected_cfg_ids = yield self._cfg_get_affected_cfg_ids(id)
+                defer.returnValue(affected_cfg_ids)
         except Exception:
             logger.error('Error while deleting config', exc_info=True)
             raise
@@ -754,7 +910,10 @@ class ProvisioningApplication(object):
     def cfg_find_one(self, selector, *args, **kwargs):
         return self._cfg_collection.find_one(selector, *args, **kwargs)
 
-    @_wlock
+    def cfg_count(self, selector):
+        return self._cfg_collection.count(selector)
+
+    @_rlock
     @defer.inlineCallbacks
     def cfg_create_new(self):
         """Create a new config from the config with the autocreate role.
@@ -837,16 +996,8 @@ class ProvisioningApplication(object):
     @defer.inlineCallbacks
     def _pg_configure_all_devices(self, plugin_id):
         logger.info('Reconfiguring all devices using plugin %s', plugin_id)
-        devices = yield self._dev_collection.find({u'plugin': plugin_id})
-        for device in devices:
-            # deconfigure
-            if device[u'configured']:
-                self._dev_deconfigure_if_possible(device)
-            # configure
-            configured = yield self._dev_configure_if_possible(device)
-            if device[u'configured'] != configured:
-                device[u'configured'] = configured
-                yield self._dev_collection.update(device)
+        devices = yield self._dev_collection.find({u'plugin': plugin_id}, fields=[ID_KEY])
+        yield self._dev_reconfigure_devices([device[ID_KEY] for device in devices])
 
     def pg_install(self, id):
         """Install the plugin with the given id.
@@ -873,7 +1024,7 @@ class ProvisioningApplication(object):
         def callback1(_):
             # reset the state to in progress
             oip.state = OIP_PROGRESS
-        @_wlock_arg(self._rw_lock)
+        @_wlock_arg(self._locks.rw_lock)
         def callback2(_):
             # The lock apply only to the deferred return by this function
             # and not on the function itself
@@ -908,7 +1059,7 @@ class ProvisioningApplication(object):
         def callback1(_):
             # reset the state to in progress
             oip.state = OIP_PROGRESS
-        @_wlock_arg(self._rw_lock)
+        @_wlock_arg(self._locks.rw_lock)
         def callback2(_):
             # The lock apply only to the deferred return by this function
             # and not on the function itself
@@ -30,6 +30,33 @@ The following parameters are defined:
         verbose
         sync_service_type
         asterisk_ami_servers
+        reconfigure_workers
+            The number of worker threads used to reconfigure the devices
+            affected by a config or plugin change, or 0 to reconfigure them
+            in the main thread. Using threads is opt-in: the calls to a
+            same plugin are serialized, since the plugins are not expected
+            to be thread-safe, so the devices are only reconfigured in
+            parallel when they use different plugins.
+        device_update_window
+            The number of seconds during which the updates of a device done
+            while processing its requests are merged into a single update,
+            or 0 to only merge the updates done while another update of the
+            device is in progress. If not 0, the requests don't wait for the
+            update to be persisted, and its errors are only logged.
+        device_update_volatile_keys
+            The list of device keys whose modification alone is not
+            persisted when processing requests. The keys used to look up
+            the devices (id, mac, ip, sn and uuid) can't be volatile.
+        tftp_engine
+            The TFTP transfer engine, either 'default' to listen on a new
+            UDP port for every transfer, or 'multiplexed' to run every
+            transfer over a pool of tftp_engine_ports UDP ports.
+        tftp_engine_ports
+            The number of UDP ports of the 'multiplexed' TFTP engine.
+        tftp_block_cache_size
+            The maximum size, in bytes, of the DATA datagrams of the files
+            served by TFTP kept in memory. 0 disables the cache. The
+            datagrams of a file are cached once a transfer has read it.
     rest_api:
         ip
         port
@@ -47,6 +74,11 @@ The following parameters are defined:
         generator
         ensure_common_indexes
         json_db_dir
+        json_load_workers
+            The number of worker processes used to decode the documents of
+            a json database at startup, or 0 to decode them sequentially.
+        journal_db_dir
+        journal_fsync
     plugin_config:
         *
             *
@@ -96,6 +128,12 @@ _DEFAULT_CONFIG = {
         'tftp_port': 69,
         'verbose': False,
         'sync_service_type': 'none',
+        'reconfigure_workers': 0,
+        'device_update_window': 0.0,
+        'device_update_volatile_keys': [],
+        'tftp_engine': 'default',
+        'tftp_engine_ports': 4,
+        'tftp_block_cache_size': 64 * 1024 * 1024,
     },
     'rest_api': {
         'ip': '127.0.0.1',
@@ -116,6 +154,9 @@ _DEFAULT_CONFIG = {
         'generator': 'default',
         'ensure_common_indexes': True,
         'json_db_dir': 'jsondb',
+        'json_load_workers': 0,
+        'journal_db_dir': 'journaldb',
+        'journal_fsync': False,
     },
     'amid': {
         'host': 'localhost',
@@ -230,10 +271,11 @@ def _update_general_base_raw_config(app_raw_config):
 def _post_update_raw_config(raw_config):
     # Update raw config after transformation/check
     _update_general_base_raw_config(raw_config)
-    # update json_db_dir to absolute dir
-    if 'json_db_dir' in raw_config['database']:
-        raw_config['database']['json_db_dir'] = os.path.join(raw_config['general']['base_storage_dir'],
-                                                             raw_config['database']['json_db_dir'])
+    # update json_db_dir and journal_db_dir to absolute dir
+    for key in ['json_db_dir', 'journal_db_dir']:
+        if key in raw_config['database']:
+            raw_config['database'][key] = os.path.join(raw_config['general']['base_storage_dir'],
+                                                       raw_config['database'][key])
 
 
 def _load_key_file(config):
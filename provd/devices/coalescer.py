@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Coalescing of the device updates done while processing requests.
+
+When a device boots, it usually does a lot of requests in a short period of
+time, and each of these requests might update the device with the same, or
+nearly the same, information. Updates of the same device done within a
+short window, or while a previous update of the device is in progress, are
+merged into a single update.
+
+"""
+
+import logging
+from provd.devices.device import LOOKUP_KEYS
+from provd.persist.common import ID_KEY
+from twisted.internet import defer
+from twisted.python import failure
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingUpdate(object):
+    def __init__(self):
+        self.device = None
+        self.pre_update_hooks = []
+        self.deferreds = []
+
+
+def _new_pre_update_hook(pre_update_hooks):
+    if not pre_update_hooks:
+        return None
+    elif len(pre_update_hooks) == 1:
+        return pre_update_hooks[0]
+
+    def pre_update_hook(device, config):
+        for hook in pre_update_hooks:
+            hook(device, config)
+    return pre_update_hook
+
+
+class DeviceUpdateCoalescer(object):
+    """Update devices through the application, coalescing the updates of
+    the same device.
+
+    The device passed to the last update call is the one that is persisted,
+    and every pre-update hook is called on it. If the device only differs
+    from the persisted device by its volatile keys, it is not persisted.
+
+    The keys used to look up the devices can't be volatile, else a device
+    would not be found anymore by its new MAC or IP address.
+
+    """
+
+    def __init__(self, app, window=0.0, volatile_keys=(), clock=None):
+        invalid_keys = set(volatile_keys).intersection(LOOKUP_KEYS + [ID_KEY])
+        if invalid_keys:
+            raise ValueError('invalid volatile keys: %s' % ', '.join(sorted(invalid_keys)))
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._app = app
+        self._window = window
+        self._volatile_keys = frozenset(volatile_keys)
+        self._clock = clock
+        self._pending = {}
+        self._in_progress = set()
+        self.nb_requested = 0
+        self.nb_coalesced = 0
+        self.nb_skipped = 0
+        self.nb_persisted = 0
+
+    def update(self, device, pre_update_hook=None):
+        """Return a deferred that will fire with None once the device has
+        been updated, or fire its errback if the update failed.
+
+        If the window is not 0, the returned deferred has already fired,
+        so that the requests of the device are not delayed by the window,
+        and the errors are only logged.
+
+        The deferred will fire its errback with an exception if device has
+        no 'id' key.
+
+        """
+        try:
+            id = device[ID_KEY]
+        except KeyError:
+            return self._app.dev_update(device, pre_update_hook=pre_update_hook)
+
+        self.nb_requested += 1
+        pending = self._pending.get(id)
+        if pending is None:
+            pending = self._pending[id] = _PendingUpdate()
+            schedule = id not in self._in_progress
+        else:
+            logger.debug('Coalescing update of device %s', id)
+            self.nb_coalesced += 1
+            schedule = False
+        pending.device = device
+        if pre_update_hook is not None:
+            pending.pre_update_hooks.append(pre_update_hook)
+        if self._window > 0:
+            if schedule:
+                self._clock.callLater(self._window, self._flush, id)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        pending.deferreds.append(d)
+        if schedule:
+            self._flush(id)
+        return d
+
+    def _flush(self, id):
+        pending = self._pending.pop(id)
+        self._in_progress.add(id)
+        d = self._update(pending)
+        d.addBoth(self._on_flushed, id, pending)
+
+    def _on_flushed(self, result, id, pending):
+        self._in_progress.discard(id)
+        if id in self._pending:
+            # the device has been updated again while the update was in
+            # progress, no need to wait any longer
+            self._flush(id)
+        if pending.deferreds:
+            for d in pending.deferreds:
+                d.callback(result)
+        elif isinstance(result, failure.Failure):
+            logger.error('Error while updating device %s: %s', id, result.getErrorMessage())
+
+    def _is_volatile_change(self, old_device, device):
+        volatile_keys = self._volatile_keys
+        if old_device is None:
+            return False
+        keys = set(old_device).union(device)
+        for key in keys:
+            if key not in volatile_keys and old_device.get(key) != device.get(key):
+                return False
+        return True
+
+    @defer.inlineCallbacks
+    def _update(self, pending):
+        device = pending.device
+        if self._volatile_keys and not pending.pre_update_hooks:
+            old_device = yield self._app.dev_retrieve(device[ID_KEY])
+            if self._is_volatile_change(old_device, device):
+                logger.debug('Not persisting device %s: only volatile keys changed', device[ID_KEY])
+                self.nb_skipped += 1
+                defer.returnValue(None)
+        self.nb_persisted += 1
+        pre_update_hook = _new_pre_update_hook(pending.pre_update_hooks)
+        yield self._app.dev_update(device, pre_update_hook=pre_update_hook)
+
+    def stats(self):
+        return {
+            u'requested': self.nb_requested,
+            u'coalesced': self.nb_coalesced,
+            u'skipped': self.nb_skipped,
+            u'persisted': self.nb_persisted,
+        }
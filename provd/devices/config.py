@@ -426,6 +426,7 @@ import uuid
 from copy import deepcopy
 from functools import wraps
 from provd.persist.common import ID_KEY
+from provd.persist.document import cow, freeze
 from provd.persist.util import ForwardingDocumentCollection
 from twisted.internet import defer
 
@@ -514,6 +515,29 @@ def _remove_none_values(config):
 
 
 class ConfigCollection(ForwardingDocumentCollection):
+    # Flattened raw configs are cached by config ID. An entry is invalidated
+    # when the config or one of its ancestors is inserted, updated or
+    # deleted, i.e. the entries of the config and of its descendants are
+    # removed from the cache. Like the childs and parents indexes, the cache
+    # is invalidated synchronously, without waiting for the modification
+    # to be persisted.
+
+    def __init__(self, collection):
+        ForwardingDocumentCollection.__init__(self, collection)
+        # map config ID to (base raw config, frozen flattened raw config)
+        self._raw_config_cache = {}
+        # incremented every time the cache is invalidated, so that a raw
+        # config computed before an invalidation is not cached
+        self._raw_config_generation = 0
+        self.raw_config_cache_hits = 0
+        self.raw_config_cache_misses = 0
+
+    def _invalidate_raw_configs(self, id):
+        self._raw_config_generation += 1
+        self._raw_config_cache.pop(id, None)
+        for descendant_id in self._descendants(id):
+            self._raw_config_cache.pop(descendant_id, None)
+
     @defer.inlineCallbacks
     def _build_childs_and_parents_indexes(self):
         # XXX it's possible to have this method executed twice, for example
@@ -546,8 +570,10 @@ class ConfigCollection(ForwardingDocumentCollection):
     def insert(self, config):
         config = _remove_none_values_for_device(config)
         _check_config_validity(config)
-
-        def callback(id):
+        deferred = self._collection.insert(config)
+        if not self._rejected(deferred):
+            # the ID of the config is set by the collection if missing
+            id = config[ID_KEY]
             parent_ids = config[u'parent_ids']
             # update childs idx
             for parent_id in parent_ids:
@@ -557,18 +583,19 @@ class ConfigCollection(ForwardingDocumentCollection):
                     self._childs_idx[parent_id] = [id]
             # update parents idx
             self._parents_idx[id] = list(parent_ids)
-            return id
-        deferred = self._collection.insert(config)
-        deferred.addCallback(callback)
+            # a config might already have been referenced as a parent
+            self._invalidate_raw_configs(id)
         return deferred
 
     @_needs_childs_and_parents_indexes
     def update(self, config):
         config = _remove_none_values_for_device(config)
         _check_config_validity(config)
-
-        def callback(_):
-            id = config[ID_KEY]
+        id = config.get(ID_KEY)
+        if id is not None:
+            self._invalidate_raw_configs(id)
+        deferred = self._collection.update(config)
+        if not self._rejected(deferred):
             new_parent_ids = config[u'parent_ids']
             old_parent_ids = self._parents_idx[id]
             if new_parent_ids != old_parent_ids:
@@ -585,13 +612,13 @@ class ConfigCollection(ForwardingDocumentCollection):
                         self._childs_idx[parent_id] = [id]
                 # update parents idx
                 self._parents_idx[id] = list(new_parent_ids)
-        deferred = self._collection.update(config)
-        deferred.addCallback(callback)
         return deferred
 
     @_needs_childs_and_parents_indexes
     def delete(self, id):
-        def callback(_):
+        self._invalidate_raw_configs(id)
+        deferred = self._collection.delete(id)
+        if not self._rejected(deferred):
             # update childs idx
             old_parent_ids = self._parents_idx[id]
             for parent_id in old_parent_ids:
@@ -601,8 +628,6 @@ class ConfigCollection(ForwardingDocumentCollection):
                     del self._childs_idx[parent_id]
             # update parents idx
             del self._parents_idx[id]
-        deferred = self._collection.delete(id)
-        deferred.addCallback(callback)
         return deferred
 
     @_needs_childs_and_parents_indexes
@@ -633,6 +658,9 @@ class ConfigCollection(ForwardingDocumentCollection):
         is unknown.
 
         """
+        return self._descendants(id)
+
+    def _descendants(self, id):
         visited = set()
 
         def aux(cur_id):
@@ -650,7 +678,34 @@ class ConfigCollection(ForwardingDocumentCollection):
         parameters from its ancestors config, or fire with None if id is not
         a known ID.
 
+        The returned raw config is a copy-on-write dictionary (see
+        provd.persist.document).
+
         """
+        entry = self._raw_config_cache.get(id)
+        if entry is not None and entry[0] is base_raw_config:
+            self.raw_config_cache_hits += 1
+            return defer.succeed(cow(entry[1]))
+        self.raw_config_cache_misses += 1
+        generation = self._raw_config_generation
+
+        def callback(raw_config):
+            if raw_config is None:
+                return None
+            raw_config = freeze(raw_config)
+            if generation == self._raw_config_generation:
+                self._raw_config_cache[id] = (base_raw_config, raw_config)
+            return cow(raw_config)
+        d = self._get_raw_config(id, base_raw_config)
+        d.addCallback(callback)
+        return d
+
+    def stats(self):
+        stats = self._collection.stats()
+        stats[u'raw_config_cache_entries'] = len(self._raw_config_cache)
+        return stats
+
+    def _get_raw_config(self, id, base_raw_config):
         # flattened_raw_config is set to a copy of base_raw_config only once
         # we know that the id is valid. This is a bit ugly, but it's the
         # simplest thing to do.
@@ -40,19 +40,33 @@ Finally, device collection objects are used as a storage for device objects.
 
 import logging
 from copy import deepcopy
+from functools import wraps
 from provd.util import is_normed_mac, is_normed_ip
+from provd.persist.common import ID_KEY
+from provd.persist.document import freeze
 from provd.persist.util import ForwardingDocumentCollection
+from twisted.internet import defer
 
 logger = logging.getLogger(__name__)
 
 _RECONF_KEYS = [u'plugin', u'config', u'mac', u'uuid',
                 u'vendor', u'model', u'version', 'options']
 
+# keys used to find the device doing a request
+LOOKUP_KEYS = [u'mac', u'ip', u'sn', u'uuid']
+
 
 def copy(device):
     return deepcopy(device)
 
 
+def snapshot(device):
+    # Return a read-only copy of the device. This is cheaper than copy for
+    # devices returned by a collection, since their unmodified values are
+    # shared instead of being copied.
+    return freeze(device)
+
+
 def needs_reconfiguration(old_device, new_device):
     for key in _RECONF_KEYS:
         if old_device.get(key) != new_device.get(key):
@@ -72,11 +86,141 @@ def _check_device_validity(device):
         raise ValueError('Tenant UUID not specified')
 
 
+def _needs_lookup_indexes(fun):
+    # Method wrapped by this decorator will return a deferred.
+    # Note: to be used only with method on a DeviceCollection.
+    @wraps(fun)
+    def aux(self, *args, **kwargs):
+        if self._lookup_idx is not None:
+            return defer.maybeDeferred(fun, self, *args, **kwargs)
+        else:
+            def callback(_):
+                assert self._lookup_idx is not None
+                return fun(self, *args, **kwargs)
+            deferred = self._build_lookup_indexes()
+            deferred.addCallback(callback)
+            return deferred
+    return aux
+
+
+def _get_lookup_values(device):
+    # Return a list of (key, value) tuples for the lookup keys of the device
+    lookup_values = []
+    for key in LOOKUP_KEYS:
+        value = device.get(key)
+        if value is not None:
+            try:
+                hash(value)
+            except TypeError:
+                continue
+            lookup_values.append((key, value))
+    return lookup_values
+
+
 class DeviceCollection(ForwardingDocumentCollection):
+    # Device IDs are indexed in memory by the value of their lookup keys,
+    # so that the device doing a request is found without going through
+    # a query. The lookup indexes are built the first time they are needed
+    # and are updated as soon as a device is inserted, updated or deleted,
+    # without waiting for the modification to be persisted.
+
+    def __init__(self, collection):
+        ForwardingDocumentCollection.__init__(self, collection)
+        # map (key, value) to the set of IDs of the devices with this value
+        self._lookup_idx = None
+        # map device ID to the list of (key, value) of the device
+        self._lookup_values = None
+        self.lookup_hits = 0
+        self.lookup_misses = 0
+
+    @defer.inlineCallbacks
+    def _build_lookup_indexes(self):
+        logger.debug('Building lookup indexes')
+        lookup_idx = {}
+        lookup_values = {}
+        devices = yield self._collection.find({})
+        for device in devices:
+            id = device[ID_KEY]
+            values = lookup_values[id] = _get_lookup_values(device)
+            for key_value in values:
+                lookup_idx.setdefault(key_value, set()).add(id)
+        self._lookup_idx = lookup_idx
+        self._lookup_values = lookup_values
+
+    def _add_lookup_values(self, id, device):
+        values = self._lookup_values[id] = _get_lookup_values(device)
+        for key_value in values:
+            self._lookup_idx.setdefault(key_value, set()).add(id)
+
+    def _remove_lookup_values(self, id):
+        for key_value in self._lookup_values.pop(id, ()):
+            ids = self._lookup_idx[key_value]
+            ids.discard(id)
+            if not ids:
+                del self._lookup_idx[key_value]
+
+    @_needs_lookup_indexes
     def insert(self, device):
         _check_device_validity(device)
-        return self._collection.insert(device)
+        deferred = self._collection.insert(device)
+        if not self._rejected(deferred):
+            # the ID of the device is set by the collection if missing
+            self._add_lookup_values(device[ID_KEY], device)
+        return deferred
 
+    @_needs_lookup_indexes
     def update(self, device):
         _check_device_validity(device)
-        return self._collection.update(device)
+        deferred = self._collection.update(device)
+        if not self._rejected(deferred):
+            id = device[ID_KEY]
+            self._remove_lookup_values(id)
+            self._add_lookup_values(id, device)
+        return deferred
+
+    @_needs_lookup_indexes
+    def delete(self, id):
+        deferred = self._collection.delete(id)
+        if not self._rejected(deferred):
+            self._remove_lookup_values(id)
+        return deferred
+
+    @_needs_lookup_indexes
+    @defer.inlineCallbacks
+    def lookup(self, key, value):
+        """Return a deferred that will fire with the list, sorted by ID, of
+        the devices whose key is equal to value, where key is one of the
+        lookup keys.
+
+        """
+        if key not in LOOKUP_KEYS:
+            raise ValueError('invalid lookup key: %s' % key)
+        try:
+            ids = sorted(self._lookup_idx.get((key, value), ()))
+        except TypeError:
+            ids = []
+        devices = []
+        for id in ids:
+            device = yield self._collection.retrieve(id)
+            if device is not None:
+                devices.append(device)
+        if devices:
+            self.lookup_hits += 1
+        else:
+            self.lookup_misses += 1
+        defer.returnValue(devices)
+
+    def stats(self):
+        stats = self._collection.stats()
+        stats[u'lookup_entries'] = len(self._lookup_idx) if self._lookup_idx is not None else 0
+        return stats
+
+    def lookup_hit_ratio(self):
+        """Return the ratio of lookups that found at least one device, or
+        None if no lookup has been done yet.
+
+        """
+        nb_lookups = self.lookup_hits + self.lookup_misses
+        if not nb_lookups:
+            return None
+        return float(self.lookup_hits) / nb_lookups
@@ -9,12 +9,15 @@ import logging
 from collections import defaultdict
 from operator import itemgetter
 from os.path import basename
-from provd.devices.device import copy as copy_device
+from provd.devices.device import LOOKUP_KEYS, snapshot as snapshot_device
+from provd.metrics import NULL_REQUEST_TRACE, STAGE_EXTRACT, STAGE_RETRIEVE,\
+    STAGE_UPDATE, STAGE_ROUTE, STAGE_SERVE
 from provd.plugins import BasePluginManagerObserver
 from provd.security import log_security_msg
 from provd.servers.tftp.packet import ERR_UNDEF
 from provd.servers.tftp.service import TFTPNullService
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from twisted.web.http import INTERNAL_SERVER_ERROR
 from twisted.web.resource import Resource, NoResource, ErrorPage
 from twisted.web import rewrite
@@ -69,6 +72,17 @@ class IDeviceInfoExtractor(Interface):
     information, we can then always make sure the IP <-> MAC for a device is
     up to date.
 
+    The device info extractors of plugins MAY also have the following
+    attributes, so that they are only called for the requests they can
+    extract information from:
+    - filename_prefixes, a list of prefixes of the filenames of the TFTP and
+      HTTP requests they care about
+    - user_agent_prefixes, a list of prefixes of the User-Agent header of the
+      HTTP requests they care about
+    An extractor having at least one of these attributes is called only if
+    the request matches one of the prefixes. These attributes are ignored
+    for DHCP requests.
+
     """
 
     def extract(request, request_type):
@@ -183,6 +197,10 @@ class AllPluginsDeviceInfoExtractor(object):
     """Composite device info extractor that forward extraction requests to
     device info extractors of every loaded plugins.
 
+    Extractors declaring filename or user agent prefixes are indexed in
+    prefix tries, so that only the extractors relevant to a request are
+    called.
+
     """
 
     implements(IDeviceInfoExtractor)
@@ -194,6 +212,7 @@ class AllPluginsDeviceInfoExtractor(object):
         """
         self.extractor_factory = extractor_factory
         self._pg_mgr = pg_mgr
+        self._xtor_indexes = {}
         self._set_xtors()
         # observe plugin loading/unloading and keep a reference to the weakly
         # referenced observer
@@ -215,15 +234,170 @@ class AllPluginsDeviceInfoExtractor(object):
                     pg_extractors.append(pg_extractor)
             xtor = self.extractor_factory(pg_extractors)
             setattr(self, self._xtor_name(request_type), xtor)
+            if request_type == REQUEST_TYPE_DHCP:
+                index = None
+            else:
+                index = _ExtractorIndex(pg_extractors, self.extractor_factory)
+                if not index.is_useful():
+                    index = None
+            self._xtor_indexes[request_type] = index
 
     def _on_plugin_load_or_unload(self, pg_id):
         self._set_xtors()
 
     def extract(self, request, request_type):
-        xtor = getattr(self, self._xtor_name(request_type))
+        index = self._xtor_indexes.get(request_type)
+        if index is None:
+            xtor = getattr(self, self._xtor_name(request_type))
+        else:
+            xtor = index.get_extractor(request, request_type)
         return xtor.extract(request, request_type)
 
 
+class _PrefixTrie(object):
+    # Map string prefixes to values.
+
+    def __init__(self):
+        # each node is a dict mapping a character to a child node, and None
+        # to the list of values of the prefix ending at this node
+        self._root = {}
+
+    def add(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def find(self, string):
+        # Return the list of values of every prefix of string
+        node = self._root
+        values = list(node.get(None, ()))
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                values.extend(node[None])
+        return values
+
+
+class _ExtractorIndex(object):
+    # Index of extractors by the filename and user agent prefixes they
+    # declare, used to select the extractors to call for a request.
+
+    _CACHE_MAX_SIZE = 256
+
+    def __init__(self, extractors, extractor_factory):
+        self._extractors = extractors
+        self._extractor_factory = extractor_factory
+        self._always_idx = []
+        self._filename_trie = _PrefixTrie()
+        self._user_agent_trie = _PrefixTrie()
+        # map a tuple of extractor indexes to the composite extractor
+        self._cache = {}
+        for i, extractor in enumerate(extractors):
+            filename_prefixes = getattr(extractor, 'filename_prefixes', None)
+            user_agent_prefixes = getattr(extractor, 'user_agent_prefixes', None)
+            if filename_prefixes is None and user_agent_prefixes is None:
+                self._always_idx.append(i)
+                continue
+            for prefix in filename_prefixes or ():
+                self._filename_trie.add(prefix, i)
+            for prefix in user_agent_prefixes or ():
+                self._user_agent_trie.add(prefix, i)
+
+    def is_useful(self):
+        return len(self._always_idx) != len(self._extractors)
+
+    def get_extractor(self, request, request_type):
+        indexes = set(self._always_idx)
+        filename = _get_filename_from_request(request, request_type)
+        if filename:
+            indexes.update(self._filename_trie.find(filename))
+        if request_type == REQUEST_TYPE_HTTP:
+            user_agent = request.getHeader('User-Agent')
+            if user_agent:
+                indexes.update(self._user_agent_trie.find(user_agent))
+        key = tuple(sorted(indexes))
+        try:
+            return self._cache[key]
+        except KeyError:
+            extractor = self._extractor_factory([self._extractors[i] for i in key])
+            if len(self._cache) >= self._CACHE_MAX_SIZE:
+                self._cache.clear()
+            self._cache[key] = extractor
+            return extractor
+
+
+class KnownDeviceInfoExtractor(object):
+    """Device info extractor that forwards extraction requests only to the
+    device info extractor of the plugin of the requesting device, if this
+    device is known.
+
+    The requesting device is looked up by its MAC address for DHCP requests
+    and by its IP address otherwise. If no single device with a loaded
+    plugin is found, or if the plugin extractor doesn't extract anything or
+    extracts information that doesn't match the device, the extraction
+    request is forwarded to the fallback extractor, which is usually an
+    AllPluginsDeviceInfoExtractor.
+
+    """
+
+    implements(IDeviceInfoExtractor)
+
+    _MATCH_KEYS = [u'mac', u'vendor', u'model']
+
+    def __init__(self, app, fallback_extractor):
+        self._app = app
+        self._fallback_extractor = fallback_extractor
+        self.nb_known = 0
+        self.nb_fallbacks = 0
+
+    @defer.inlineCallbacks
+    def _retrieve_device(self, request, request_type):
+        if request_type == REQUEST_TYPE_DHCP:
+            devices = yield self._app.dev_lookup(u'mac', request[u'mac'])
+        elif self._app.nat:
+            # many devices might have the same IP address
+            defer.returnValue(None)
+        else:
+            ip = _get_ip_from_request(request, request_type)
+            devices = yield self._app.dev_lookup(u'ip', ip)
+        if len(devices) == 1:
+            defer.returnValue(devices[0])
+        defer.returnValue(None)
+
+    def _get_plugin_extractor(self, device, request_type):
+        plugin_id = device.get(u'plugin')
+        if not plugin_id:
+            return None
+        plugin = self._app.pg_mgr.get(plugin_id)
+        if plugin is None:
+            return None
+        return getattr(plugin, request_type + '_dev_info_extractor', None)
+
+    def _matches(self, device, dev_info):
+        for key in self._MATCH_KEYS:
+            if key in dev_info and key in device and dev_info[key] != device[key]:
+                return False
+        return True
+
+    @defer.inlineCallbacks
+    def extract(self, request, request_type):
+        device = yield self._retrieve_device(request, request_type)
+        if device is not None:
+            pg_extractor = self._get_plugin_extractor(device, request_type)
+            if pg_extractor is not None:
+                dev_info = yield pg_extractor.extract(request, request_type)
+                if dev_info and self._matches(device, dev_info):
+                    self.nb_known += 1
+                    defer.returnValue(dev_info)
+                logger.debug('Device info %s does not match device %s', dev_info, device[u'id'])
+        self.nb_fallbacks += 1
+        dev_info = yield self._fallback_extractor.extract(request, request_type)
+        defer.returnValue(dev_info)
+
+
 class IDeviceRetriever(Interface):
     """A device retriever return a device object from device information.
 
@@ -254,6 +428,10 @@ class SearchDeviceRetriever(object):
 
     def retrieve(self, dev_info):
         if self._key in dev_info:
+            if self._key in LOOKUP_KEYS:
+                d = self._app.dev_lookup(self._key, dev_info[self._key])
+                d.addCallback(lambda devices: devices[0] if devices else None)
+                return d
             return self._app.dev_find_one({self._key: dev_info[self._key]})
         return defer.succeed(None)
 
@@ -267,7 +445,7 @@ class IpDeviceRetriever(object):
     @defer.inlineCallbacks
     def retrieve(self, dev_info):
         if u'ip' in dev_info:
-            devices = yield self._app.dev_find({u'ip': dev_info[u'ip']})
+            devices = yield self._app.dev_lookup(u'ip', dev_info[u'ip'])
             matching_device = self._get_matching_device(devices, dev_info)
             defer.returnValue(matching_device)
         defer.returnValue(None)
@@ -497,11 +675,18 @@ class RequestProcessingService(object):
 
     """
 
-    def __init__(self, app, dev_info_extractor, dev_retriever, dev_updater):
+    def __init__(self, app, dev_info_extractor, dev_retriever, dev_updater,
+                 dev_update_coalescer=None, request_stats=None):
+        # dev_update_coalescer is an optional DeviceUpdateCoalescer used to
+        # persist the device updates
+        # request_stats is an optional RequestStats object used to time the
+        # requests that are processed without a trace
         self._app = app
         self._dev_info_extractor = dev_info_extractor
         self._dev_retriever = dev_retriever
         self._dev_updater = dev_updater
+        self._dev_update_coalescer = dev_update_coalescer
+        self._request_stats = request_stats
         self._req_id = 0    # used for logging
 
     def _new_request_id(self):
@@ -509,8 +694,7 @@ class RequestProcessingService(object):
         self._req_id = (self._req_id + 1) % 100
         return req_id
 
-    @defer.inlineCallbacks
-    def process(self, request, request_type):
+    def process(self, request, request_type, trace=None):
         """Return a deferred that will eventually fire with a (device, pg_id)
         pair, where:
 
@@ -519,73 +703,147 @@ class RequestProcessingService(object):
         - pg_id is a plugin identifier or None, identifying which plugin should
           continue to process this request.
 
+        If trace is not None, it's a RequestTrace object on which the stages
+        of the processing are marked, and which must be finished by the
+        caller.
+
         """
-        helper = _RequestHelper(self._app, request, request_type, self._new_request_id())
+        request_id = self._new_request_id()
+        if trace is None:
+            if self._request_stats is None:
+                trace = NULL_REQUEST_TRACE
+            else:
+                trace = self._request_stats.new_trace(request_type)
+            finish_trace = True
+        else:
+            finish_trace = False
+        trace.request_id = request_id
+        helper = _RequestHelper(self._app, request, request_type, request_id,
+                                self._dev_update_coalescer)
 
-        dev_info = yield helper.extract_device_info(self._dev_info_extractor)
-        device = yield helper.retrieve_device(self._dev_retriever, dev_info)
-        yield helper.update_device(self._dev_updater, device, dev_info)
+        try:
+            result = _chain(helper.extract_device_info(self._dev_info_extractor),
+                            self._on_device_info_extracted, helper, trace)
+        except Exception:
+            trace.finish()
+            return defer.fail()
+        if isinstance(result, defer.Deferred):
+            if finish_trace:
+                result.addBoth(self._finish_trace, trace)
+            return result
+        if finish_trace:
+            trace.finish()
+        return defer.succeed(result)
+
+    def _finish_trace(self, result, trace):
+        trace.finish()
+        return result
+
+    def _on_device_info_extracted(self, dev_info, helper, trace):
+        trace.mark(STAGE_EXTRACT)
+        return _chain(helper.retrieve_device(self._dev_retriever, dev_info),
+                      self._on_device_retrieved, helper, trace, dev_info)
+
+    def _on_device_retrieved(self, device, helper, trace, dev_info):
+        trace.mark(STAGE_RETRIEVE)
+        return _chain(helper.update_device(self._dev_updater, device, dev_info),
+                      self._on_device_updated, helper, trace, device)
+
+    def _on_device_updated(self, _, helper, trace, device):
+        trace.mark(STAGE_UPDATE)
         pg_id = helper.get_plugin_id(device)
+        trace.plugin_id = pg_id
+        return device, pg_id
 
-        defer.returnValue((device, pg_id))
+
+def _chain(result, fun, *args):
+    # Call fun with the result of a step of the request processing, and
+    # return what fun returns, or a deferred that will fire with it.
+    #
+    # Most of the time, every step completes synchronously, so the result
+    # of an already fired deferred is used directly instead of adding a
+    # callback to the deferred.
+    if isinstance(result, defer.Deferred):
+        if result.called and not result.paused and not isinstance(result.result, Failure):
+            return fun(result.result, *args)
+        return result.addCallback(fun, *args)
+    return fun(result, *args)
 
 
 class _RequestHelper(object):
+    # The methods of this class return either a value or a deferred that
+    # will fire with the value.
 
-    def __init__(self, app, request, request_type, request_id):
+    def __init__(self, app, request, request_type, request_id, dev_update_coalescer=None):
         self._app = app
         self._request = request
         self._request_type = request_type
         self._request_id = request_id
+        self._dev_update_coalescer = dev_update_coalescer
+
+    def _dev_update(self, device, pre_update_hook=None):
+        if self._dev_update_coalescer is None:
+            if pre_update_hook is None:
+                return self._app.dev_update(device)
+            return self._app.dev_update(device, pre_update_hook=pre_update_hook)
+        return self._dev_update_coalescer.update(device, pre_update_hook)
 
-    @defer.inlineCallbacks
     def extract_device_info(self, dev_info_extractor):
-        dev_info = yield dev_info_extractor.extract(self._request, self._request_type)
+        return _chain(dev_info_extractor.extract(self._request, self._request_type),
+                      self._on_device_info_extracted)
+
+    def _on_device_info_extracted(self, dev_info):
         if not dev_info:
             logger.info('<%s> No device info extracted', self._request_id)
             dev_info = {}
         else:
             logger.info('<%s> Extracted device info: %s', self._request_id, dev_info)
 
-        defer.returnValue(dev_info)
+        return dev_info
 
-    @defer.inlineCallbacks
     def retrieve_device(self, dev_retriever, dev_info):
-        device = yield dev_retriever.retrieve(dev_info)
+        return _chain(dev_retriever.retrieve(dev_info), self._on_device_retrieved)
+
+    def _on_device_retrieved(self, device):
         if device is None:
             logger.info('<%s> No device retrieved', self._request_id)
         else:
             logger.info('<%s> Retrieved device id: %s', self._request_id, device[u'id'])
 
-        defer.returnValue(device)
+        return device
 
-    @defer.inlineCallbacks
     def update_device(self, dev_updater, device, dev_info):
         if device is None:
-            defer.returnValue(None)
+            return None
+
+        orig_device = snapshot_device(device)
+        return _chain(dev_updater.update(device, dev_info, self._request, self._request_type),
+                      self._on_device_updated, device, orig_device)
 
-        orig_device = copy_device(device)
-        yield dev_updater.update(device, dev_info, self._request, self._request_type)
+    def _on_device_updated(self, _, device, orig_device):
         if device == orig_device:
-            yield self._update_device_on_no_change(device)
+            return self._update_device_on_no_change(device)
         else:
             logger.info('<%s> Device has been updated', self._request_id)
-            yield self._update_device_on_change(device)
+            return self._update_device_on_change(device)
 
-    @defer.inlineCallbacks
     def _update_device_on_no_change(self, device):
         if not device.get(u'configured'):
-            defer.returnValue(None)
+            return None
 
         if not self._should_update_remote_state(device):
-            defer.returnValue(None)
+            return None
+
+        return _chain(self._app.cfg_retrieve(device[u'config']),
+                      self._on_config_retrieved, device)
 
-        config = yield self._app.cfg_retrieve(device[u'config'])
+    def _on_config_retrieved(self, config, device):
         if not config:
-            defer.returnValue(None)
+            return None
 
         if self._update_remote_state_sip_username(device, config):
-            yield self._app.dev_update(device)
+            return self._dev_update(device)
+        return None
 
     def _update_device_on_change(self, device):
         if self._should_update_remote_state(device):
@@ -593,7 +851,7 @@ class _RequestHelper(object):
         else:
             pre_update_hook = None
 
-        return self._app.dev_update(device, pre_update_hook=pre_update_hook)
+        return self._dev_update(device, pre_update_hook)
 
     def _should_update_remote_state(self, device):
         filename = _get_filename_from_request(self._request, self._request_type)
@@ -710,21 +968,30 @@ class HTTPRequestProcessingService(Resource):
 
     default_service = NoResource('Nowhere to route this request.')
 
-    def __init__(self, process_service, pg_mgr):
+    def __init__(self, process_service, pg_mgr, request_stats=None):
         Resource.__init__(self)
         self._process_service = process_service
         self._pg_mgr = pg_mgr
+        self._request_stats = request_stats
         self.service_factory = _null_service_factory
 
+    def _new_trace(self):
+        if self._request_stats is None:
+            return NULL_REQUEST_TRACE
+        return self._request_stats.new_trace(REQUEST_TYPE_HTTP)
+
     @defer.inlineCallbacks
     def getChild(self, path, request):
         logger.info('Processing HTTP request: %s', request.path)
         logger.debug('HTTP request: %s', request)
         logger.debug('postpath: %s', request.postpath)
+        trace = self._new_trace()
         try:
-            device, pg_id = yield self._process_service.process(request, REQUEST_TYPE_HTTP)
+            device, pg_id = yield self._process_service.process(request, REQUEST_TYPE_HTTP, trace)
         except Exception:
             logger.error('Error while processing HTTP request:', exc_info=True)
+            trace.status = INTERNAL_SERVER_ERROR
+            trace.finish()
             defer.returnValue(ErrorPage(INTERNAL_SERVER_ERROR,
                               'Internal processing error',
                               'Internal processing error'))
@@ -741,12 +1008,20 @@ class HTTPRequestProcessingService(Resource):
                     if hasattr(service, 'path_preprocess'):
                         logger.debug('Rewriting paths to the HTTP Service')
                         service = rewrite.RewriterResource(service, service.path_preprocess)
+            trace.mark(STAGE_ROUTE)
+            request.notifyFinish().addBoth(self._on_request_finished, request, trace)
             if service.isLeaf:
                 request.postpath.insert(0, request.prepath.pop())
                 defer.returnValue(service)
             else:
                 defer.returnValue(service.getChildWithDefault(path, request))
 
+    def _on_request_finished(self, _, request, trace):
+        # called once the response has been written, or the connection lost
+        trace.mark(STAGE_SERVE)
+        trace.status = request.code
+        trace.finish()
+
 
 class TFTPRequestProcessingService(object):
     """A TFTP read service that does TFTP request processing and routing to
@@ -758,14 +1033,21 @@ class TFTPRequestProcessingService(object):
 
     default_service = TFTPNullService(errmsg="Nowhere to route this request")
 
-    def __init__(self, process_service, pg_mgr):
+    def __init__(self, process_service, pg_mgr, request_stats=None):
         self._process_service = process_service
         self._pg_mgr = pg_mgr
+        self._request_stats = request_stats
         self.service_factory = _null_service_factory
 
+    def _new_trace(self):
+        if self._request_stats is None:
+            return NULL_REQUEST_TRACE
+        return self._request_stats.new_trace(REQUEST_TYPE_TFTP)
+
     def handle_read_request(self, request, response):
         logger.info('Processing TFTP request: %s', request['packet']['filename'])
         logger.debug('TFTP request: %s', request)
+        trace = self._new_trace()
         def callback((device, pg_id)):
             # Here we 'inject' the device object into the request object
             request['prov_dev'] = device
@@ -776,11 +1058,17 @@ class TFTPRequestProcessingService(object):
                 if plugin.tftp_service is not None:
                     _log_sensitive_request(plugin, request, REQUEST_TYPE_TFTP)
                     service = self.service_factory(pg_id, plugin.tftp_service)
+            trace.mark(STAGE_ROUTE)
+            # the time taken by the service to accept or reject the request,
+            # not the duration of the transfer
             service.handle_read_request(request, response)
+            trace.mark(STAGE_SERVE)
+            trace.finish()
         def errback(failure):
             logger.error('Error while processing TFTP request: %s', failure)
+            trace.finish()
             response.reject(ERR_UNDEF, 'Internal processing error')
-        d = self._process_service.process(request, REQUEST_TYPE_TFTP)
+        d = self._process_service.process(request, REQUEST_TYPE_TFTP, trace)
         d.addCallbacks(callback, errback)
 
 
@@ -6,9 +6,11 @@
 
 
 import logging
+import weakref
 from collections import defaultdict
 from operator import itemgetter
 from provd.devices.ident import IDeviceUpdater
+from provd.plugins import BasePluginManagerObserver
 from twisted.internet import defer
 from zope.interface import Interface, implements
 
@@ -79,15 +81,108 @@ class ReverseAlphabeticConflictSolver(object):
         return max(pg_ids)
 
 
+def _score_cache_key(dev_info):
+    return dev_info.get(u'vendor'), dev_info.get(u'model'), dev_info.get(u'version')
+
+
+class AssociationScoreCache(object):
+    """Cache of the plugin association scores, keyed by the vendor, model
+    and version of the device info.
+
+    Plugin associators are expected to only use these keys of the device
+    info, like BasePgAssociator does. The cache is cleared every time a
+    plugin is loaded or unloaded.
+
+    """
+
+    max_size = 10000
+
+    def __init__(self, pg_mgr):
+        # map (vendor, model, version) to a dictionary mapping scores to the
+        # list of IDs of the plugins with this score
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+        # observe plugin loading/unloading and keep a reference to the weakly
+        # referenced observer
+        self._obs = BasePluginManagerObserver(self._on_plugin_load_or_unload,
+                                              self._on_plugin_load_or_unload)
+        pg_mgr.attach(self._obs)
+
+    def _on_plugin_load_or_unload(self, pg_id):
+        self.clear()
+
+    def clear(self):
+        self._cache.clear()
+
+    def get(self, dev_info):
+        """Return the cached scores for the device info, or None."""
+        pg_scores = self._cache.get(_score_cache_key(dev_info))
+        if pg_scores is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return pg_scores
+
+    def set(self, dev_info, pg_scores):
+        if len(self._cache) >= self.max_size:
+            self._cache.clear()
+        self._cache[_score_cache_key(dev_info)] = pg_scores
+
+    def associations(self):
+        """Return a list of dictionaries describing the cached scores, with
+        the plugins having the highest score for each vendor, model and
+        version.
+
+        """
+        associations = []
+        for (vendor, model, version), pg_scores in self._cache.iteritems():
+            scores = {}
+            for score, pg_ids in pg_scores.iteritems():
+                for pg_id in pg_ids:
+                    scores[pg_id] = score
+            if pg_scores:
+                best_pg_ids = sorted(pg_scores[max(pg_scores)])
+            else:
+                best_pg_ids = []
+            associations.append({
+                u'vendor': vendor,
+                u'model': model,
+                u'version': version,
+                u'scores': scores,
+                u'best_plugins': best_pg_ids,
+            })
+        return associations
+
+
+# map plugin managers to their shared association score cache
+_score_caches = weakref.WeakKeyDictionary()
+
+
+def get_association_score_cache(pg_mgr):
+    """Return the association score cache shared by the users of the plugin
+    manager, creating it if needed.
+
+    """
+    score_cache = _score_caches.get(pg_mgr)
+    if score_cache is None:
+        score_cache = _score_caches[pg_mgr] = AssociationScoreCache(pg_mgr)
+    return score_cache
+
+
 class PluginAssociatorDeviceUpdater(object):
     implements(IDeviceUpdater)
 
     force_update = False
     min_level = PROBABLE_SUPPORT
 
-    def __init__(self, pg_mgr, conflict_solver):
+    def __init__(self, pg_mgr, conflict_solver, score_cache=None):
+        # score_cache defaults to the cache shared by the users of pg_mgr
         self._pg_mgr = pg_mgr
         self._solver = conflict_solver
+        if score_cache is None:
+            score_cache = get_association_score_cache(pg_mgr)
+        self._score_cache = score_cache
 
     def update(self, dev, dev_info, request, request_type):
         if self.force_update or u'plugin' not in dev:
@@ -114,7 +209,16 @@ class PluginAssociatorDeviceUpdater(object):
         return None
 
     def _get_scores(self, dev_info):
+        pg_scores = self._score_cache.get(dev_info)
+        if pg_scores is None:
+            pg_scores, errors = self._compute_scores(dev_info)
+            if not errors:
+                self._score_cache.set(dev_info, pg_scores)
+        return pg_scores
+
+    def _compute_scores(self, dev_info):
         pg_scores = defaultdict(list)
+        errors = False
         for pg_id, pg in self._pg_mgr.iteritems():
             sstor = pg.pg_associator
             if sstor is not None:
@@ -124,6 +228,7 @@ class PluginAssociatorDeviceUpdater(object):
                 except Exception:
                     logger.error('Error during plugin association for plugin %s',
                                  pg_id, exc_info=True)
+                    errors = True
                 else:
                     pg_scores[score].append(pg_id)
-        return pg_scores
+        return dict(pg_scores), errors
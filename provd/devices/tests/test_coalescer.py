@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from hamcrest import assert_that, contains, equal_to, has_entries
+from mock import Mock, call
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from ..coalescer import DeviceUpdateCoalescer
+
+
+class TestDeviceUpdateCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Mock()
+        self.app.dev_update.return_value = defer.succeed(None)
+        self.clock = Clock()
+
+    def test_update_without_window(self):
+        coalescer = DeviceUpdateCoalescer(self.app)
+        device = {u'id': u'a'}
+
+        d = coalescer.update(device)
+
+        assert_that(d.called)
+        self.app.dev_update.assert_called_once_with(device, pre_update_hook=None)
+
+    def test_update_merges_updates_within_window(self):
+        coalescer = DeviceUpdateCoalescer(self.app, window=1.0, clock=self.clock)
+        hook1 = Mock()
+        hook2 = Mock()
+        device1 = {u'id': u'a', u'ip': u'10.0.0.1'}
+        device2 = {u'id': u'a', u'ip': u'10.0.0.2'}
+
+        d1 = coalescer.update(device1, hook1)
+        d2 = coalescer.update(device2, hook2)
+        assert_that(self.app.dev_update.called, equal_to(False))
+        self.clock.advance(1.0)
+
+        assert_that(d1.called and d2.called)
+        assert_that(self.app.dev_update.call_count, equal_to(1))
+        assert_that(self.app.dev_update.call_args[0][0], equal_to(device2))
+        pre_update_hook = self.app.dev_update.call_args[1]['pre_update_hook']
+        pre_update_hook(device2, None)
+        hook1.assert_called_once_with(device2, None)
+        hook2.assert_called_once_with(device2, None)
+        assert_that(coalescer.stats(), has_entries({u'requested': 2,
+                                                     u'coalesced': 1,
+                                                     u'persisted': 1}))
+
+    def test_update_within_window_does_not_wait(self):
+        self.app.dev_update.return_value = defer.Deferred()
+        coalescer = DeviceUpdateCoalescer(self.app, window=1.0, clock=self.clock)
+
+        d = coalescer.update({u'id': u'a'})
+
+        assert_that(d.called)
+        assert_that(self.app.dev_update.called, equal_to(False))
+
+    def test_update_within_window_error(self):
+        self.app.dev_update.return_value = defer.fail(Exception('error'))
+        coalescer = DeviceUpdateCoalescer(self.app, window=1.0, clock=self.clock)
+        errors = []
+
+        d = coalescer.update({u'id': u'a'})
+        d.addErrback(errors.append)
+        self.clock.advance(1.0)
+
+        assert_that(errors, equal_to([]))
+        assert_that(coalescer.stats(), has_entries({u'persisted': 1}))
+
+    def test_lookup_keys_are_not_volatile(self):
+        for key in [u'id', u'mac', u'ip', u'sn', u'uuid']:
+            self.assertRaises(ValueError, DeviceUpdateCoalescer, self.app, volatile_keys=[u'version', key])
+
+    def test_update_merges_updates_while_in_progress(self):
+        in_progress = defer.Deferred()
+        self.app.dev_update.side_effect = [in_progress, defer.succeed(None)]
+        coalescer = DeviceUpdateCoalescer(self.app)
+        device1 = {u'id': u'a', u'ip': u'10.0.0.1'}
+        device2 = {u'id': u'a', u'ip': u'10.0.0.2'}
+        device3 = {u'id': u'a', u'ip': u'10.0.0.3'}
+
+        d1 = coalescer.update(device1)
+        d2 = coalescer.update(device2)
+        d3 = coalescer.update(device3)
+        in_progress.callback(None)
+
+        assert_that(d1.called and d2.called and d3.called)
+        assert_that(self.app.dev_update.call_args_list, contains(
+            call(device1, pre_update_hook=None),
+            call(device3, pre_update_hook=None),
+        ))
+        assert_that(coalescer.stats(), has_entries({u'coalesced': 1, u'persisted': 2}))
+
+    def test_update_different_devices(self):
+        coalescer = DeviceUpdateCoalescer(self.app, window=1.0, clock=self.clock)
+
+        coalescer.update({u'id': u'a'})
+        coalescer.update({u'id': u'b'})
+        self.clock.advance(1.0)
+
+        assert_that(self.app.dev_update.call_count, equal_to(2))
+
+    def test_update_skips_volatile_changes(self):
+        self.app.dev_retrieve.return_value = defer.succeed({u'id': u'a', u'version': u'1.0'})
+        coalescer = DeviceUpdateCoalescer(self.app, volatile_keys=[u'version'])
+
+        d = coalescer.update({u'id': u'a', u'version': u'1.1'})
+
+        assert_that(d.called)
+        assert_that(self.app.dev_update.called, equal_to(False))
+        assert_that(coalescer.stats(), has_entries({u'skipped': 1, u'persisted': 0}))
+
+    def test_update_persists_non_volatile_changes(self):
+        self.app.dev_retrieve.return_value = defer.succeed({u'id': u'a', u'version': u'1.0'})
+        coalescer = DeviceUpdateCoalescer(self.app, volatile_keys=[u'version'])
+        device = {u'id': u'a', u'version': u'1.1', u'ip': u'10.0.0.2'}
+
+        coalescer.update(device)
+
+        self.app.dev_update.assert_called_once_with(device, pre_update_hook=None)
+
+    def test_update_error(self):
+        self.app.dev_update.return_value = defer.fail(Exception('error'))
+        coalescer = DeviceUpdateCoalescer(self.app)
+        errors = []
+
+        d = coalescer.update({u'id': u'a'})
+        d.addErrback(errors.append)
+
+        assert_that(len(errors), equal_to(1))
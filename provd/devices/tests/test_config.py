@@ -2,6 +2,9 @@
 # Copyright 2018-2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from hamcrest import (
@@ -15,7 +18,19 @@ from hamcrest import (
     starts_with,
 )
 
-from ..config import DefaultConfigFactory, _remove_none_values
+from twisted.internet.task import Clock
+
+from provd.persist.id import numeric_id_generator
+from provd.persist.journal_backend import JournalSimpleBackend
+from provd.persist.json_backend import new_json_collection
+from provd.persist.util import new_backend_based_collection
+from ..config import ConfigCollection, DefaultConfigFactory, _remove_none_values
+
+
+def _result(deferred):
+    results = []
+    deferred.addCallback(results.append)
+    return results[0]
 
 
 class TestDefaultConfigFactory(unittest.TestCase):
@@ -140,3 +155,97 @@ class TestRemoveNoneValues(unittest.TestCase):
             result,
             is_(equal_to(expected_result)),
         )
+
+
+class TestConfigCollectionRawConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = ConfigCollection(new_json_collection(self.directory, numeric_id_generator()))
+        self.base_raw_config = {u'ip': u'10.0.0.1', u'sip_lines': {}}
+        self._insert(u'base', [], {u'locale': u'fr_FR', u'sip_lines': {u'1': {u'proxy_ip': u'1'}}})
+        self._insert(u'middle', [u'base'], {u'timezone': u'America/Montreal'})
+        self._insert(u'device', [u'middle'], {u'sip_lines': {u'1': {u'username': u'foo'}}})
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def _insert(self, id, parent_ids, raw_config):
+        _result(self.collection.insert({u'id': id, u'parent_ids': parent_ids, u'raw_config': raw_config}))
+
+    def _get_raw_config(self, id):
+        return _result(self.collection.get_raw_config(id, self.base_raw_config))
+
+    def test_get_raw_config(self):
+        raw_config = self._get_raw_config(u'device')
+
+        assert_that(raw_config, equal_to({
+            u'ip': u'10.0.0.1',
+            u'locale': u'fr_FR',
+            u'timezone': u'America/Montreal',
+            u'sip_lines': {u'1': {u'proxy_ip': u'1', u'username': u'foo'}},
+        }))
+
+    def test_get_raw_config_unknown_id(self):
+        assert_that(self._get_raw_config(u'unknown'), none())
+
+    def test_get_raw_config_is_cached(self):
+        self._get_raw_config(u'device')
+        raw_config = self._get_raw_config(u'device')
+        raw_config[u'sip_lines'][u'1'][u'username'] = u'bar'
+
+        assert_that(self._get_raw_config(u'device')[u'sip_lines'][u'1'][u'username'], equal_to(u'foo'))
+        assert_that(self.collection.raw_config_cache_hits, equal_to(2))
+        assert_that(self.collection.raw_config_cache_misses, equal_to(1))
+
+    def test_ancestor_update_invalidates_cache(self):
+        self._get_raw_config(u'device')
+        self._get_raw_config(u'base')
+        config = _result(self.collection.retrieve(u'middle'))
+        config[u'raw_config'][u'timezone'] = u'Europe/Paris'
+        _result(self.collection.update(config))
+
+        assert_that(self._get_raw_config(u'device'), has_entries({u'timezone': u'Europe/Paris'}))
+        assert_that(self._get_raw_config(u'base'), not_(has_entries({u'timezone': u'Europe/Paris'})))
+        assert_that(self.collection.raw_config_cache_hits, equal_to(1))
+
+    def test_ancestor_delete_invalidates_cache(self):
+        self._get_raw_config(u'device')
+        _result(self.collection.delete(u'base'))
+
+        assert_that(self._get_raw_config(u'device'), not_(has_entries({u'locale': u'fr_FR'})))
+
+    def test_other_base_raw_config_is_not_cached(self):
+        self._get_raw_config(u'device')
+        self.base_raw_config = {u'ip': u'10.0.0.2'}
+
+        assert_that(self._get_raw_config(u'device'), has_entries({u'ip': u'10.0.0.2'}))
+
+
+class TestConfigCollectionRawConfigJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = Clock()
+        backend = JournalSimpleBackend(os.path.join(self.directory, 'configs.journal'),
+                                       clock=self.clock)
+        self.collection = ConfigCollection(new_backend_based_collection(backend,
+                                                                        numeric_id_generator()))
+        self.collection.insert({u'id': u'base', u'parent_ids': [], u'raw_config': {u'a': 1}})
+        self.collection.insert({u'id': u'device', u'parent_ids': [u'base'], u'raw_config': {}})
+        self.clock.advance(0)
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def test_update_invalidates_cache_before_persisted(self):
+        _result(self.collection.get_raw_config(u'device'))
+
+        # the update is persisted in the next reactor iteration
+        self.collection.update({u'id': u'base', u'parent_ids': [], u'raw_config': {u'a': 2}})
+
+        assert_that(_result(self.collection.get_raw_config(u'device')), equal_to({u'a': 2}))
+        self.clock.advance(0)
+        assert_that(_result(self.collection.get_raw_config(u'device')), equal_to({u'a': 2}))
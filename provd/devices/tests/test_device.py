@@ -2,10 +2,24 @@
 # Copyright (C) 2010-2014 Avencall
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from hamcrest import assert_that, equal_to
+from hamcrest import assert_that, contains, empty, equal_to
 
+import os
+import shutil
+import tempfile
 import unittest
-from provd.devices.device import copy, needs_reconfiguration
+from twisted.internet.task import Clock
+from provd.devices.device import DeviceCollection, copy, needs_reconfiguration
+from provd.persist.id import numeric_id_generator
+from provd.persist.journal_backend import JournalSimpleBackend
+from provd.persist.json_backend import new_json_collection
+from provd.persist.util import new_backend_based_collection
+
+
+def _result(deferred):
+    results = []
+    deferred.addCallback(results.append)
+    return results[0]
 
 
 class TestDevice(unittest.TestCase):
@@ -41,3 +55,102 @@ class TestDevice(unittest.TestCase):
         new_device = {u'id': u'1', u'foo': u'b'}
 
         self.assertFalse(needs_reconfiguration(old_device, new_device))
+
+
+class TestDeviceCollectionLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = DeviceCollection(new_json_collection(self.directory, numeric_id_generator()))
+        self._insert({u'id': u'a', u'mac': u'00:11:22:33:44:55', u'ip': u'10.0.0.1'})
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def _insert(self, device):
+        device[u'tenant_uuid'] = u'tenant'
+        return _result(self.collection.insert(device))
+
+    def _lookup_ids(self, key, value):
+        devices = _result(self.collection.lookup(key, value))
+        return [device[u'id'] for device in devices]
+
+    def test_lookup(self):
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:55'), contains(u'a'))
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:66'), empty())
+        assert_that(self.collection.lookup_hit_ratio(), equal_to(0.5))
+
+    def test_lookup_multiple_devices(self):
+        self._insert({u'id': u'b', u'ip': u'10.0.0.1'})
+
+        assert_that(self._lookup_ids(u'ip', u'10.0.0.1'), contains(u'a', u'b'))
+
+    def test_lookup_after_update(self):
+        device = _result(self.collection.retrieve(u'a'))
+        device[u'ip'] = u'10.0.0.2'
+        del device[u'mac']
+        _result(self.collection.update(device))
+
+        assert_that(self._lookup_ids(u'ip', u'10.0.0.1'), empty())
+        assert_that(self._lookup_ids(u'ip', u'10.0.0.2'), contains(u'a'))
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:55'), empty())
+
+    def test_lookup_after_delete(self):
+        _result(self.collection.delete(u'a'))
+
+        assert_that(self._lookup_ids(u'ip', u'10.0.0.1'), empty())
+
+    def test_lookup_existing_devices(self):
+        collection = DeviceCollection(new_json_collection(self.directory, numeric_id_generator()))
+
+        devices = _result(collection.lookup(u'ip', u'10.0.0.1'))
+
+        assert_that([device[u'id'] for device in devices], contains(u'a'))
+
+    def test_lookup_invalid_key(self):
+        failures = []
+        self.collection.lookup(u'vendor', u'foo').addErrback(failures.append)
+
+        assert_that(len(failures), equal_to(1))
+
+
+class TestDeviceCollectionLookupJournal(unittest.TestCase):
+    # the journal backend persists the modifications in the next reactor
+    # iteration, which is never run here
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        backend = JournalSimpleBackend(os.path.join(self.directory, 'devices.journal'),
+                                       clock=Clock())
+        self.collection = DeviceCollection(new_backend_based_collection(backend,
+                                                                        numeric_id_generator()))
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def _lookup_ids(self, key, value):
+        devices = _result(self.collection.lookup(key, value))
+        return [device[u'id'] for device in devices]
+
+    def test_lookup_before_persisted(self):
+        self.collection.insert({u'mac': u'00:11:22:33:44:55', u'tenant_uuid': u'tenant'})
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:55'), contains(u'0'))
+
+        self.collection.update({u'id': u'0', u'mac': u'00:11:22:33:44:66',
+                                u'tenant_uuid': u'tenant'})
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:55'), empty())
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:66'), contains(u'0'))
+
+        self.collection.delete(u'0')
+        assert_that(self._lookup_ids(u'mac', u'00:11:22:33:44:66'), empty())
+
+    def test_rejected_update(self):
+        failures = []
+
+        self.collection.update({u'id': u'1', u'mac': u'00:11:22:33:44:55',
+                                u'tenant_uuid': u'tenant'}).addErrback(failures.append)
+
+        assert_that(len(failures), equal_to(1))
+        assert_that(self.collection._lookup_values, equal_to({}))
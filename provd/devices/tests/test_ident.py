@@ -2,11 +2,13 @@
 # Copyright (C) 2010-2016 Avencall
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from hamcrest import assert_that, equal_to, has_entry
-from mock import Mock, patch
+from hamcrest import assert_that, contains, equal_to, has_entries, has_entry
+from mock import Mock, call, patch
 from provd.devices import ident
 from provd.devices.ident import LastSeenUpdater, VotingUpdater, _RequestHelper,\
-    RemoveOutdatedIpDeviceUpdater, AddDeviceRetriever
+    RemoveOutdatedIpDeviceUpdater, AddDeviceRetriever, KnownDeviceInfoExtractor,\
+    AllPluginsDeviceInfoExtractor, _PrefixTrie, RequestProcessingService
+from provd.metrics import RequestStats, STAGE_EXTRACT, STAGE_RETRIEVE, STAGE_UPDATE
 from twisted.internet import defer
 from twisted.trial import unittest
 
@@ -35,6 +37,135 @@ class TestAddDeviceRetriever(unittest.TestCase):
         assert_that(device, equal_to(expected_device))
 
 
+class TestKnownDeviceInfoExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Mock()
+        self.app.nat = 0
+        self.plugin = Mock()
+        self.app.pg_mgr = {u'foo': self.plugin}
+        self.fallback_extractor = Mock()
+        self.fallback_extractor.extract.return_value = defer.succeed({u'vendor': u'fallback'})
+        self.request = Mock()
+        self.request.getClientIP.return_value = '10.0.0.1'
+        self.extractor = KnownDeviceInfoExtractor(self.app, self.fallback_extractor)
+
+    def _set_plugin_dev_info(self, dev_info):
+        self.plugin.http_dev_info_extractor.extract.return_value = defer.succeed(dev_info)
+
+    @defer.inlineCallbacks
+    def test_extract_known_device(self):
+        self.app.dev_lookup.return_value = defer.succeed([{u'id': u'a', u'plugin': u'foo', u'vendor': u'Foo'}])
+        self._set_plugin_dev_info({u'vendor': u'Foo', u'model': u'Bar'})
+
+        dev_info = yield self.extractor.extract(self.request, 'http')
+
+        assert_that(dev_info, equal_to({u'vendor': u'Foo', u'model': u'Bar'}))
+        self.app.dev_lookup.assert_called_once_with(u'ip', u'10.0.0.1')
+        self.assertFalse(self.fallback_extractor.extract.called)
+
+    @defer.inlineCallbacks
+    def test_extract_unknown_device(self):
+        self.app.dev_lookup.return_value = defer.succeed([])
+
+        dev_info = yield self.extractor.extract(self.request, 'http')
+
+        assert_that(dev_info, equal_to({u'vendor': u'fallback'}))
+
+    @defer.inlineCallbacks
+    def test_extract_mismatch(self):
+        self.app.dev_lookup.return_value = defer.succeed([{u'id': u'a', u'plugin': u'foo', u'vendor': u'Foo'}])
+        self._set_plugin_dev_info({u'vendor': u'Other'})
+
+        dev_info = yield self.extractor.extract(self.request, 'http')
+
+        assert_that(dev_info, equal_to({u'vendor': u'fallback'}))
+
+    @defer.inlineCallbacks
+    def test_extract_nat(self):
+        self.app.nat = 1
+
+        dev_info = yield self.extractor.extract(self.request, 'http')
+
+        assert_that(dev_info, equal_to({u'vendor': u'fallback'}))
+        self.assertFalse(self.app.dev_lookup.called)
+
+
+class TestPrefixTrie(unittest.TestCase):
+
+    def test_find(self):
+        trie = _PrefixTrie()
+        trie.add('', 0)
+        trie.add('ab', 1)
+        trie.add('abc', 2)
+        trie.add('b', 3)
+
+        assert_that(trie.find('abcd'), equal_to([0, 1, 2]))
+        assert_that(trie.find('a'), equal_to([0]))
+        assert_that(trie.find('bc'), equal_to([0, 3]))
+
+
+class _Extractor(object):
+
+    def __init__(self, dev_info, filename_prefixes=None, user_agent_prefixes=None):
+        if filename_prefixes is not None:
+            self.filename_prefixes = filename_prefixes
+        if user_agent_prefixes is not None:
+            self.user_agent_prefixes = user_agent_prefixes
+        self._dev_info = dev_info
+        self.nb_calls = 0
+
+    def extract(self, request, request_type):
+        self.nb_calls += 1
+        return defer.succeed(self._dev_info)
+
+
+class _Plugin(object):
+
+    tftp_dev_info_extractor = None
+    dhcp_dev_info_extractor = None
+
+    def __init__(self, http_dev_info_extractor):
+        self.http_dev_info_extractor = http_dev_info_extractor
+
+
+class TestAllPluginsDeviceInfoExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.filename_xtor = _Extractor({u'vendor': u'Foo'}, filename_prefixes=['foo'])
+        self.ua_xtor = _Extractor({u'vendor': u'Bar'}, user_agent_prefixes=['Bar/'])
+        self.other_xtor = _Extractor({u'model': u'Baz'})
+        self.pg_mgr = Mock()
+        self.pg_mgr.itervalues.return_value = [
+            _Plugin(self.filename_xtor), _Plugin(self.ua_xtor), _Plugin(self.other_xtor),
+        ]
+        self.extractor = AllPluginsDeviceInfoExtractor(self._xtor_factory, self.pg_mgr)
+        self.request = Mock()
+        self.request.path = '/foo123.cfg'
+
+    def _xtor_factory(self, xtors):
+        return ident.CollaboratingDeviceInfoExtractor(LastSeenUpdater, xtors)
+
+    @defer.inlineCallbacks
+    def test_extract_filename_prefix(self):
+        self.request.getHeader.return_value = 'Other/1.0'
+
+        dev_info = yield self.extractor.extract(self.request, 'http')
+
+        assert_that(dev_info, equal_to({u'vendor': u'Foo', u'model': u'Baz'}))
+        assert_that(self.ua_xtor.nb_calls, equal_to(0))
+
+    @defer.inlineCallbacks
+    def test_extract_user_agent_prefix(self):
+        self.request.path = '/bar.cfg'
+        self.request.getHeader.return_value = 'Bar/1.0'
+
+        dev_info = yield self.extractor.extract(self.request, 'http')
+
+        assert_that(dev_info, equal_to({u'vendor': u'Bar', u'model': u'Baz'}))
+        assert_that(self.filename_xtor.nb_calls, equal_to(0))
+
+
 class TestLastSeenUpdater(unittest.TestCase):
 
     def setUp(self):
@@ -139,6 +270,81 @@ class TestRemoveOutdatedIpDeviceUpdater(unittest.TestCase):
         self.assertFalse(self.app.dev_find.called)
 
 
+class TestRequestProcessingService(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Mock()
+        self.device = {u'id': u'a', u'plugin': u'foo'}
+        self.dev_info_extractor = Mock()
+        self.dev_info_extractor.extract.return_value = defer.succeed({u'ip': u'10.0.0.1'})
+        self.dev_retriever = Mock()
+        self.dev_retriever.retrieve.return_value = defer.succeed(self.device)
+        self.dev_updater = Mock()
+        self.dev_updater.update.return_value = defer.succeed(None)
+        self.process_service = RequestProcessingService(self.app, self.dev_info_extractor,
+                                                        self.dev_retriever, self.dev_updater)
+
+    def _process(self):
+        results = []
+        d = self.process_service.process(Mock(), ident.REQUEST_TYPE_HTTP)
+        d.addBoth(results.append)
+        return results
+
+    def test_process_sync(self):
+        results = self._process()
+
+        assert_that(results, equal_to([(self.device, u'foo')]))
+
+    def test_process_async(self):
+        d = defer.Deferred()
+        self.dev_retriever.retrieve.return_value = d
+
+        results = self._process()
+        assert_that(results, equal_to([]))
+        d.callback(None)
+
+        assert_that(results, equal_to([(None, None)]))
+        self.assertFalse(self.dev_updater.update.called)
+
+    def test_process_error(self):
+        self.dev_updater.update.return_value = defer.fail(Exception('error'))
+
+        results = self._process()
+
+        assert_that(results[0].check(Exception))
+
+    def test_process_sync_error(self):
+        self.dev_retriever.retrieve.side_effect = Exception('error')
+
+        results = self._process()
+
+        assert_that(results[0].check(Exception))
+
+    def test_process_trace(self):
+        trace = Mock()
+
+        self.process_service.process(Mock(), ident.REQUEST_TYPE_HTTP, trace)
+
+        assert_that(trace.mark.call_args_list, equal_to([
+            call(STAGE_EXTRACT), call(STAGE_RETRIEVE), call(STAGE_UPDATE),
+        ]))
+        assert_that(trace.plugin_id, equal_to(u'foo'))
+        self.assertFalse(trace.finish.called)
+
+    def test_process_request_stats(self):
+        request_stats = RequestStats()
+        process_service = RequestProcessingService(self.app, self.dev_info_extractor,
+                                                   self.dev_retriever, self.dev_updater,
+                                                   request_stats=request_stats)
+
+        process_service.process(Mock(), ident.REQUEST_TYPE_DHCP)
+
+        assert_that(request_stats.as_list(), contains(has_entries({
+            u'request_type': ident.REQUEST_TYPE_DHCP,
+            u'plugin': u'foo',
+        })))
+
+
 class TestRequestHelper(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from hamcrest import assert_that, contains, equal_to, has_entries, same_instance
+from mock import Mock
+
+from ..pgasso import (
+    AssociationScoreCache,
+    COMPLETE_SUPPORT,
+    PluginAssociatorDeviceUpdater,
+    ReverseAlphabeticConflictSolver,
+    UNKNOWN_SUPPORT,
+    get_association_score_cache,
+)
+
+
+class TestPluginAssociatorDeviceUpdater(unittest.TestCase):
+
+    def setUp(self):
+        self.foo_associator = Mock()
+        self.foo_associator.associate.return_value = COMPLETE_SUPPORT
+        self.bar_associator = Mock()
+        self.bar_associator.associate.return_value = UNKNOWN_SUPPORT
+        self.pg_mgr = Mock()
+        self.pg_mgr.iteritems.return_value = [
+            (u'foo', Mock(pg_associator=self.foo_associator)),
+            (u'bar', Mock(pg_associator=self.bar_associator)),
+        ]
+        self.cache = AssociationScoreCache(self.pg_mgr)
+        self.updater = PluginAssociatorDeviceUpdater(self.pg_mgr, ReverseAlphabeticConflictSolver(),
+                                                     self.cache)
+        self.dev_info = {u'vendor': u'Foo', u'model': u'F1', u'version': u'1.0'}
+
+    def _update(self, dev_info):
+        device = {}
+        self.updater.update(device, dev_info, None, 'http')
+        return device
+
+    def test_update_uses_cached_scores(self):
+        device1 = self._update(self.dev_info)
+        device2 = self._update(dict(self.dev_info, ip=u'10.0.0.1'))
+
+        assert_that(device1, equal_to({u'plugin': u'foo'}))
+        assert_that(device2, equal_to({u'plugin': u'foo'}))
+        assert_that(self.foo_associator.associate.call_count, equal_to(1))
+        assert_that(self.cache.hits, equal_to(1))
+
+    def test_default_cache_is_shared(self):
+        updater = PluginAssociatorDeviceUpdater(self.pg_mgr, ReverseAlphabeticConflictSolver())
+        cache = get_association_score_cache(self.pg_mgr)
+
+        updater.update({}, self.dev_info, None, 'http')
+
+        assert_that(cache.misses, equal_to(1))
+        assert_that(get_association_score_cache(self.pg_mgr), same_instance(cache))
+
+    def test_update_different_model(self):
+        self._update(self.dev_info)
+        self._update(dict(self.dev_info, model=u'F2'))
+
+        assert_that(self.foo_associator.associate.call_count, equal_to(2))
+
+    def test_plugin_load_clears_cache(self):
+        self._update(self.dev_info)
+        observer = self.pg_mgr.attach.call_args[0][0]
+        observer.pg_load(u'baz')
+        self._update(self.dev_info)
+
+        assert_that(self.foo_associator.associate.call_count, equal_to(2))
+
+    def test_errors_are_not_cached(self):
+        self.bar_associator.associate.side_effect = Exception()
+
+        self._update(self.dev_info)
+        self._update(self.dev_info)
+
+        assert_that(self.foo_associator.associate.call_count, equal_to(2))
+
+    def test_associations(self):
+        self._update(self.dev_info)
+
+        assert_that(self.cache.associations(), contains(has_entries({
+            u'vendor': u'Foo',
+            u'model': u'F1',
+            u'version': u'1.0',
+            u'scores': {u'foo': COMPLETE_SUPPORT, u'bar': UNKNOWN_SUPPORT},
+            u'best_plugins': [u'foo'],
+        })))
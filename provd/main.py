@@ -9,18 +9,23 @@ import provd.localization
 import provd.synchronize
 from provd import security
 from provd.app import ProvisioningApplication
+from provd.devices.coalescer import DeviceUpdateCoalescer
+from provd.metrics import RequestStats
 from provd.devices.config import ConfigCollection
 from provd.devices.device import DeviceCollection
 from provd.devices import ident
 from provd.devices import pgasso
 from provd.rest.server import auth
+from provd.servers.tftp.blockcache import block_cache
+from provd.servers.tftp.engine import new_transfer_engine
 from provd.servers.tftp.proto import TFTPProtocol
 from provd.servers.http_site import Site, AuthResource
 from provd.persist.json_backend import JsonDatabaseFactory
+from provd.persist.journal_backend import JournalDatabaseFactory
 from provd.rest.server.server import new_authenticated_server_resource
 from twisted.application.service import IServiceMaker, Service, MultiService
 from twisted.application import internet
-from twisted.internet import ssl
+from twisted.internet import defer, ssl
 from twisted.web.resource import Resource as UnsecuredResource
 from twisted.plugin import IPlugin
 from twisted.python import log
@@ -46,6 +51,7 @@ class ProvisioningService(Service):
 
     _DB_FACTORIES = {
         'json': JsonDatabaseFactory(),
+        'journal': JournalDatabaseFactory(),
     }
 
     def __init__(self, config):
@@ -86,6 +92,9 @@ class ProvisioningService(Service):
                     dev_collection.ensure_index(u'mac')
                     dev_collection.ensure_index(u'ip')
                     dev_collection.ensure_index(u'sn')
+                    dev_collection.ensure_index(u'tenant_uuid')
+                    dev_collection.ensure_index(u'config')
+                    dev_collection.ensure_index(u'plugin')
                 except AttributeError as e:
                     logger.warning('This type of database doesn\'t seem to support index: %s', e)
             self.app = ProvisioningApplication(cfg_collection, dev_collection, self._config)
@@ -107,6 +116,8 @@ class ProvisioningService(Service):
 
 
 class ProcessService(Service):
+    # has a 'request_processing', a 'request_stats' and a
+    # 'dev_update_coalescer' attribute once started
     def __init__(self, prov_service, config):
         self._prov_service = prov_service
         self._config = config
@@ -141,8 +152,15 @@ class ProcessService(Service):
         dev_info_extractor = self._create_processor('info_extractor')
         dev_retriever = self._create_processor('retriever')
         dev_updater = self._create_processor('updater')
-        self.request_processing = ident.RequestProcessingService(self._prov_service.app, dev_info_extractor,
-                                                                 dev_retriever, dev_updater)
+        app = self._prov_service.app
+        self.dev_update_coalescer = DeviceUpdateCoalescer(app,
+                                                          self._config['general']['device_update_window'],
+                                                          self._config['general']['device_update_volatile_keys'])
+        self.request_stats = RequestStats()
+        self.request_processing = ident.RequestProcessingService(app, dev_info_extractor,
+                                                                 dev_retriever, dev_updater,
+                                                                 self.dev_update_coalescer,
+                                                                 self.request_stats)
         Service.startService(self)
 
 
@@ -155,7 +173,8 @@ class HTTPProcessService(Service):
     def startService(self):
         app = self._prov_service.app
         process_service = self._process_service.request_processing
-        http_process_service = ident.HTTPRequestProcessingService(process_service, app.pg_mgr)
+        http_process_service = ident.HTTPRequestProcessingService(process_service, app.pg_mgr,
+                                                                  self._process_service.request_stats)
         site = Site(http_process_service)
         port = self._config['general']['http_port']
         logger.info('Binding HTTP provisioning service to port %s', port)
@@ -173,7 +192,10 @@ class TFTPProcessService(Service):
         self._prov_service = prov_service
         self._process_service = process_service
         self._config = config
-        self._tftp_protocol = TFTPProtocol()
+        self._tftp_engine = new_transfer_engine(config['general']['tftp_engine'],
+                                                config['general']['tftp_engine_ports'])
+        self._tftp_protocol = TFTPProtocol(self._tftp_engine)
+        block_cache.set_max_size(config['general']['tftp_block_cache_size'])
 
     def privilegedStartService(self):
         port = self._config['general']['tftp_port']
@@ -185,13 +207,16 @@ class TFTPProcessService(Service):
     def startService(self):
         app = self._prov_service.app
         process_service = self._process_service.request_processing
-        tftp_process_service = ident.TFTPRequestProcessingService(process_service, app.pg_mgr)
+        tftp_process_service = ident.TFTPRequestProcessingService(process_service, app.pg_mgr,
+                                                                  self._process_service.request_stats)
         self._tftp_protocol.set_tftp_request_processing_service(tftp_process_service)
+        self._tftp_engine.start()
         Service.startService(self)
 
     def stopService(self):
         Service.stopService(self)
-        return self._udp_server.stopService()
+        return defer.DeferredList([defer.maybeDeferred(self._udp_server.stopService),
+                                   self._tftp_engine.stop()])
 
 
 class DHCPProcessService(Service):
@@ -206,8 +231,9 @@ class DHCPProcessService(Service):
 
 
 class RemoteConfigurationService(Service):
-    def __init__(self, prov_service, dhcp_process_service, config):
+    def __init__(self, prov_service, process_service, dhcp_process_service, config):
         self._prov_service = prov_service
+        self._process_service = process_service
         self._dhcp_process_service = dhcp_process_service
         self._config = config
         auth_client = auth.get_auth_client(**self._config['auth'])
@@ -217,7 +243,8 @@ class RemoteConfigurationService(Service):
         app = self._prov_service.app
         dhcp_request_processing_service = self._dhcp_process_service.dhcp_request_processing_service
         server_resource = new_authenticated_server_resource(
-            app, dhcp_request_processing_service
+            app, dhcp_request_processing_service, self._process_service.request_stats,
+            self._process_service.dev_update_coalescer
         )
         logger.info('Authentication is required for REST API')
         # /{version}
@@ -370,7 +397,8 @@ class ProvisioningServiceMaker(object):
         dhcp_process_service = DHCPProcessService(process_service)
         dhcp_process_service.setServiceParent(top_service)
 
-        remote_config_service = RemoteConfigurationService(prov_service, dhcp_process_service, config)
+        remote_config_service = RemoteConfigurationService(prov_service, process_service,
+                                                           dhcp_process_service, config)
         remote_config_service.setServiceParent(top_service)
 
         return top_service
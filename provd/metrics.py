@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Timing of the request processing and metrics exposition.
+
+The processing of a request from a device is split into stages: the
+extraction of the device info, the retrieval of the device, the update of
+the device, the routing of the request to a plugin service and the serving
+of the request by the service. The duration of each stage is aggregated into
+histograms per request type and plugin.
+
+Metrics are exposed in the Prometheus text exposition format.
+
+"""
+
+import bisect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGE_EXTRACT = u'extract'
+STAGE_RETRIEVE = u'retrieve'
+STAGE_UPDATE = u'update'
+STAGE_ROUTE = u'route'
+STAGE_SERVE = u'serve'
+STAGE_TOTAL = u'total'
+
+
+def format_upper_bound(upper_bound):
+    if upper_bound == float('inf'):
+        return u'+Inf'
+    return u'%g' % upper_bound
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is the one of the implicit +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Return a list of (upper bound, count) tuples, where count is the
+        number of observed values less than or equal to the upper bound.
+
+        The upper bound of the last tuple is float('inf').
+        """
+        result = []
+        count = 0
+        for upper_bound, bucket_count in zip(self.buckets + (float('inf'),), self.counts):
+            count += bucket_count
+            result.append((upper_bound, count))
+        return result
+
+    def as_dict(self):
+        buckets = []
+        for upper_bound, count in self.cumulative_counts():
+            buckets.append({u'le': format_upper_bound(upper_bound), u'count': count})
+        return {
+            u'count': self.count,
+            u'sum': self.sum,
+            u'buckets': buckets,
+        }
+
+
+class RequestStats(object):
+    """Histograms of the duration of the request processing stages, per
+    request type and plugin.
+
+    """
+
+    def __init__(self, timer=time.time, buckets=DEFAULT_BUCKETS):
+        self._timer = timer
+        self._buckets = buckets
+        # (request_type, plugin_id) -> {stage: histogram}
+        self._histograms = {}
+        # (request_type, plugin_id, status) -> number of responses
+        self._responses = {}
+
+    def new_trace(self, request_type):
+        return RequestTrace(self, request_type, self._timer)
+
+    def observe(self, request_type, plugin_id, stage, duration):
+        histograms = self._histograms.get((request_type, plugin_id))
+        if histograms is None:
+            histograms = self._histograms[(request_type, plugin_id)] = {}
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram(self._buckets)
+        histogram.observe(duration)
+
+    def count_response(self, request_type, plugin_id, status):
+        key = (request_type, plugin_id, status)
+        self._responses[key] = self._responses.get(key, 0) + 1
+
+    def responses(self):
+        """Return a list of (request_type, plugin_id, status, count) tuples,
+        sorted by request type, plugin ID and status.
+
+        """
+        result = [key + (count,) for key, count in self._responses.iteritems()]
+        result.sort(key=lambda t: (t[0], t[1] or u'', t[2]))
+        return result
+
+    def histograms(self):
+        """Return a list of (request_type, plugin_id, stage, histogram)
+        tuples, sorted by request type, plugin ID and stage.
+
+        """
+        result = []
+        for (request_type, plugin_id), histograms in self._histograms.iteritems():
+            for stage, histogram in histograms.iteritems():
+                result.append((request_type, plugin_id, stage, histogram))
+        result.sort(key=lambda t: (t[0], t[1] or u'', t[2]))
+        return result
+
+    def as_list(self):
+        result = []
+        for request_type, plugin_id, stage, histogram in self.histograms():
+            if not result or result[-1][u'request_type'] != request_type or result[-1][u'plugin'] != plugin_id:
+                result.append({u'request_type': request_type,
+                               u'plugin': plugin_id,
+                               u'stages': {}})
+            result[-1][u'stages'][stage] = histogram.as_dict()
+        return result
+
+
+class RequestTrace(object):
+    """The duration of the stages of the processing of a single request.
+
+    The durations are added to the request stats once the trace is finished,
+    so that they are aggregated under the plugin the request has been routed
+    to.
+
+    """
+
+    def __init__(self, request_stats, request_type, timer=time.time):
+        self.request_id = None
+        self.plugin_id = None
+        # the status of the response, if any, e.g. the HTTP status code
+        self.status = None
+        self._request_stats = request_stats
+        self._request_type = request_type
+        self._timer = timer
+        self._stages = []
+        self._start_time = self._last_time = timer()
+        self._finished = False
+
+    def mark(self, stage):
+        """Mark the end of a stage, which started at the end of the previous
+        one.
+
+        """
+        now = self._timer()
+        self._stages.append((stage, now - self._last_time))
+        self._last_time = now
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        total = self._timer() - self._start_time
+        request_stats = self._request_stats
+        for stage, duration in self._stages:
+            request_stats.observe(self._request_type, self.plugin_id, stage, duration)
+        request_stats.observe(self._request_type, self.plugin_id, STAGE_TOTAL, total)
+        if self.status is not None:
+            request_stats.count_response(self._request_type, self.plugin_id, self.status)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('<%s> Request processed in %.1f ms (%s)', self.request_id, total * 1000,
+                         ', '.join('%s: %.1f ms' % (stage, duration * 1000)
+                                   for stage, duration in self._stages))
+
+
+class _NullRequestTrace(object):
+
+    request_id = None
+    plugin_id = None
+    status = None
+
+    def mark(self, stage):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_REQUEST_TRACE = _NullRequestTrace()
+
+
+def _format_label_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _format_label_value(value))
+                             for name, value in sorted(labels.iteritems()))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class MetricsWriter(object):
+    """Write metrics in the Prometheus text exposition format.
+
+    Samples are lists of (labels, value) tuples, where labels is a
+    dictionary mapping label names to label values.
+
+    """
+
+    def __init__(self, prefix='provd_'):
+        self._prefix = prefix
+        self._lines = []
+
+    def _write_header(self, name, type, help):
+        self._lines.append('# HELP %s %s' % (name, help))
+        self._lines.append('# TYPE %s %s' % (name, type))
+
+    def _write_sample(self, name, labels, value):
+        self._lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+
+    def _write_samples(self, name, type, help, samples):
+        name = self._prefix + name
+        self._write_header(name, type, help)
+        for labels, value in samples:
+            self._write_sample(name, labels, value)
+
+    def counter(self, name, help, samples):
+        self._write_samples(name, 'counter', help, samples)
+
+    def gauge(self, name, help, samples):
+        self._write_samples(name, 'gauge', help, samples)
+
+    def histogram(self, name, help, samples):
+        """Write histograms, where the values of samples are Histogram
+        objects.
+
+        """
+        name = self._prefix + name
+        self._write_header(name, 'histogram', help)
+        for labels, histogram in samples:
+            for upper_bound, count in histogram.cumulative_counts():
+                bucket_labels = dict(labels)
+                bucket_labels['le'] = format_upper_bound(upper_bound)
+                self._write_sample(name + '_bucket', bucket_labels, count)
+            self._write_sample(name + '_sum', labels, histogram.sum)
+            self._write_sample(name + '_count', labels, histogram.count)
+
+    def getvalue(self):
+        return '\n'.join(self._lines) + '\n'
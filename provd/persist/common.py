@@ -86,6 +86,12 @@ class IDocumentCollection(Interface):
 
         """
 
+    def new_id():
+        """Return a new ID that is not used by any document of the
+        collection and that will not be generated again by the collection.
+
+        """
+
     def update(document):
         """Update the document with the current document and return a
         deferred that fire with None once the document has been successfully
@@ -113,7 +119,7 @@ class IDocumentCollection(Interface):
 
         """
 
-    def find(selector, fields, skip, limit, sort):
+    def find(selector, fields, skip, limit, sort, after):
         """Return a deferred that will fire with an iterator over documents
         that match the selector.
 
@@ -129,6 +135,11 @@ class IDocumentCollection(Interface):
           sort -- a tuple (key, direction), where key is the key to do the sort
             and direction is either 1 for ASC and -1 for DESC. If not specified,
             the matching documents are not sorted.
+          after -- a tuple (value, id), where value is the value of the sort
+            key and id the ID of the last document of the previous page. Only
+            the documents coming after this one in the sort order are
+            returned, documents with the same sort key value being sorted
+            by ID. If sort is not specified, documents are sorted by ID.
 
         All arguments are optional except for selector.
 
@@ -146,7 +157,10 @@ class IDocumentCollection(Interface):
         been created.
 
         complex_key has the same format as keys for selectors, i.e. it
-        can be of the form 'a.b' for example.
+        can be of the form 'a.b' for example. It can also be a tuple of
+        complex keys, in which case a compound index is created, i.e. an
+        index used for selectors with an equality or $in condition on
+        every one of these keys.
 
         This is an optional operation, and some implementation might not
         implement it, i.e. you should be ready to catch an AttributeError
@@ -154,6 +168,25 @@ class IDocumentCollection(Interface):
 
         """
 
+    def count(selector):
+        """Return a deferred that will fire with the number of documents
+        that match the selector.
+
+        This is an optional operation, like ensure_index.
+
+        """
+
+    def explain(selector, sort):
+        """Return a deferred that will fire with a dictionary describing how
+        the documents matching the selector would be found, i.e. which index,
+        if any, would be used.
+
+        Arguments have the same meaning as for the find method.
+
+        This is an optional operation, like ensure_index.
+
+        """
+
 
 class IDatabase(Interface):
     """A database is a group of zero or more document collections."""
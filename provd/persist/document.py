@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Frozen and copy-on-write documents.
+
+Backends store documents in their frozen form, i.e. built from FrozenDict
+and FrozenList objects, so that they can be shared without being copied.
+
+Documents returned by collections are CowDict objects, which are regular
+mutable dictionaries sharing their nested values with the stored frozen
+document. A nested dictionary or list is copied the first time it is
+accessed (i.e. with [], get, setdefault, pop, popitem, items, values or
+their iter variant), so that it can be freely modified.
+
+"""
+
+
+class FrozenDict(dict):
+    """Immutable dictionary."""
+
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s object does not support modification' % type(self).__name__)
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    def copy(self):
+        return thaw(self)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    """Immutable list."""
+
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s object does not support modification' % type(self).__name__)
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    __setslice__ = _immutable
+    __delslice__ = _immutable
+    __iadd__ = _immutable
+    __imul__ = _immutable
+    append = _immutable
+    extend = _immutable
+    insert = _immutable
+    pop = _immutable
+    remove = _immutable
+    reverse = _immutable
+    sort = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+def is_frozen(obj):
+    obj_type = type(obj)
+    return obj_type is FrozenDict or obj_type is FrozenList
+
+
+def freeze(obj):
+    """Return a frozen version of obj.
+
+    Frozen values found in obj are reused as is, which makes freezing a
+    CowDict cheap when few of its nested values have been accessed.
+
+    """
+    obj_type = type(obj)
+    if obj_type is FrozenDict or obj_type is FrozenList:
+        return obj
+    elif isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in dict.iteritems(obj))
+    elif isinstance(obj, list):
+        return FrozenList(freeze(v) for v in obj)
+    elif obj_type is tuple:
+        return tuple(freeze(v) for v in obj)
+    else:
+        return obj
+
+
+def thaw(obj):
+    """Return a mutable deep copy of obj, which can be frozen or not."""
+    if isinstance(obj, dict):
+        return dict((k, thaw(v)) for k, v in dict.iteritems(obj))
+    elif isinstance(obj, list):
+        return [thaw(v) for v in obj]
+    elif type(obj) is tuple:
+        return tuple(thaw(v) for v in obj)
+    else:
+        return obj
+
+
+class CowDict(dict):
+    """Mutable dictionary whose nested frozen values are copied on access."""
+
+    __slots__ = ()
+
+    def _thaw_value(self, key, value):
+        if is_frozen(value):
+            value = thaw(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        return self._thaw_value(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def pop(self, key, *args):
+        value = dict.pop(self, key, *args)
+        if is_frozen(value):
+            value = thaw(value)
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if is_frozen(value):
+            value = thaw(value)
+        return key, value
+
+    def iteritems(self):
+        # the keys are copied since thawed values are stored in the dict
+        for key in dict.keys(self):
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in dict.keys(self):
+            yield self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        return CowDict(self)
+
+    def __copy__(self):
+        return CowDict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return dict, (thaw(self),)
+
+
+def cow(document):
+    """Return a copy-on-write view of the given frozen document."""
+    return CowDict(document)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Append-only journal backend.
+
+Each collection is stored in a single journal file where every line is a
+JSON encoded record:
+
+    ["set", <id>, <document>]
+    ["del", <id>]
+
+Writes issued during the same reactor iteration are group-committed, i.e.
+written to the journal with a single write/flush. The deferreds returned
+by the collection fire once the records have been written. If they can't
+be written, the error is logged and the records are kept in memory and
+written again later: the modifications stay visible, so the deferreds
+still fire successfully. When the journal contains too many stale
+records, it is compacted by rewriting it as a snapshot of the live
+documents.
+
+"""
+
+import errno
+import json
+import logging
+import os
+from provd.persist.document import freeze
+from provd.persist.id import get_id_generator_factory
+from provd.persist.util import new_backend_based_collection
+from twisted.internet import defer
+
+logger = logging.getLogger(__name__)
+
+_SET = u'set'
+_DEL = u'del'
+
+
+def _encode_record(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+class JournalSimpleBackend(object):
+    # Backend storing documents in an append-only journal file.
+
+    compact_min_records = 1000
+    compact_ratio = 2.0
+    # delay, in seconds, before writing again the records that could not be
+    # written
+    retry_delay = 1.0
+
+    def __init__(self, filename, import_directory=None, fsync=False, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._filename = filename
+        self._fsync = fsync
+        self._clock = clock
+        self._dict = {}
+        self._nb_records = 0
+        self._pending = []
+        # deferreds firing once the pending records have been written
+        self._waiting = []
+        self._delayed_flush = None
+        if os.path.isfile(filename):
+            self._load()
+        elif import_directory is not None and os.path.isdir(import_directory):
+            self._import(import_directory)
+        self._open()
+        self.closed = False
+
+    def _open(self):
+        self._fobj = open(self._filename, 'ab')
+        # size of the journal once every written record is complete
+        self._size = os.fstat(self._fobj.fileno()).st_size
+
+    def _load(self):
+        nb_errors = 0
+        good_offset = 0
+        with open(self._filename, 'rb') as fobj:
+            for line in fobj:
+                if not line.endswith('\n'):
+                    # torn write at the end of the journal
+                    logger.warning('Discarding incomplete record at end of journal %s',
+                                   self._filename)
+                    break
+                try:
+                    record = json.loads(line)
+                    self._apply_record(record)
+                except (ValueError, IndexError, KeyError, TypeError) as e:
+                    nb_errors += 1
+                    logger.warning('Could not decode journal record in %s: %s', self._filename, e)
+                good_offset += len(line)
+        if good_offset != os.path.getsize(self._filename):
+            with open(self._filename, 'r+b') as fobj:
+                fobj.truncate(good_offset)
+        logger.info('Loaded %s documents (%s records, %s errors) from journal %s',
+                    len(self._dict), self._nb_records, nb_errors, self._filename)
+        if self._need_compaction():
+            self._compact()
+
+    def _apply_record(self, record):
+        op = record[0]
+        if op == _SET:
+            self._dict[record[1]] = freeze(record[2])
+        elif op == _DEL:
+            self._dict.pop(record[1], None)
+        else:
+            raise ValueError('unknown record operation %r' % op)
+        self._nb_records += 1
+
+    def _import(self, directory):
+        # import the documents of a JSON collection directory, i.e. from the
+        # "json" database type
+        logger.info('Importing JSON documents from %s into journal %s', directory, self._filename)
+        for rel_filename in os.listdir(directory):
+            abs_filename = os.path.join(directory, rel_filename)
+            try:
+                with open(abs_filename) as fobj:
+                    document = json.load(fobj)
+            except (EnvironmentError, ValueError) as e:
+                logger.warning('Could not import JSON document %s: %s', abs_filename, e)
+            else:
+                self._dict[rel_filename.decode('ascii')] = freeze(document)
+        self._compact()
+
+    def _need_compaction(self):
+        return (self._nb_records > self.compact_min_records and
+                self._nb_records > self.compact_ratio * len(self._dict))
+
+    def _compact(self):
+        # Rewrite the journal so that it only contains the live documents.
+        logger.info('Compacting journal %s (%s records, %s documents)',
+                    self._filename, self._nb_records, len(self._dict))
+        tmp_filename = self._filename + '.tmp'
+        with open(tmp_filename, 'wb') as fobj:
+            for id, document in self._dict.iteritems():
+                fobj.write(_encode_record([_SET, id, document]))
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.rename(tmp_filename, self._filename)
+        self._nb_records = len(self._dict)
+
+    def _append(self, record):
+        self._pending.append(_encode_record(record))
+        self._nb_records += 1
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._delayed_flush is None:
+            self._delayed_flush = self._clock.callLater(0, self._delayed_flush_cb)
+
+    def _delayed_flush_cb(self):
+        self._delayed_flush = None
+        try:
+            self.flush()
+        except EnvironmentError:
+            # already logged
+            if self._delayed_flush is not None:
+                self._delayed_flush.cancel()
+            self._delayed_flush = self._clock.callLater(self.retry_delay,
+                                                        self._delayed_flush_cb)
+
+    def commit(self):
+        """Return a deferred that will fire with None once the pending
+        records have been written to the journal, or once writing them has
+        failed, the records being then written again later.
+
+        """
+        if not self._pending:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._schedule_flush()
+        return d
+
+    def _write(self, data):
+        if self._fobj.closed:
+            size = self._size
+            self._open()
+            if self._size != size:
+                # the incomplete record of a failed write could not be
+                # discarded, so it's terminated to not corrupt the next one
+                data = '\n' + data
+        self._fobj.write(data)
+        self._fobj.flush()
+        if self._fsync:
+            os.fsync(self._fobj.fileno())
+        self._size += len(data)
+
+    def _discard_partial_write(self):
+        # Truncate the journal to its size before the failed write, so that
+        # an incomplete record is not followed by other records.
+        try:
+            self._fobj.close()
+        except EnvironmentError:
+            pass
+        try:
+            with open(self._filename, 'r+b') as fobj:
+                fobj.truncate(self._size)
+        except EnvironmentError as e:
+            logger.error('Could not truncate journal %s: %s', self._filename, e)
+
+    def flush(self):
+        """Write the pending records to the journal.
+
+        If the records can't be written, they are kept to be written with the
+        next flush, the waiting deferreds are fired anyway and an
+        EnvironmentError is raised.
+
+        """
+        if self._delayed_flush is not None:
+            self._delayed_flush.cancel()
+            self._delayed_flush = None
+        if not self._pending:
+            return
+        waiting = self._waiting
+        self._waiting = []
+        try:
+            self._write(''.join(self._pending))
+        except EnvironmentError as e:
+            logger.error('Could not write %s records to journal %s: %s',
+                         len(self._pending), self._filename, e)
+            self._discard_partial_write()
+            for d in waiting:
+                d.callback(None)
+            raise
+        self._pending = []
+        for d in waiting:
+            d.callback(None)
+        if self._need_compaction():
+            self._fobj.close()
+            try:
+                self._compact()
+            except EnvironmentError as e:
+                logger.error('Could not compact journal %s: %s', self._filename, e)
+            self._open()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._fobj.close()
+            self._dict = {}
+            self.closed = True
+
+    def __getitem__(self, id):
+        return self._dict[id]
+
+    def __setitem__(self, id, document):
+        document = freeze(document)
+        self._dict[id] = document
+        self._append([_SET, id, document])
+
+    def __delitem__(self, id):
+        del self._dict[id]
+        self._append([_DEL, id])
+
+    def __contains__(self, id):
+        return id in self._dict
+
+    def __len__(self):
+        return len(self._dict)
+
+    def itervalues(self):
+        return self._dict.itervalues()
+
+
+def new_journal_collection(filename, generator, import_directory=None, fsync=False):
+    return new_backend_based_collection(JournalSimpleBackend(filename, import_directory, fsync),
+                                        generator)
+
+
+class JournalDatabase(object):
+    def __init__(self, base_directory, generator_factory, import_base_directory=None,
+                 fsync=False):
+        self._base_directory = base_directory
+        self._generator_factory = generator_factory
+        self._import_base_directory = import_base_directory
+        self._fsync = fsync
+        self._collections = {}
+        self._create_base_directory()
+
+    def _create_base_directory(self):
+        try:
+            os.makedirs(self._base_directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def close(self):
+        for collection in self._collections.itervalues():
+            collection.close()
+        self._collections = {}
+
+    def _new_collection(self, id):
+        generator = self._generator_factory()
+        filename = os.path.join(self._base_directory, id + '.journal')
+        if self._import_base_directory is None:
+            import_directory = None
+        else:
+            import_directory = os.path.join(self._import_base_directory, id)
+        try:
+            return new_journal_collection(filename, generator, import_directory, self._fsync)
+        except Exception, e:
+            # could not create collection
+            raise ValueError(e)
+
+    def collection(self, id):
+        if id not in self._collections or self._collections[id].closed:
+            self._collections[id] = self._new_collection(id)
+        return self._collections[id]
+
+
+class JournalDatabaseFactory(object):
+    def new_database(self, type, generator, **kwargs):
+        if type != 'journal':
+            raise ValueError('unrecognised type "%s"' % type)
+        try:
+            base_directory = kwargs['journal_db_dir']
+        except KeyError:
+            raise ValueError('missing "journal_db_dir" arguments in "%s"' % kwargs)
+        else:
+            generator_factory = get_id_generator_factory(generator)
+            # documents of a previously used "json" database are imported
+            # the first time a collection is created
+            import_base_directory = kwargs.get('json_db_dir')
+            fsync = kwargs.get('journal_fsync', False)
+            return JournalDatabase(base_directory, generator_factory,
+                                   import_base_directory, fsync)
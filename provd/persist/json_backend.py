@@ -4,19 +4,80 @@
 
 import json
 import logging
+import multiprocessing
 import os
-from copy import deepcopy
+import time
+from itertools import islice
+from provd.persist.document import freeze
 from provd.persist.id import get_id_generator_factory
 from provd.persist.util import new_backend_based_collection
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from ujson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+_LOAD_CHUNK_SIZE = 500
+_LOAD_PROGRESS_INTERVAL = 5000
+
+
+def _iter_filenames(directory):
+    # Return an iterator over the name of the regular files in directory,
+    # without building the whole listing when possible.
+    if scandir is None:
+        for rel_filename in os.listdir(directory):
+            if os.path.isfile(os.path.join(directory, rel_filename)):
+                yield rel_filename
+    else:
+        for entry in scandir(directory):
+            if entry.is_file():
+                yield entry.name
+
+
+def _iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _decode_files(args):
+    # Return a list of (rel_filename, document, error) tuples. This is a
+    # module level function so that it can be used by a process pool.
+    directory, rel_filenames = args
+    results = []
+    for rel_filename in rel_filenames:
+        abs_filename = os.path.join(directory, rel_filename)
+        try:
+            with open(abs_filename) as fobj:
+                document = _json_loads(fobj.read())
+        except EnvironmentError as e:
+            results.append((rel_filename, None, 'Could not open file %s: %s' % (abs_filename, e)))
+        except ValueError as e:
+            results.append((rel_filename, None, 'Could not decode JSON document %s: %s' % (abs_filename, e)))
+        else:
+            results.append((rel_filename, document, None))
+    return results
+
 
 class JsonSimpleBackend(object):
     closed = False
 
-    def __init__(self, directory):
+    def __init__(self, directory, load_workers=0):
         self._directory = directory
+        self._load_workers = load_workers
         self._dict = {}
         self._load()
         self._closed = False
@@ -25,31 +86,43 @@ class JsonSimpleBackend(object):
         if not os.path.isdir(self._directory):
             os.mkdir(self._directory)
 
-        for rel_filename in os.listdir(self._directory):
-            abs_filename = os.path.join(self._directory, rel_filename)
+        start_time = time.time()
+        chunks = ((self._directory, chunk) for chunk in
+                  _iter_chunks(_iter_filenames(self._directory), _LOAD_CHUNK_SIZE))
+        if self._load_workers > 0:
+            pool = multiprocessing.Pool(self._load_workers)
             try:
-                fobj = open(abs_filename)
-            except EnvironmentError, e:
-                logger.warning('Could not open file %s: %s', abs_filename, e)
-            else:
-                try:
-                    document = json.load(fobj)
-                except ValueError as e:
-                    logger.warning('Could not decode JSON document %s: %s', abs_filename, e)
+                self._add_decoded_chunks(pool.imap_unordered(_decode_files, chunks))
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            self._add_decoded_chunks(_decode_files(chunk) for chunk in chunks)
+        logger.info('Loaded %s documents from %s in %.3f seconds',
+                    len(self._dict), self._directory, time.time() - start_time)
+
+    def _add_decoded_chunks(self, decoded_chunks):
+        next_progress = _LOAD_PROGRESS_INTERVAL
+        for decoded_chunk in decoded_chunks:
+            for rel_filename, document, error in decoded_chunk:
+                if error is None:
+                    self._dict[rel_filename.decode('ascii')] = freeze(document)
                 else:
-                    self._dict[rel_filename.decode('ascii')] = document
-                finally:
-                    fobj.close()
+                    logger.warning('%s', error)
+            if len(self._dict) >= next_progress:
+                logger.info('Loading %s: %s documents loaded', self._directory, len(self._dict))
+                next_progress += _LOAD_PROGRESS_INTERVAL
 
     def close(self):
         self._dict = {}
         self._closed = True
 
     def __getitem__(self, id):
-        return deepcopy(self._dict[id])
+        return self._dict[id]
 
     def __setitem__(self, id, document):
-        self._dict[id] = deepcopy(document)
+        document = freeze(document)
+        self._dict[id] = document
         abs_filename = os.path.join(self._directory, id.encode('ascii'))
         fobj = open(abs_filename, 'w')
         try:
@@ -68,20 +141,23 @@ class JsonSimpleBackend(object):
     def __contains__(self, id):
         return id in self._dict
 
+    def __len__(self):
+        return len(self._dict)
+
     def itervalues(self):
-        for document in self._dict.itervalues():
-            yield deepcopy(document)
+        return self._dict.itervalues()
 
 
-def new_json_collection(directory, generator):
-    return new_backend_based_collection(JsonSimpleBackend(directory),
+def new_json_collection(directory, generator, load_workers=0):
+    return new_backend_based_collection(JsonSimpleBackend(directory, load_workers),
                                         generator)
 
 
 class JsonDatabase(object):
-    def __init__(self, base_directory, generator_factory):
+    def __init__(self, base_directory, generator_factory, load_workers=0):
         self._base_directory = base_directory
         self._generator_factory = generator_factory
+        self._load_workers = load_workers
         self._collections = {}
         self._create_base_directory()
 
@@ -98,7 +174,7 @@ class JsonDatabase(object):
         generator = self._generator_factory()
         directory = os.path.join(self._base_directory, id)
         try:
-            return new_json_collection(directory, generator)
+            return new_json_collection(directory, generator, self._load_workers)
         except Exception, e:
             # could not create collection
             raise ValueError(e)
@@ -119,4 +195,5 @@ class JsonDatabaseFactory(object):
             raise ValueError('missing "json_db_dir" arguments in "%s"' % kwargs)
         else:
             generator_factory = get_id_generator_factory(generator)
-            return JsonDatabase(base_directory, generator_factory)
+            load_workers = kwargs.get('json_load_workers', 0)
+            return JsonDatabase(base_directory, generator_factory, load_workers)
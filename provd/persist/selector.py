@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Selector compiler.
+
+A selector is compiled into a predicate in two steps:
+
+1. the selector "shape", i.e. its keys and operators but not its values, is
+   turned into a plan, which is a list of (key path, condition factory)
+   tuples. Plans are cached by shape, since applications use a small number
+   of different selector shapes.
+2. the plan is bound to the selector values, giving a list of conditions
+   that are evaluated in order on each document.
+
+The semantic is the same as the one of provd.persist.util, i.e. lists are
+only traversed for the last component of a key.
+
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+_dict_get = dict.get
+
+_PLAN_CACHE_MAX_SIZE = 256
+_plan_cache = {}
+
+
+def _contains_operator(selector_value):
+    # Return true if the value associated with a key of a selector
+    # is an operator value, i.e. has an operator semantic.
+    if isinstance(selector_value, dict):
+        for k in selector_value.iterkeys():
+            if k.startswith(u'$'):
+                return True
+    return False
+
+
+def _new_values_getter(path):
+    # Return a function taking a document and returning the list of values
+    # in the document matching the given key path
+    last_index = len(path) - 1
+
+    def aux(index, current_doc, values):
+        key = path[index]
+        if index == last_index:
+            if isinstance(current_doc, dict):
+                value = _dict_get(current_doc, key, _MISSING)
+                if value is not _MISSING:
+                    values.append(value)
+            elif isinstance(current_doc, list):
+                for elem in current_doc:
+                    aux(index, elem, values)
+        elif isinstance(current_doc, dict):
+            value = _dict_get(current_doc, key, _MISSING)
+            if value is not _MISSING:
+                aux(index + 1, value, values)
+
+    def get_values(doc):
+        values = []
+        aux(0, doc, values)
+        return values
+    return get_values
+
+
+def _new_any_condition(path, pred):
+    # Return a condition that is true if there's a value in the document
+    # matching the key path for which pred(value) is true
+    if len(path) == 1:
+        key = path[0]
+        get_values = _new_values_getter(path)
+
+        def condition(doc):
+            if isinstance(doc, dict):
+                value = _dict_get(doc, key, _MISSING)
+                return value is not _MISSING and pred(value)
+            for value in get_values(doc):
+                if pred(value):
+                    return True
+            return False
+    else:
+        get_values = _new_values_getter(path)
+
+        def condition(doc):
+            for value in get_values(doc):
+                if pred(value):
+                    return True
+            return False
+    return condition
+
+
+def _new_none_condition(path, pred):
+    # Return a condition that is true if there's no value in the document
+    # matching the key path for which pred(value) is true
+    any_condition = _new_any_condition(path, pred)
+    return lambda doc: not any_condition(doc)
+
+
+def _new_membership_pred(s_value, operator):
+    if not isinstance(s_value, list):
+        raise ValueError('selector value for %s matcher must be a list: %s is not' %
+                         (operator, s_value))
+    try:
+        s_set = frozenset(s_value)
+    except TypeError:
+        # the list contains unhashable values
+        return lambda doc_value: doc_value in s_value
+
+    def pred(doc_value):
+        try:
+            return doc_value in s_set
+        except TypeError:
+            return doc_value in s_value
+    return pred
+
+
+def _new_eq_condition(path, s_value):
+    if len(path) == 1 and not isinstance(s_value, (dict, list)):
+        # scalar equality on a top level key: most common case
+        key = path[0]
+        any_condition = _new_any_condition(path, lambda doc_value: doc_value == s_value)
+
+        def condition(doc):
+            if isinstance(doc, dict):
+                return _dict_get(doc, key, _MISSING) == s_value
+            return any_condition(doc)
+        return condition
+    return _new_any_condition(path, lambda doc_value: doc_value == s_value)
+
+
+def _new_ne_condition(path, s_value):
+    return _new_none_condition(path, lambda doc_value: doc_value == s_value)
+
+
+def _new_in_condition(path, s_value):
+    return _new_any_condition(path, _new_membership_pred(s_value, u'in'))
+
+
+def _new_nin_condition(path, s_value):
+    return _new_none_condition(path, _new_membership_pred(s_value, u'nin'))
+
+
+def _new_contains_condition(path, s_value):
+    pred = lambda doc_value: hasattr(doc_value, '__contains__') and s_value in doc_value
+    return _new_any_condition(path, pred)
+
+
+def _new_gt_condition(path, s_value):
+    return _new_any_condition(path, lambda doc_value: doc_value > s_value)
+
+
+def _new_ge_condition(path, s_value):
+    return _new_any_condition(path, lambda doc_value: doc_value >= s_value)
+
+
+def _new_lt_condition(path, s_value):
+    return _new_any_condition(path, lambda doc_value: doc_value < s_value)
+
+
+def _new_le_condition(path, s_value):
+    return _new_any_condition(path, lambda doc_value: doc_value <= s_value)
+
+
+def _new_exists_condition(path, s_value):
+    s_value = bool(s_value)
+    if len(path) == 1:
+        key = path[0]
+        get_values = _new_values_getter(path)
+
+        def condition(doc):
+            if isinstance(doc, dict):
+                return (key in doc) is s_value
+            return bool(get_values(doc)) is s_value
+    else:
+        get_values = _new_values_getter(path)
+
+        def condition(doc):
+            return bool(get_values(doc)) is s_value
+    return condition
+
+
+_CONDITION_FACTORIES = {
+    u'$in': _new_in_condition,
+    u'$nin': _new_nin_condition,
+    u'$contains': _new_contains_condition,
+    u'$gt': _new_gt_condition,
+    u'$ge': _new_ge_condition,
+    u'$lt': _new_lt_condition,
+    u'$le': _new_le_condition,
+    u'$ne': _new_ne_condition,
+    u'$exists': _new_exists_condition,
+}
+
+# conditions that are cheap to evaluate are evaluated first
+_CONDITION_COSTS = {
+    u'$exists': 0,
+    None: 1,
+    u'$in': 2,
+}
+
+
+def _selector_shape(selector):
+    # Return an hashable object describing the keys and operators of the
+    # selector, but not its values
+    shape = []
+    for key, s_value in selector.iteritems():
+        if _contains_operator(s_value):
+            shape.append((key, tuple(sorted(s_value))))
+        else:
+            shape.append((key, None))
+    shape.sort()
+    return tuple(shape)
+
+
+def _new_plan(shape):
+    # Return a list of (key, operator, path, condition factory) tuples,
+    # where operator is None for equality
+    plan = []
+    for key, operators in shape:
+        path = tuple(key.split(u'.'))
+        if operators is None:
+            plan.append((key, None, path, _new_eq_condition))
+        else:
+            for operator in operators:
+                try:
+                    factory = _CONDITION_FACTORIES[operator]
+                except KeyError:
+                    raise ValueError('invalid operator: %s' % operator)
+                plan.append((key, operator, path, factory))
+    plan.sort(key=lambda step: _CONDITION_COSTS.get(step[1], 3))
+    return plan
+
+
+def _get_plan(shape):
+    try:
+        return _plan_cache[shape]
+    except KeyError:
+        plan = _new_plan(shape)
+        if len(_plan_cache) >= _PLAN_CACHE_MAX_SIZE:
+            _plan_cache.clear()
+        _plan_cache[shape] = plan
+        return plan
+
+
+def compile_selector(selector):
+    """Return a predicate taking a document as argument and returning true
+    if the selector matches it, else false.
+
+    Raise a ValueError if the selector is invalid.
+
+    """
+    plan = _get_plan(_selector_shape(selector))
+    conditions = []
+    for key, operator, path, factory in plan:
+        if operator is None:
+            s_value = selector[key]
+        else:
+            s_value = selector[key][operator]
+        conditions.append(factory(path, s_value))
+
+    if not conditions:
+        return lambda doc: True
+    elif len(conditions) == 1:
+        return conditions[0]
+    elif len(conditions) == 2:
+        first, second = conditions
+        return lambda doc: first(doc) and second(doc)
+    else:
+        def pred(doc):
+            for condition in conditions:
+                if not condition(doc):
+                    return False
+            return True
+        return pred
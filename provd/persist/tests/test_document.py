@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import copy
+import unittest
+from hamcrest import assert_that, equal_to, instance_of, same_instance
+from provd.persist.document import CowDict, FrozenDict, FrozenList, cow, freeze, thaw
+
+
+class TestFreeze(unittest.TestCase):
+
+    def test_freeze(self):
+        frozen = freeze({u'a': [1, {u'b': 2}]})
+
+        assert_that(frozen, instance_of(FrozenDict))
+        assert_that(frozen[u'a'], instance_of(FrozenList))
+        assert_that(frozen[u'a'][1], instance_of(FrozenDict))
+        assert_that(frozen, equal_to({u'a': [1, {u'b': 2}]}))
+
+    def test_frozen_is_immutable(self):
+        frozen = freeze({u'a': [1]})
+
+        self.assertRaises(TypeError, frozen.__setitem__, u'b', 2)
+        self.assertRaises(TypeError, frozen.pop, u'a')
+        self.assertRaises(TypeError, frozen[u'a'].append, 2)
+
+    def test_freeze_reuse_frozen_values(self):
+        frozen = freeze({u'a': {u'b': 1}})
+
+        refrozen = freeze(cow(frozen))
+
+        assert_that(refrozen[u'a'], same_instance(frozen[u'a']))
+
+    def test_thaw(self):
+        frozen = freeze({u'a': [1, {u'b': 2}]})
+
+        thawed = thaw(frozen)
+
+        assert_that(type(thawed), same_instance(dict))
+        assert_that(type(thawed[u'a']), same_instance(list))
+        assert_that(type(thawed[u'a'][1]), same_instance(dict))
+        assert_that(thawed, equal_to(frozen))
+
+
+class TestCowDict(unittest.TestCase):
+
+    def setUp(self):
+        self.frozen = freeze({u'a': 1, u'b': {u'c': [1, 2]}})
+        self.document = cow(self.frozen)
+
+    def test_modify_top_level(self):
+        self.document[u'a'] = 2
+        del self.document[u'b']
+
+        assert_that(self.document, equal_to({u'a': 2}))
+        assert_that(self.frozen, equal_to({u'a': 1, u'b': {u'c': [1, 2]}}))
+
+    def test_modify_nested_value(self):
+        self.document[u'b'][u'c'].append(3)
+        self.document.get(u'b')[u'd'] = 4
+
+        assert_that(self.document, equal_to({u'a': 1, u'b': {u'c': [1, 2, 3], u'd': 4}}))
+        assert_that(self.frozen, equal_to({u'a': 1, u'b': {u'c': [1, 2]}}))
+
+    def test_pop_nested_value(self):
+        value = self.document.pop(u'b')
+        value[u'd'] = 4
+
+        assert_that(self.frozen, equal_to({u'a': 1, u'b': {u'c': [1, 2]}}))
+
+    def test_modify_iterated_values(self):
+        for key, value in self.document.items():
+            if key == u'b':
+                value[u'c'].append(3)
+        for value in self.document.itervalues():
+            if isinstance(value, dict):
+                value[u'd'] = 4
+
+        assert_that(self.document, equal_to({u'a': 1, u'b': {u'c': [1, 2, 3], u'd': 4}}))
+        assert_that(self.frozen, equal_to({u'a': 1, u'b': {u'c': [1, 2]}}))
+
+    def test_copy_is_independent(self):
+        document_copy = self.document.copy()
+        document_copy[u'b'][u'd'] = 4
+
+        assert_that(document_copy, instance_of(CowDict))
+        assert_that(self.document, equal_to({u'a': 1, u'b': {u'c': [1, 2]}}))
+
+    def test_deepcopy(self):
+        document_copy = copy.deepcopy(self.document)
+
+        assert_that(type(document_copy), same_instance(dict))
+        assert_that(type(document_copy[u'b']), same_instance(dict))
+        assert_that(document_copy, equal_to(self.document))
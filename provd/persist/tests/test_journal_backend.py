@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import errno
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from hamcrest import assert_that, contains_inanyorder, equal_to, has_length
+from twisted.internet.task import Clock
+from provd.persist.id import numeric_id_generator
+from provd.persist.journal_backend import JournalSimpleBackend
+from provd.persist.util import new_backend_based_collection
+
+
+class _FullDiskFile(object):
+
+    closed = False
+
+    def write(self, data):
+        raise IOError(errno.ENOSPC, 'No space left on device')
+
+    def close(self):
+        self.closed = True
+
+
+class TestJournalSimpleBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'devices.journal')
+        self.clock = Clock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _new_backend(self, **kwargs):
+        return JournalSimpleBackend(self.filename, clock=self.clock, **kwargs)
+
+    def _read_records(self):
+        with open(self.filename) as fobj:
+            return [json.loads(line) for line in fobj]
+
+    def test_set_get(self):
+        backend = self._new_backend()
+
+        backend[u'1'] = {u'id': u'1', u'mac': u'00:11:22:33:44:55'}
+
+        assert_that(backend[u'1'], equal_to({u'id': u'1', u'mac': u'00:11:22:33:44:55'}))
+        assert_that(u'1' in backend)
+        backend.close()
+
+    def test_writes_are_group_committed(self):
+        backend = self._new_backend()
+
+        backend[u'1'] = {u'id': u'1'}
+        backend[u'2'] = {u'id': u'2'}
+
+        assert_that(self._read_records(), has_length(0))
+        self.clock.advance(0)
+        assert_that(self._read_records(), equal_to([
+            [u'set', u'1', {u'id': u'1'}],
+            [u'set', u'2', {u'id': u'2'}],
+        ]))
+        backend.close()
+
+    def test_collection_deferreds_fire_once_written(self):
+        collection = new_backend_based_collection(self._new_backend(), numeric_id_generator())
+        results = []
+
+        collection.insert({u'id': u'1'}).addCallback(results.append)
+
+        assert_that(results, equal_to([]))
+        self.clock.advance(0)
+        assert_that(results, equal_to([u'1']))
+        assert_that(self._read_records(), has_length(1))
+        collection.close()
+
+    def test_write_error(self):
+        backend = self._new_backend()
+        collection = new_backend_based_collection(backend, numeric_id_generator())
+        collection.insert({u'id': u'1', u'n': 1})
+        self.clock.advance(0)
+        backend._fobj.close()
+        backend._fobj = _FullDiskFile()
+        results = []
+
+        collection.update({u'id': u'1', u'n': 2}).addBoth(results.append)
+        self.clock.advance(0)
+
+        assert_that(results, equal_to([None]))
+        assert_that(collection.retrieve(u'1').result, equal_to({u'id': u'1', u'n': 2}))
+        assert_that(self._read_records(), has_length(1))
+
+        self.clock.advance(backend.retry_delay)
+
+        assert_that(self._read_records(), equal_to([
+            [u'set', u'1', {u'id': u'1', u'n': 1}],
+            [u'set', u'1', {u'id': u'1', u'n': 2}],
+        ]))
+        collection.close()
+
+    def test_reload(self):
+        backend = self._new_backend()
+        backend[u'1'] = {u'id': u'1'}
+        backend[u'2'] = {u'id': u'2'}
+        backend[u'1'] = {u'id': u'1', u'ip': u'10.0.0.1'}
+        del backend[u'2']
+        backend.close()
+
+        backend = self._new_backend()
+
+        assert_that(list(backend.itervalues()), equal_to([{u'id': u'1', u'ip': u'10.0.0.1'}]))
+        assert_that(u'2' not in backend)
+        backend.close()
+
+    def test_load_discards_incomplete_last_record(self):
+        with open(self.filename, 'w') as fobj:
+            fobj.write('["set","1",{"id":"1"}]\n["set","2",{"id"')
+
+        backend = self._new_backend()
+        backend[u'3'] = {u'id': u'3'}
+        backend.close()
+
+        assert_that(self._read_records(), equal_to([
+            [u'set', u'1', {u'id': u'1'}],
+            [u'set', u'3', {u'id': u'3'}],
+        ]))
+
+    def test_compaction(self):
+        backend = self._new_backend()
+        backend.compact_min_records = 4
+        for i in xrange(10):
+            backend[u'1'] = {u'id': u'1', u'n': i}
+        backend.close()
+
+        assert_that(self._read_records(), equal_to([[u'set', u'1', {u'id': u'1', u'n': 9}]]))
+
+    def test_import_json_directory(self):
+        json_directory = os.path.join(self.directory, 'devices')
+        os.mkdir(json_directory)
+        for id in ['a', 'b']:
+            with open(os.path.join(json_directory, id), 'w') as fobj:
+                json.dump({'id': id}, fobj)
+
+        backend = self._new_backend(import_directory=json_directory)
+
+        assert_that(list(backend.itervalues()), contains_inanyorder({u'id': u'a'}, {u'id': u'b'}))
+        assert_that(self._read_records(), has_length(2))
+        backend.close()
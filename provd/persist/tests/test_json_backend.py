@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from hamcrest import assert_that, contains_inanyorder
+from provd.persist.json_backend import JsonSimpleBackend
+
+
+class TestJsonSimpleBackendLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for id in ['a', 'b', 'c']:
+            with open(os.path.join(self.directory, id), 'w') as fobj:
+                json.dump({'id': id}, fobj)
+        with open(os.path.join(self.directory, 'invalid'), 'w') as fobj:
+            fobj.write('{')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load(self):
+        backend = JsonSimpleBackend(self.directory)
+
+        assert_that(list(backend.itervalues()),
+                    contains_inanyorder({u'id': u'a'}, {u'id': u'b'}, {u'id': u'c'}))
+
+    def test_load_with_workers(self):
+        backend = JsonSimpleBackend(self.directory, load_workers=2)
+
+        assert_that(list(backend.itervalues()),
+                    contains_inanyorder({u'id': u'a'}, {u'id': u'b'}, {u'id': u'c'}))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+from hamcrest import assert_that, equal_to
+from provd.persist.document import freeze
+from provd.persist.selector import compile_selector
+from provd.persist.util import _create_pred_from_selector
+
+DOCUMENTS = [
+    {},
+    {'k': 'v'},
+    {'k': 'v1', 'n': 1},
+    {'k': ['v', 'v2'], 'n': 2},
+    {'k': {'kk': 'v'}, 'n': 3.5},
+    {'k': [{'kk': 'v'}, {'kk': 'v1'}], 'n': None},
+    {'k': [[{'kk': 'v1'}]]},
+    {'k': {'kk': {'kkk': 'v'}}},
+    {'k': None},
+    {'k': []},
+]
+
+SELECTORS = [
+    {},
+    {'k': 'v'},
+    {'k': ['v', 'v2']},
+    {'k': {'kk': 'v'}},
+    {'k.kk': 'v'},
+    {'k.kk': 'v1'},
+    {'k.kk.kkk': 'v'},
+    {'k': 'v', 'n': 1},
+    {'k': {'$in': ['v', 'v1']}},
+    {'k': {'$in': [['v', 'v2'], 'v1']}},
+    {'k.kk': {'$in': ['v1']}},
+    {'k': {'$nin': ['v', 'v1']}},
+    {'k': {'$ne': 'v'}},
+    {'k': {'$contains': 'v'}},
+    {'k': {'$exists': True}},
+    {'k': {'$exists': False}},
+    {'k.kk': {'$exists': True}},
+    {'n': {'$gt': 1}},
+    {'n': {'$ge': 1, '$lt': 3}},
+    {'n': {'$le': 2}},
+    {'k': {'$exists': True}, 'n': {'$gt': 1}, 'k.kk': 'v'},
+]
+
+
+class TestCompileSelector(unittest.TestCase):
+
+    def test_same_result_as_reference_implementation(self):
+        for selector in SELECTORS:
+            reference_pred = _create_pred_from_selector(selector)
+            pred = compile_selector(selector)
+            for document in DOCUMENTS:
+                expected = reference_pred(document)
+                assert_that(pred(document), equal_to(expected), (selector, document))
+                assert_that(pred(freeze(document)), equal_to(expected), (selector, document))
+
+    def test_plan_reused_for_different_values(self):
+        pred1 = compile_selector({'k': {'$in': ['v']}})
+        pred2 = compile_selector({'k': {'$in': ['v1']}})
+
+        assert_that(pred1({'k': 'v'}), equal_to(True))
+        assert_that(pred2({'k': 'v'}), equal_to(False))
+
+    def test_invalid_operator(self):
+        self.assertRaises(ValueError, compile_selector, {'k': {'$foo': 1}})
+
+    def test_invalid_in_value(self):
+        self.assertRaises(ValueError, compile_selector, {'k': {'$in': 'v'}})
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+from mock import patch
+from hamcrest import assert_that, contains, contains_inanyorder, equal_to, has_entries
+from provd.persist.document import freeze
+from provd.persist.id import numeric_id_generator
+from provd.persist.util import SimpleBackendDocumentCollection
+
+
+class _DictBackend(dict):
+
+    def __setitem__(self, id, document):
+        dict.__setitem__(self, id, freeze(document))
+
+    def close(self):
+        pass
+
+
+def _result(deferred):
+    results = []
+    deferred.addCallback(results.append)
+    return results[0]
+
+
+class TestSimpleBackendDocumentCollection(unittest.TestCase):
+
+    def setUp(self):
+        # always use indexes for sorting, even for small collections
+        patcher = patch('provd.persist.util._INDEX_SORT_MIN_CANDIDATES', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection = SimpleBackendDocumentCollection(_DictBackend(), numeric_id_generator())
+        self.documents = [
+            {u'id': u'1', u'mac': u'00:00:00:00:00:01', u'tenant_uuid': u't1', u'n': 1},
+            {u'id': u'2', u'mac': u'00:00:00:00:00:02', u'tenant_uuid': u't1', u'n': 2},
+            {u'id': u'3', u'mac': u'00:00:00:00:00:03', u'tenant_uuid': u't2', u'n': 3},
+            {u'id': u'4', u'tenant_uuid': u't3', u'n': [4, 5]},
+        ]
+        for document in self.documents:
+            self.collection.insert(dict(document))
+
+    def test_new_id(self):
+        new_ids = [self.collection.new_id(), self.collection.new_id()]
+        document = {}
+        self.collection.insert(document)
+
+        assert_that(new_ids, equal_to([u'0', u'5']))
+        assert_that(document[u'id'], equal_to(u'6'))
+
+    def _find_ids(self, selector, **kwargs):
+        documents = _result(self.collection.find(selector, **kwargs))
+        return [document[u'id'] for document in documents]
+
+    def _check_same_results_with_indexes(self, selectors, sort=None):
+        expected = [(selector, self._find_ids(selector, sort=sort)) for selector in selectors]
+        for key in [u'mac', u'tenant_uuid', u'n']:
+            self.collection.ensure_index(key)
+        for selector, expected_ids in expected:
+            if sort:
+                assert_that(self._find_ids(selector, sort=sort), equal_to(expected_ids), selector)
+            else:
+                assert_that(self._find_ids(selector), contains_inanyorder(*expected_ids), selector)
+
+    def test_find_same_results_with_indexes(self):
+        self._check_same_results_with_indexes([
+            {},
+            {u'mac': u'00:00:00:00:00:01'},
+            {u'mac': u'00:00:00:00:00:01', u'tenant_uuid': u't2'},
+            {u'tenant_uuid': {u'$in': [u't1', u't3']}},
+            {u'tenant_uuid': {u'$nin': [u't1']}},
+            {u'n': {u'$gt': 1, u'$le': 3}},
+            {u'n': {u'$ge': 4}},
+            {u'n': 4},
+            {u'n': {u'$in': [4]}},
+            {u'n': {u'$nin': [5]}},
+            {u'n': {u'$ne': 3}},
+            {u'id': {u'$in': [u'1', u'3', u'5']}},
+        ])
+
+    def test_find_sorted_same_results_with_indexes(self):
+        self._check_same_results_with_indexes([{}, {u'tenant_uuid': u't1'}], sort=(u'mac', 1))
+        self._check_same_results_with_indexes([{}, {u'n': {u'$gt': 1}}], sort=(u'mac', -1))
+
+    def test_index_sorted_after_updates(self):
+        self.collection.ensure_index(u'mac')
+        _result(self.collection.explain({}, sort=(u'mac', 1)))
+        document = _result(self.collection.retrieve(u'1'))
+        document[u'mac'] = u'00:00:00:00:00:04'
+        self.collection.update(document)
+        self.collection.insert({u'id': u'5', u'mac': u'00:00:00:00:00:00', u'tenant_uuid': u't1'})
+
+        with_index = self._find_ids({}, sort=(u'mac', 1))
+
+        assert_that(with_index, contains(u'4', u'5', u'2', u'3', u'1'))
+
+    def test_explain(self):
+        self.collection.ensure_index(u'mac')
+        self.collection.ensure_index(u'tenant_uuid')
+
+        explanation = _result(self.collection.explain({u'mac': u'00:00:00:00:00:01',
+                                                       u'tenant_uuid': {u'$in': [u't1']}}))
+
+        assert_that(explanation, has_entries({u'plan': u'index', u'index': u'mac',
+                                              u'operator': u'$eq', u'candidates': 1}))
+
+    def test_explain_scan(self):
+        explanation = _result(self.collection.explain({u'mac': u'00:00:00:00:00:01'}))
+
+        assert_that(explanation, has_entries({u'plan': u'scan', u'candidates': 4}))
+
+    def test_find_same_results_with_compound_index(self):
+        selectors = [
+            {u'tenant_uuid': u't1', u'mac': u'00:00:00:00:00:02'},
+            {u'tenant_uuid': {u'$in': [u't1', u't2']}, u'mac': {u'$in': [u'00:00:00:00:00:01',
+                                                                        u'00:00:00:00:00:03']}},
+            {u'tenant_uuid': u't3', u'n': 5},
+        ]
+        expected = [(selector, self._find_ids(selector)) for selector in selectors]
+        self.collection.ensure_index((u'tenant_uuid', u'mac'))
+        self.collection.ensure_index((u'tenant_uuid', u'n'))
+
+        for selector, expected_ids in expected:
+            assert_that(self._find_ids(selector), contains_inanyorder(*expected_ids), selector)
+
+    def test_compound_index_after_update(self):
+        self.collection.ensure_index((u'tenant_uuid', u'mac'))
+        document = _result(self.collection.retrieve(u'1'))
+        document[u'tenant_uuid'] = u't2'
+        self.collection.update(document)
+
+        assert_that(self._find_ids({u'tenant_uuid': u't1', u'mac': u'00:00:00:00:00:01'}),
+                    equal_to([]))
+        assert_that(self._find_ids({u'tenant_uuid': u't2', u'mac': u'00:00:00:00:00:01'}),
+                    equal_to([u'1']))
+
+    def test_explain_compound_index(self):
+        self.collection.ensure_index((u'tenant_uuid', u'mac'))
+
+        explanation = _result(self.collection.explain({u'tenant_uuid': u't1',
+                                                       u'mac': u'00:00:00:00:00:01'}))
+
+        assert_that(explanation, has_entries({u'plan': u'index', u'candidates': 1,
+                                              u'index': (u'tenant_uuid', u'mac')}))
+
+    def _check_pagination(self, sort):
+        expected = self._find_ids({}, sort=sort)
+        after = None
+        ids = []
+        while True:
+            documents = list(_result(self.collection.find({}, sort=sort, limit=2, after=after)))
+            if not documents:
+                break
+            ids.extend(document[u'id'] for document in documents)
+            last = documents[-1]
+            after = (last.get(sort[0]), last[u'id'])
+        assert_that(ids, equal_to(expected))
+
+    def test_find_after(self):
+        self.collection.insert({u'id': u'0', u'tenant_uuid': u't1'})
+        for sort in [(u'tenant_uuid', 1), (u'tenant_uuid', -1), (u'mac', 1), (u'mac', -1), (u'id', 1)]:
+            self._check_pagination(sort)
+        self.collection.ensure_index(u'tenant_uuid')
+        self.collection.ensure_index(u'mac')
+        for sort in [(u'tenant_uuid', 1), (u'tenant_uuid', -1), (u'mac', 1), (u'mac', -1)]:
+            self._check_pagination(sort)
+
+    def test_find_after_without_sort(self):
+        ids = self._find_ids({}, after=(u'2', u'2'))
+
+        assert_that(ids, equal_to([u'3', u'4']))
+
+    def test_find_while_modifying_collection(self):
+        documents = _result(self.collection.find({}))
+        first_document = documents.next()
+
+        self.collection.insert({u'id': u'5'})
+        self.collection.delete(u'3')
+
+        ids = [first_document[u'id']] + [document[u'id'] for document in documents]
+        assert_that(ids, contains_inanyorder(u'1', u'2', u'3', u'4'))
+
+    def test_find_sorted_with_limit(self):
+        ids = self._find_ids({}, sort=(u'mac', -1), skip=1, limit=2)
+
+        assert_that(ids, equal_to([u'2', u'1']))
+
+    def test_count(self):
+        selectors = [
+            {},
+            {u'id': u'1'},
+            {u'tenant_uuid': u't1'},
+            {u'tenant_uuid': {u'$in': [u't1', u't3']}},
+            {u'tenant_uuid': u't1', u'n': {u'$gt': 1}},
+            {u'n': 4},
+        ]
+        expected = [(selector, len(self._find_ids(selector))) for selector in selectors]
+        for key in [u'tenant_uuid', u'n']:
+            self.collection.ensure_index(key)
+
+        for selector, expected_count in expected:
+            assert_that(_result(self.collection.count(selector)), equal_to(expected_count), selector)
+
+    def test_stats(self):
+        self.collection.ensure_index(u'tenant_uuid')
+        self.collection.ensure_index((u'tenant_uuid', u'mac'))
+
+        stats = self.collection.stats()
+
+        assert_that(stats, equal_to({
+            u'documents': 4,
+            u'indexes': {u'tenant_uuid': 3, u'tenant_uuid,mac': 3},
+        }))
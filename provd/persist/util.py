@@ -2,10 +2,16 @@
 # Copyright 2011-2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import heapq
 import logging
-from itertools import ifilter, imap
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain, ifilter, imap, islice, product
+from operator import attrgetter, itemgetter
 from provd.persist.common import ID_KEY, InvalidIdError, NonDeletableError
+from provd.persist.document import cow, thaw
+from provd.persist.selector import compile_selector, _contains_operator, _new_values_getter
 from twisted.internet import defer
+from twisted.python import failure
 
 logger = logging.getLogger(__name__)
 
@@ -35,16 +41,6 @@ def _retrieve_doc_values(s_key, doc):
     return aux(s_key, doc)
 
 
-def _contains_operator(selector_value):
-    # Return true if the value associated with a key of a selector
-    # is an operator value, i.e. has an operator semantic.
-    if isinstance(selector_value, dict):
-        for k in selector_value.iterkeys():
-            if k.startswith(u'$'):
-                return True
-    return False
-
-
 def _new_simple_matcher_from_pred(pred):
     # Return a matcher that returns true if there's a value in the document
     # matching the select key for which pred(value) is true
@@ -186,6 +182,8 @@ def _new_matcher(s_value):
         return _new_eq_matcher(s_value)
 
 
+# This is the reference implementation of the selector semantic. Collections
+# use the equivalent, but faster, provd.persist.selector.compile_selector.
 def _create_pred_from_selector(selector):
     # Return a predicate taking a document as argument and returning
     # true if the selector matches it, else false.
@@ -198,18 +196,321 @@ def _create_pred_from_selector(selector):
     return aux
 
 
+_RANGE_OPERATORS = [u'$gt', u'$ge', u'$lt', u'$le']
+
+# minimal number of candidate documents for which sorting is done by walking
+# an index instead of sorting the candidate documents
+_INDEX_SORT_MIN_CANDIDATES = 1000
+
+
+def _new_sort_key_fun(key):
+    # Return a function usable for the key parameter of the sorted function
+    # from a [sort] key
+    splitted_key = key.split(u'.')
+    if len(splitted_key) == 1:
+        # documents are always dictionaries
+        return lambda document: document.get(key)
+    def aux(document):
+        cur_elem = document
+        try:
+            for cur_key in splitted_key:
+                cur_elem = cur_elem[cur_key]
+        except (KeyError, TypeError):
+            # document does not have the given key -- return None
+            return None
+        else:
+            return cur_elem
+    return aux
+
+
+def _new_sort_item_key_fun(key):
+    # Return a function returning the (sort key, id) tuple of a document,
+    # which is used to totally order documents when sorting by key
+    sort_key_fun = _new_sort_key_fun(key)
+    def aux(document):
+        return sort_key_fun(document), document[ID_KEY]
+    return aux
+
+
+def _new_after_pred(after, reverse):
+    # Return a predicate taking a (sort key, id) tuple and returning true
+    # if it comes after the given (sort key, id) tuple in the sort order
+    if reverse:
+        return lambda item_key: item_key < after
+    else:
+        return lambda item_key: item_key > after
+
+
+def _merge_sorted(iterable1, iterable2, reverse):
+    # Merge two iterables of (key, value) tuples sorted by key
+    it1 = iter(iterable1)
+    it2 = iter(iterable2)
+    item1 = next(it1, None)
+    item2 = next(it2, None)
+    while item1 is not None and item2 is not None:
+        if (item2[0] < item1[0]) != reverse and item2[0] != item1[0]:
+            yield item2
+            item2 = next(it2, None)
+        else:
+            yield item1
+            item1 = next(it1, None)
+    if item1 is not None:
+        yield item1
+        for item1 in it1:
+            yield item1
+    if item2 is not None:
+        yield item2
+        for item2 in it2:
+            yield item2
+
+
+class _Index(object):
+    # An index maps the values found in documents for a complex key to the
+    # IDs of these documents, i.e. it uses the same semantic as selectors to
+    # get the values of a document.
+    #
+    # The IDs of documents that don't have any value are kept in missing_ids.
+    # The IDs of documents with unhashable values, or for which the value
+    # used for sorting is not the only value they are indexed under, are kept
+    # in irregular_ids; these documents are always returned by lookups.
+    #
+    # The sorted list of values is only built when it is first needed, i.e.
+    # for range lookups or for sorting.
+    #
+    # Index entries are sets of IDs, so that updating a document is done in
+    # constant time even for keys with few distinct values.
+
+    def __init__(self, complex_key):
+        self.complex_key = complex_key
+        path = tuple(complex_key.split(u'.'))
+        self._get_values = _new_values_getter(path)
+        self._get_sort_key = _new_sort_key_fun(complex_key)
+        self.entries = {}
+        self.missing_ids = set()
+        self.irregular_ids = set()
+        self._sorted_values = None
+
+    def _get_index_values(self, document):
+        # Return a (values, regular) tuple for the document
+        values = self._get_values(document)
+        regular = len(values) == 1 and values[0] is self._get_sort_key(document)
+        return values, regular
+
+    def add(self, id, document):
+        values, regular = self._get_index_values(document)
+        if not values:
+            self.missing_ids.add(id)
+            return
+        for value in values:
+            try:
+                index_entry = self.entries.get(value)
+            except TypeError:
+                regular = False
+                continue
+            if index_entry is None:
+                self.entries[value] = set([id])
+                if self._sorted_values is not None:
+                    insort(self._sorted_values, value)
+            else:
+                index_entry.add(id)
+        if not regular:
+            self.irregular_ids.add(id)
+
+    def remove(self, id, document):
+        self.missing_ids.discard(id)
+        self.irregular_ids.discard(id)
+        for value in self._get_index_values(document)[0]:
+            try:
+                index_entry = self.entries.get(value)
+            except TypeError:
+                continue
+            if index_entry is not None:
+                index_entry.discard(id)
+                if not index_entry:
+                    del self.entries[value]
+                    if self._sorted_values is not None:
+                        del self._sorted_values[bisect_left(self._sorted_values, value)]
+
+    def sorted_values(self):
+        if self._sorted_values is None:
+            self._sorted_values = sorted(self.entries)
+        return self._sorted_values
+
+    def _iter_ids(self, index_entries):
+        # Return an iterator over the irregular IDs and the IDs in the given
+        # index entries, without duplicates
+        irregular_ids = self.irregular_ids
+        for id in irregular_ids:
+            yield id
+        for index_entry in index_entries:
+            for id in index_entry:
+                if id not in irregular_ids:
+                    yield id
+
+    def lookup(self, values):
+        # Return a (number of IDs, IDs iterator) tuple for the documents that
+        # might have one of the given values. Raise a TypeError if a value
+        # is unhashable.
+        values = set(values)
+        index_entries = [self.entries[value] for value in values if value in self.entries]
+        nb_ids = len(self.irregular_ids) + sum(len(index_entry) for index_entry in index_entries)
+        return nb_ids, self._iter_ids(index_entries)
+
+    def lookup_range(self, bounds):
+        # Return a (number of IDs, IDs iterator) tuple for the documents that
+        # might have a value matching all the given (operator, value) bounds.
+        sorted_values = self.sorted_values()
+        start = 0
+        end = len(sorted_values)
+        for operator, value in bounds:
+            if operator == u'$gt':
+                start = max(start, bisect_right(sorted_values, value))
+            elif operator == u'$ge':
+                start = max(start, bisect_left(sorted_values, value))
+            elif operator == u'$lt':
+                end = min(end, bisect_left(sorted_values, value))
+            else:
+                end = min(end, bisect_right(sorted_values, value))
+        index_entries = [self.entries[value] for value in sorted_values[start:end]]
+        nb_ids = len(self.irregular_ids) + sum(len(index_entry) for index_entry in index_entries)
+        return nb_ids, self._iter_ids(index_entries)
+
+    def iter_sorted_ids(self, reverse, after=None):
+        # Return an iterator of (sort key, id) tuples, sorted by sort key
+        # then by id, for every document except irregular ones. If after is
+        # a (sort key, id) tuple, only the tuples coming after it are
+        # returned.
+        irregular_ids = self.irregular_ids
+
+        def iter_none():
+            # documents without a value and documents with a None value
+            # both have None as their sort key
+            ids = self.missing_ids.union(self.entries.get(None, ()))
+            for id in sorted(ids, reverse=reverse):
+                if id not in irregular_ids:
+                    yield None, id
+
+        def iter_entries():
+            # the sorted values and the index entries are copied since the
+            # index might be updated while being iterated
+            sorted_values = self.sorted_values()
+            if after is None:
+                sorted_values = list(sorted_values)
+            elif reverse:
+                sorted_values = sorted_values[:bisect_right(sorted_values, after[0])]
+            else:
+                sorted_values = sorted_values[bisect_left(sorted_values, after[0]):]
+            if reverse:
+                sorted_values.reverse()
+            for value in sorted_values:
+                if value is None:
+                    continue
+                for id in sorted(self.entries.get(value, ()), reverse=reverse):
+                    if id not in irregular_ids:
+                        yield value, id
+
+        # None is smaller than any other value
+        if reverse:
+            items = chain(iter_entries(), iter_none())
+        elif after is not None and after[0] is not None:
+            items = iter_entries()
+        else:
+            items = chain(iter_none(), iter_entries())
+        if after is not None:
+            items = ifilter(_new_after_pred(after, reverse), items)
+        return items
+
+
+class _CompoundIndex(_Index):
+    # A compound index maps tuples of values, one value for each of its
+    # complex keys, to the IDs of the documents having these values.
+    #
+    # A document with more than one value for a key is indexed under every
+    # combination of its values, and is irregular so that it's not returned
+    # twice by lookups. Compound indexes are not used for sorting.
+
+    def __init__(self, complex_keys):
+        self.complex_key = complex_keys
+        self._values_getters = [_new_values_getter(tuple(complex_key.split(u'.')))
+                                for complex_key in complex_keys]
+        self.entries = {}
+        self.missing_ids = set()
+        self.irregular_ids = set()
+        self._sorted_values = None
+
+    def _get_index_values(self, document):
+        values_list = [get_values(document) for get_values in self._values_getters]
+        if not all(values_list):
+            return [], True
+        regular = all(len(values) == 1 for values in values_list)
+        return list(product(*values_list)), regular
+
+    def iter_sorted_ids(self, reverse, after=None):
+        raise NotImplementedError('compound indexes are not ordered')
+
+
+class _QueryPlan(object):
+    # Describe how the candidate documents for a selector are found, i.e.
+    # either:
+    # - 'id': by looking up the IDs given in the selector
+    # - 'index': by looking up an index
+    # - 'scan': by scanning every documents
+    # new_iterator is a function returning an iterator over the candidate
+    # documents, which must then be filtered with the selector.
+    #
+    # covered_keys is the tuple of selector keys for which every candidate
+    # is known to match, or None. When it contains every key of the
+    # selector, the candidates don't need to be filtered.
+
+    def __init__(self, type, nb_candidates, new_iterator, index=None, operator=None,
+                 covered_keys=None):
+        self.type = type
+        self.nb_candidates = nb_candidates
+        self.new_iterator = new_iterator
+        self.index = index
+        self.operator = operator
+        self.covered_keys = covered_keys
+        self.sort = None
+
+    def is_exact(self, selector):
+        # Return true if every candidate document matches the selector
+        return self.covered_keys is not None and len(self.covered_keys) == len(selector)
+
+    def explain(self):
+        result = {
+            u'plan': self.type,
+            u'candidates': self.nb_candidates,
+        }
+        if self.index is not None:
+            result[u'index'] = self.index
+            result[u'operator'] = self.operator
+        if self.sort is not None:
+            result[u'sort'] = self.sort
+        return result
+
+
 class SimpleBackendDocumentCollection(object):
+    # The backend is a dict-like object mapping IDs to documents. It stores
+    # and returns frozen documents (see provd.persist.document), so that
+    # documents are never copied while being searched. Documents are only
+    # copied, lazily, when returned to the caller.
+    #
+    # Backends writing the modifications asynchronously have a commit
+    # method returning a deferred that fires once the modifications done
+    # so far have been written.
+
     def __init__(self, backend, generator):
         self._backend = backend
         self._generator = generator
         self._indexes = {}
+        self._compound_indexes = []
         self.closed = False
 
     def close(self):
         self._backend.close()
         self.closed = True
 
-    def _generate_new_id(self):
+    def new_id(self):
         while True:
             id = self._generator.next()
             if id not in self._backend:
@@ -221,14 +522,24 @@ class SimpleBackendDocumentCollection(object):
             if id in self._backend:
                 raise InvalidIdError(id)
         else:
-            id = self._generate_new_id()
+            id = self.new_id()
             document[ID_KEY] = id
 
         assert id == document[ID_KEY]
         assert id not in self._backend
         self._backend[id] = document
-        self._add_document_update_indexes(document)
-        return defer.succeed(id)
+        self._add_document_update_indexes(self._backend[id])
+        return self._commit(id)
+
+    def _commit(self, result):
+        # Return a deferred that will fire with result once the backend
+        # has written the modifications.
+        commit = getattr(self._backend, 'commit', None)
+        if commit is None:
+            return defer.succeed(result)
+        d = commit()
+        d.addCallback(lambda _: result)
+        return d
 
     def update(self, document):
         try:
@@ -241,8 +552,8 @@ class SimpleBackendDocumentCollection(object):
                 return defer.fail(InvalidIdError(id))
             old_document = self._backend[id]
             self._backend[id] = document
-            self._update_document_update_indexes(document, old_document)
-            return defer.succeed(None)
+            self._update_document_update_indexes(self._backend[id], old_document)
+            return self._commit(None)
 
     def delete(self, id):
         try:
@@ -255,30 +566,14 @@ class SimpleBackendDocumentCollection(object):
         except KeyError:
             return defer.fail(InvalidIdError(id))
         else:
-            return defer.succeed(None)
+            return self._commit(None)
 
     def retrieve(self, id):
         try:
-            return defer.succeed(self._backend[id])
+            return defer.succeed(cow(self._backend[id]))
         except KeyError:
             return defer.succeed(None)
 
-    def _new_key_fun_from_key(self, key):
-        # Return a function usable for the key parameter of the sorted function
-        # from a [sort] key
-        splitted_key = key.split(u'.')
-        def aux(document):
-            cur_elem = document
-            try:
-                for cur_key in splitted_key:
-                    cur_elem = cur_elem[cur_key]
-            except (KeyError, TypeError):
-                # document does not have the given key -- return None
-                return None
-            else:
-                return cur_elem
-        return aux
-
     def _reverse_from_direction(self, direction):
         # Return the reverse value for the reverse parameter of the sorted
         # function from a [sort] direction
@@ -290,19 +585,87 @@ class SimpleBackendDocumentCollection(object):
             # XXX should probably create a more meaningful exception class
             raise Exception('invalid direction %s' % direction)
 
-    def _do_find_sorted(self, selector, fields, skip, limit, sort):
-        documents = list(self._do_find_unsorted(selector, fields, 0, 0))
+    def _use_index_for_sort(self, plan, key):
+        if key not in self._indexes:
+            return False
+        if plan.type == u'id':
+            return False
+        if plan.nb_candidates is not None and plan.nb_candidates < _INDEX_SORT_MIN_CANDIDATES:
+            return False
+        return True
+
+    def _new_index_sorted_iterator(self, index, reverse, pred, after):
+        # Return an iterator over the documents matching pred, sorted by
+        # walking the given index.
+        item_key_fun = _new_sort_item_key_fun(index.complex_key)
+        irregular_items = []
+        for id in index.irregular_ids:
+            document = self._backend[id]
+            if pred(document):
+                irregular_items.append((item_key_fun(document), document))
+        if after is not None:
+            after_pred = _new_after_pred(after, reverse)
+            irregular_items = [item for item in irregular_items if after_pred(item[0])]
+        irregular_items.sort(key=itemgetter(0), reverse=reverse)
+
+        def iter_regular_items():
+            backend = self._backend
+            for sort_key, id in index.iter_sorted_ids(reverse, after):
+                if id in backend:
+                    document = backend[id]
+                    if pred(document):
+                        yield (sort_key, id), document
+
+        return imap(itemgetter(1), _merge_sorted(iter_regular_items(), irregular_items, reverse))
+
+    def _new_top_sorted_iterator(self, documents, key, reverse, after, nb):
+        # Return an iterator over the nb first documents, sorted by key, or
+        # over all the documents if nb is 0.
+        #
+        # Documents are decorated with their (sort key, id) tuple, which is
+        # unique, so that the documents themselves are never compared.
+        sort_key_fun = _new_sort_key_fun(key)
+        items = ((sort_key_fun(document), document[ID_KEY], document) for document in documents)
+        if after is not None:
+            after_pred = _new_after_pred(after, reverse)
+            items = (item for item in items if after_pred(item[:2]))
+        if not nb:
+            items = sorted(items, reverse=reverse)
+        elif reverse:
+            items = heapq.nlargest(nb, items)
+        else:
+            items = heapq.nsmallest(nb, items)
+        return imap(itemgetter(2), items)
+
+    def _do_find_sorted(self, selector, fields, skip, limit, sort, after):
+        # Documents are sorted by key then by ID, so that the order is
+        # total and the documents coming after a given one can be found.
         key, direction = sort
-        key_fun = self._new_key_fun_from_key(key)
         reverse = self._reverse_from_direction(direction)
-        documents.sort(key=key_fun, reverse=reverse)
+        if after is not None:
+            after = tuple(after)
+        plan = self._plan(selector)
+        if self._use_index_for_sort(plan, key):
+            plan.sort = {u'key': key, u'method': u'index'}
+            self._log_plan(plan)
+            pred = compile_selector(selector)
+            documents = self._new_index_sorted_iterator(self._indexes[key], reverse, pred, after)
+        else:
+            plan.sort = {u'key': key, u'method': u'sort'}
+            self._log_plan(plan)
+            documents = self._new_plan_iterator(plan, selector)
+            nb = skip + limit if limit else 0
+            documents = self._new_top_sorted_iterator(documents, key, reverse, after, nb)
         documents = self._new_skip_iterator(skip, documents)
         documents = self._new_limit_iterator(limit, documents)
+        documents = imap(self._new_fields_map_function(fields), documents)
         return documents
 
     def _new_fields_map_function(self, fields):
+        # Return a function that takes a frozen document and return a
+        # copy-on-write document with only the given fields
         if not fields:
-            return lambda x: x
+            return cow
         else:
             splitted_keys = [field.split(u'.') for field in fields]
             def aux(document):
@@ -319,7 +682,7 @@ class SimpleBackendDocumentCollection(object):
                         cur_result = result
                         for cur_key in splitted_key[:-1]:
                             cur_result = cur_result.setdefault(cur_key, {})
-                        cur_result[splitted_key[-1]] = cur_elem
+                        cur_result[splitted_key[-1]] = thaw(cur_elem)
                 return result
             return aux
 
@@ -350,82 +713,176 @@ class SimpleBackendDocumentCollection(object):
                     pass
             return aux(limit)
 
-    def _new_iterator(self, selector, documents):
-        # Return an iterator that will return every documents matching
-        # the given "regular" selector
-        pred = _create_pred_from_selector(selector)
-        return ifilter(pred, documents)
-
-    def _new_indexes_iterator(self, indexes_selector):
-        # Return an iterator that will return every documents in the backend
-        # matching the given "indexes" selector. Note that an indexes selector
-        # can't be empty.
-        ids = set()
-        first_loop = True
-        for selector_key, selector_value in indexes_selector.iteritems():
-            index = self._indexes[selector_key]
-            index_entry = index.get(selector_value, [])
-            if first_loop:
-                first_loop = False
-                ids.update(index_entry)
+    def _new_ids_iterator_function(self, ids):
+        def aux():
+            # the IDs are copied since the indexes might be updated while
+            # the documents are being iterated
+            backend = self._backend
+            for id in list(ids):
+                if id in backend:
+                    yield backend[id]
+        return aux
+
+    def _new_excluded_ids_iterator_function(self, excluded_ids):
+        def aux():
+            excluded_ids_set = set(excluded_ids)
+            for document in self._iter_backend_documents():
+                if document[ID_KEY] not in excluded_ids_set:
+                    yield document
+        return aux
+
+    def _iter_backend_documents(self):
+        # the documents are copied since the backend might be modified
+        # while the documents are being iterated, for example while they
+        # are being streamed
+        return iter(list(self._backend.itervalues()))
+
+    def _plan_id(self, s_value):
+        # Return a plan for a selector value on ID_KEY, or None
+        if not _contains_operator(s_value):
+            ids = [s_value]
+        elif len(s_value) == 1 and isinstance(s_value.get(u'$in'), list):
+            ids = s_value[u'$in']
+        else:
+            return None
+        try:
+            ids = set(id for id in ids if id in self._backend)
+        except TypeError:
+            return None
+        return _QueryPlan(u'id', len(ids), self._new_ids_iterator_function(ids),
+                          covered_keys=(ID_KEY,))
+
+    def _plan_index(self, index, s_value):
+        # Return a list of plans using the given index for the selector value
+        plans = []
+        complex_key = index.complex_key
+        # lookups return exactly the matching documents when there's no
+        # irregular document in the index
+        if index.irregular_ids:
+            covered_keys = None
+        else:
+            covered_keys = (complex_key,)
+        try:
+            if not _contains_operator(s_value):
+                nb_ids, ids = index.lookup([s_value])
+                plans.append(_QueryPlan(u'index', nb_ids, self._new_ids_iterator_function(ids),
+                                        complex_key, u'$eq', covered_keys))
+            else:
+                if isinstance(s_value.get(u'$in'), list):
+                    nb_ids, ids = index.lookup(s_value[u'$in'])
+                    if len(s_value) != 1:
+                        covered_keys = None
+                    plans.append(_QueryPlan(u'index', nb_ids, self._new_ids_iterator_function(ids),
+                                            complex_key, u'$in', covered_keys))
+                if isinstance(s_value.get(u'$nin'), list):
+                    nb_ids, ids = index.lookup(s_value[u'$nin'])
+                    # irregular documents are candidates, and are the first
+                    # to be returned by the lookup
+                    excluded_ids = islice(ids, len(index.irregular_ids), None)
+                    nb_candidates = max(len(self._backend) - nb_ids + len(index.irregular_ids), 0)
+                    plans.append(_QueryPlan(u'index', nb_candidates,
+                                            self._new_excluded_ids_iterator_function(excluded_ids),
+                                            complex_key, u'$nin'))
+                bounds = [(operator, s_value[operator]) for operator in _RANGE_OPERATORS
+                          if operator in s_value]
+                if bounds:
+                    nb_ids, ids = index.lookup_range(bounds)
+                    operator = u','.join(operator for operator, _ in bounds)
+                    plans.append(_QueryPlan(u'index', nb_ids, self._new_ids_iterator_function(ids),
+                                            complex_key, operator))
+        except TypeError:
+            # unhashable selector value -- index is not usable
+            pass
+        return plans
+
+    def _plan_compound_index(self, index, selector):
+        # Return a list of plans using the given compound index for the
+        # selector, i.e. an empty list if the selector doesn't have an
+        # equality or $in condition on every key of the index
+        values_list = []
+        exact = not index.irregular_ids
+        for complex_key in index.complex_key:
+            if complex_key not in selector:
+                return []
+            s_value = selector[complex_key]
+            if not _contains_operator(s_value):
+                values_list.append([s_value])
+            elif isinstance(s_value.get(u'$in'), list):
+                values_list.append(s_value[u'$in'])
+                exact = exact and len(s_value) == 1
             else:
-                ids.intersection_update(index_entry)
-        for id in ids:
-            yield self._backend[id]
+                return []
+        try:
+            nb_ids, ids = index.lookup(product(*values_list))
+        except TypeError:
+            return []
+        covered_keys = index.complex_key if exact else None
+        return [_QueryPlan(u'index', nb_ids, self._new_ids_iterator_function(ids),
+                           index.complex_key, u'$eq', covered_keys)]
+
+    def _plan(self, selector):
+        # Return the plan with the least candidate documents for the selector.
+        if ID_KEY in selector:
+            plan = self._plan_id(selector[ID_KEY])
+            if plan is not None:
+                return plan
+        plans = []
+        for selector_key, selector_value in selector.iteritems():
+            index = self._indexes.get(selector_key)
+            if index is not None:
+                plans.extend(self._plan_index(index, selector_value))
+        for index in self._compound_indexes:
+            plans.extend(self._plan_compound_index(index, selector))
+        if not plans:
+            return _QueryPlan(u'scan', len(self._backend), self._iter_backend_documents,
+                              covered_keys=())
+        return min(plans, key=attrgetter('nb_candidates'))
+
+    def _new_plan_iterator(self, plan, selector):
+        # Return an iterator that will yield every document in the backend
+        # matching the given selector, using the given plan
+        documents = plan.new_iterator()
+        if selector and not plan.is_exact(selector):
+            documents = ifilter(compile_selector(selector), documents)
+        return documents
+
+    def _log_plan(self, plan):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Query plan: %s', plan.explain())
 
     def _new_iterator_over_matching_documents(self, selector):
         # Return an iterator that will yield every document in the backend
         # matching the given selector. This may or may not use indices.
-        # 1. check if there's some key-value in the selector usable by the
-        #    indexes
-        indexes_selector = {}
-        regular_selector = {}
-        for selector_key, selector_value in selector.iteritems():
-            if (selector_key in self._indexes and
-                not _contains_operator(selector_value)):
-                indexes_selector[selector_key] = selector_value
-            else:
-                regular_selector[selector_key] = selector_value
-        # 2. use indexes selector if possible
-        if indexes_selector:
-            documents = self._new_indexes_iterator(indexes_selector)
-        else:
-            documents = self._backend.itervalues()
-        # 3. use regular selector if possible
-        if regular_selector:
-            documents = self._new_iterator(regular_selector, documents)
-        return documents
+        plan = self._plan(selector)
+        self._log_plan(plan)
+        return self._new_plan_iterator(plan, selector)
 
     def _do_find_unsorted(self, selector, fields, skip, limit):
-        # common case optimization when only ID_KEY is present
-        if ID_KEY in selector and len(selector) == 1 and not _contains_operator(selector[ID_KEY]):
-            try:
-                documents = [self._backend[selector[ID_KEY]]]
-            except KeyError:
-                documents = []
-        else:
-            documents = self._new_iterator_over_matching_documents(selector)
+        documents = self._new_iterator_over_matching_documents(selector)
         documents = self._new_skip_iterator(skip, documents)
         documents = self._new_limit_iterator(limit, documents)
         documents = imap(self._new_fields_map_function(fields), documents)
         return documents
 
-    def _do_find(self, selector, fields, skip, limit, sort):
+    def _do_find(self, selector, fields, skip, limit, sort, after=None):
         # Return an iterator over the documents
+        if after is not None and not sort:
+            sort = (ID_KEY, 1)
         if sort:
-            return self._do_find_sorted(selector, fields, skip, limit, sort)
+            return self._do_find_sorted(selector, fields, skip, limit, sort, after)
         else:
             return self._do_find_unsorted(selector, fields, skip, limit)
 
-    def find(self, selector, fields=None, skip=0, limit=0, sort=None):
+    def find(self, selector, fields=None, skip=0, limit=0, sort=None, after=None):
         logger.debug('Executing find in backend based collection with:\n'
                      '  selector: %s\n'
                      '  fields: %s\n'
                      '  skip: %s\n'
                      '  limit: %s\n'
-                     '  sort: %s',
-                     selector, fields, skip, limit, sort)
-        return defer.succeed(self._do_find(selector, fields, skip, limit, sort))
+                     '  sort: %s\n'
+                     '  after: %s',
+                     selector, fields, skip, limit, sort, after)
+        return defer.succeed(self._do_find(selector, fields, skip, limit, sort, after))
 
     def find_one(self, selector):
         it = self._do_find(selector, None, 0, 1, None)
@@ -435,13 +892,31 @@ class SimpleBackendDocumentCollection(object):
             result = None
         return defer.succeed(result)
 
+    def count(self, selector):
+        plan = self._plan(selector)
+        self._log_plan(plan)
+        if plan.is_exact(selector):
+            return defer.succeed(plan.nb_candidates)
+        nb = 0
+        for _ in self._new_plan_iterator(plan, selector):
+            nb += 1
+        return defer.succeed(nb)
+
+    def explain(self, selector, sort=None):
+        plan = self._plan(selector)
+        if sort:
+            key, direction = sort
+            if self._use_index_for_sort(plan, key):
+                plan.sort = {u'key': key, u'method': u'index'}
+            else:
+                plan.sort = {u'key': key, u'method': u'sort'}
+        return defer.succeed(plan.explain())
+
     def _add_document_update_indexes(self, document):
         # Update the indexes after adding a document to the backend.
         id = document[ID_KEY]
-        for complex_key, index in self._indexes.iteritems():
-            has_key, value = self._get_value_from_complex_key(complex_key, document)
-            if has_key:
-                self._new_value_for_index(index, id, value)
+        for index in self._indexes.itervalues():
+            index.add(id, document)
 
     def _update_document_update_indexes(self, document, old_document):
         # Update the indexes after updating a document to the backend.
@@ -451,82 +926,38 @@ class SimpleBackendDocumentCollection(object):
     def _del_document_update_indexes(self, old_document):
         # Update the indexes after removing document from the backend.
         id = old_document[ID_KEY]
-        for complex_key, index in self._indexes.iteritems():
-            has_key, value = self._get_value_from_complex_key(complex_key, old_document)
-            if has_key:
-                self._del_value_for_index(index, id, value)
-
-    def _new_value_for_index(self, index, id, value):
-        # Add the value belonging to the document with the given id to the
-        # given index.
-        def aux(value):
-            if value in index:
-                index_entry = index[value]
-                if id not in index_entry:
-                    index_entry.append(id)
-            else:
-                index[value] = [id]
-        aux(value)
-        if isinstance(value, list):
-            for list_item in value:
-                aux(list_item)
-
-    def _del_value_for_index(self, index, id, value):
-        # Delete the value belonging to the document with the given id to
-        # the given index.
-        def aux(value):
-            index_entry = index[value]
-            index_entry.remove(id)
-            if not index_entry:
-                del index[value]
-        aux(value)
-        if isinstance(value, list):
-            for list_item in value:
-                aux(list_item)
-
-    def _get_value_from_complex_key(self, complex_key, document):
-        get_value_fun = self._new_get_value_fun_from_complex_key(complex_key)
-        return get_value_fun(document)
-
-    def _new_get_value_fun_from_complex_key(self, complex_key):
-        # Return a function that takes a document and return a tuple where
-        # the first element is true if the document has the complex key, and
-        # the second element is the value of the complex key for this document
-        key_tokens = complex_key.split(u'.')
-        def aux(document):
-            value = document
-            for key_token in key_tokens:
-                try:
-                    if key_token in value:
-                        value = value[key_token]
-                    else:
-                        break
-                except TypeError:
-                    break
-            else:
-                # document has the key and value is the value of this key for
-                # this document
-                return True, value
-            return False, None
-        return aux
-
-    def _new_id_and_value_iterator(self, complex_key):
-        # Return an iterator that yield (id, value) tuple for each document
-        # in the backend that has the given complex key.
-        get_value_fun = self._new_get_value_fun_from_complex_key(complex_key)
-        for document in self._backend.itervalues():
-            has_key, value = get_value_fun(document)
-            if has_key:
-                yield document[ID_KEY], value
+        for index in self._indexes.itervalues():
+            index.remove(id, old_document)
 
     def _create_index(self, complex_key):
         logger.info('Creating index on complex key %s', complex_key)
-        index = {}
-        for id, value in self._new_id_and_value_iterator(complex_key):
-            self._new_value_for_index(index, id, value)
+        if isinstance(complex_key, tuple):
+            index = _CompoundIndex(complex_key)
+            self._compound_indexes.append(index)
+        else:
+            index = _Index(complex_key)
+        for document in self._backend.itervalues():
+            index.add(document[ID_KEY], document)
         self._indexes[complex_key] = index
 
+    def stats(self):
+        """Return a dictionary with the number of documents of the
+        collection and the number of entries of each of its indexes.
+
+        """
+        indexes = {}
+        for complex_key, index in self._indexes.iteritems():
+            if isinstance(complex_key, tuple):
+                complex_key = u','.join(complex_key)
+            indexes[complex_key] = len(index.entries)
+        return {
+            u'documents': len(self._backend),
+            u'indexes': indexes,
+        }
+
     def ensure_index(self, complex_key):
+        if isinstance(complex_key, list):
+            complex_key = tuple(complex_key)
         if complex_key not in self._indexes:
             self._create_index(complex_key)
         return defer.succeed(None)
@@ -537,8 +968,19 @@ def new_backend_based_collection(backend, generator):
 
 
 class ForwardingDocumentCollection(object):
+    # The forwarded collection applies the modifications synchronously. The
+    # deferred it returns has already failed if a modification has been
+    # rejected, and otherwise fires once the modification has been
+    # persisted, so derived collections must update their own state as soon
+    # as the modification has been forwarded, not in a callback.
+
     def __init__(self, collection):
         self._collection = collection
 
+    def _rejected(self, deferred):
+        # Return true if the forwarded collection has rejected the
+        # modification for which it returned the deferred.
+        return deferred.called and isinstance(deferred.result, failure.Failure)
+
     def __getattr__(self, name):
         return getattr(self._collection, name)
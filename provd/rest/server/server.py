@@ -25,13 +25,18 @@ from provd.app import (
     NonDeletableError,
 )
 from provd.localization import get_locale_and_language
+from provd.metrics import MetricsWriter, RequestStats
 from provd.operation import format_oip, operation_in_progres_from_deferred
 from provd.persist.common import ID_KEY
 from provd.plugins import BasePluginManagerObserver
 from provd.rest.util import PROV_MIME_TYPE, uri_append_path
 from provd.servers.http_site import AuthResource
+from provd.servers.tftp.blockcache import block_cache
+from provd.servers.tftp.connection import transfer_stats
+from provd.rest.server.stream import accept_ndjson, deferred_respond_json_list, NDJSON_MIME_TYPE
 from provd.rest.server.util import accept_mime_type, numeric_id_generator
 from provd.services import InvalidParameterError
+from provd.synchronize import sync_call_durations
 from provd.util import norm_mac, norm_ip
 from twisted.web import http
 from twisted.web.server import NOT_DONE_YET
@@ -151,6 +156,22 @@ def json_response_entity(fun):
     return aux
 
 
+def json_list_response_entity(fun):
+    """To use on resource render's method that respond with a list of
+    documents, either as a PROV_MIME_TYPE entity or, if the client accepts
+    it, as an NDJSON_MIME_TYPE entity.
+
+    """
+    @functools.wraps(fun)
+    def aux(self, request):
+        if accept_ndjson(request):
+            request.setHeader('Content-Type', NDJSON_MIME_TYPE)
+            return fun(self, request)
+        else:
+            return json_response_entity(fun)(self, request)
+    return aux
+
+
 def json_request_entity(fun):
     """To use on resource render's method that receive a PROV_MIME_TYPE
     entity.
@@ -251,6 +272,21 @@ def _add_sort_parameters(args, result):
         result['sort'] = (key, direction)
 
 
+def _add_after_parameter(args, result):
+    # after=["00:11:22:33:44:55","abcdef"]
+    if 'after' in args:
+        raw_after = args['after'][0]
+        try:
+            after = json.loads(raw_after)
+        except ValueError as e:
+            logger.warning('Invalid after value: %s', e)
+        else:
+            if isinstance(after, list) and len(after) == 2:
+                result['after'] = tuple(after)
+            else:
+                logger.warning('Invalid after value: %s', raw_after)
+
+
 def find_arguments_from_request(request):
     # Return a dictionary representing the different find parameters that
     # were passed in the request. The dictionary is usable as **kwargs for
@@ -262,6 +298,7 @@ def find_arguments_from_request(request):
     _add_skip_parameter(args, result)
     _add_limit_parameters(args, result)
     _add_sort_parameters(args, result)
+    _add_after_parameter(args, result)
     return result
 
 
@@ -322,12 +359,15 @@ class IntermediaryResource(AuthResource):
 
 
 class ServerResource(IntermediaryResource):
-    def __init__(self, app, dhcp_request_processing_service):
+    def __init__(self, app, dhcp_request_processing_service, request_stats=None):
+        if request_stats is None:
+            request_stats = RequestStats()
         links = [
             (u'dev', 'dev_mgr', DeviceManagerResource(app, dhcp_request_processing_service)),
             (u'cfg', 'cfg_mgr', ConfigManagerResource(app)),
             (u'pg', 'pg_mgr', PluginManagerResource(app)),
             (u'status', 'status', StatusResource()),
+            (u'request_stats', 'request_stats', RequestStatsResource(request_stats)),
             (REL_CONFIGURE_SRV, 'configure', ConfigureServiceResource(app.configure_service)),
         ]
         IntermediaryResource.__init__(self, links)
@@ -726,6 +766,14 @@ class DeviceReconfigureResource(AuthResource):
         AuthResource.__init__(self)
         self._app = app
 
+    @required_acl('provd.operation.read')
+    @json_response_entity
+    def render_GET(self, request):
+        # return the status of the reconfigurations of devices in progress
+        operations = [{u'status': format_oip(oip)} for oip in self._app.dev_reconfigure_oips]
+        content = {u'operations': operations}
+        return json_dumps(content)
+
     @json_request_entity
     @required_acl('provd.dev_mgr.reconfigure.create')
     def render_POST(self, request, content):
@@ -809,13 +857,23 @@ class DevicesResource(AuthResource):
             return value in ['true', 'True']
         return False
 
-    @json_response_entity
+    def _extract_count(self, request):
+        for value in request.args.get('count', []):
+            return value in ['true', 'True']
+        return False
+
+    @json_list_response_entity
     @required_acl('provd.dev_mgr.devices.read')
     def render_GET(self, request):
         find_arguments = find_arguments_from_request(request)
 
         def on_callback(devices):
-            data = json_dumps({u'devices': list(devices)})
+            deferred_respond_json_list(request, u'devices', devices,
+                                       accept_ndjson(request))
+
+        def on_count_callback(count):
+            request.setHeader('Content-Type', PROV_MIME_TYPE)
+            data = json_dumps({u'count': count})
             deferred_respond_ok(request, data)
 
         def on_errback(failure):
@@ -824,8 +882,12 @@ class DevicesResource(AuthResource):
         recurse = self._extract_recurse(request)
         tenant_uuids = self._build_tenant_list_from_request(request, recurse=recurse)
         find_arguments['selector']['tenant_uuid'] = {'$in': tenant_uuids}
-        d = self._app.dev_find(**find_arguments)
-        d.addCallbacks(on_callback, on_errback)
+        if self._extract_count(request):
+            d = self._app.dev_count(find_arguments['selector'])
+            d.addCallbacks(on_count_callback, on_errback)
+        else:
+            d = self._app.dev_find(**find_arguments)
+            d.addCallbacks(on_callback, on_errback)
         return NOT_DONE_YET
 
     @json_request_entity
@@ -986,14 +1048,14 @@ class ConfigsResource(AuthResource):
     def getChild(self, path, request):
         return ConfigResource(self._app, path)
 
-    @json_response_entity
+    @json_list_response_entity
     @required_acl('provd.cfg_mgr.configs.read')
     def render_GET(self, request):
         find_arguments = find_arguments_from_request(request)
 
         def on_callback(configs):
-            data = json_dumps({u'configs': list(configs)})
-            deferred_respond_ok(request, data)
+            deferred_respond_json_list(request, u'configs', configs,
+                                       accept_ndjson(request))
 
         def on_errback(failure):
             deferred_respond_error(request, failure.value)
@@ -1116,6 +1178,7 @@ class PluginManagerResource(IntermediaryResource):
             (REL_INSTALL_SRV, 'install', PluginManagerInstallServiceResource(app)),
             (u'pg.plugins', 'plugins', PluginsResource(app.pg_mgr)),
             (u'pg.reload', 'reload', PluginReloadResource(app)),
+            (u'pg.associations', 'associations', PluginAssociationsResource(app)),
         ]
         IntermediaryResource.__init__(self, links)
 
@@ -1257,6 +1320,23 @@ class PluginReloadResource(AuthResource):
             return NOT_DONE_YET
 
 
+class PluginAssociationsResource(AuthResource):
+    def __init__(self, app):
+        AuthResource.__init__(self)
+        self._app = app
+
+    @json_response_entity
+    @required_acl('provd.pg_mgr.associations.read')
+    def render_GET(self, request):
+        cache = self._app.pg_association_cache
+        content = {
+            u'associations': cache.associations(),
+            u'hits': cache.hits,
+            u'misses': cache.misses,
+        }
+        return json_dumps(content)
+
+
 class PluginInfoResource(AuthResource):
     def __init__(self, plugin):
         AuthResource.__init__(self)
@@ -1294,9 +1374,142 @@ class StatusResource(AuthResource):
         return json_dumps({u'rest_api': 'ok'})
 
 
-def new_authenticated_server_resource(app, dhcp_request_processing_service):
+class RequestStatsResource(AuthResource):
+    def __init__(self, request_stats):
+        AuthResource.__init__(self)
+        self._request_stats = request_stats
+
+    @json_response_entity
+    @required_acl('provd.request_stats.read')
+    def render_GET(self, request):
+        return json_dumps({u'request_stats': self._request_stats.as_list()})
+
+
+class MetricsResource(AuthResource):
+    """Resource returning the metrics of the provisioning server in the
+    Prometheus text exposition format.
+
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, app, request_stats, dev_update_coalescer=None):
+        AuthResource.__init__(self)
+        self._app = app
+        self._request_stats = request_stats
+        self._dev_update_coalescer = dev_update_coalescer
+
+    @required_acl('provd.metrics.read')
+    def render_GET(self, request):
+        writer = MetricsWriter()
+        self._write_tftp_metrics(writer)
+        self._write_request_metrics(writer)
+        self._write_collection_metrics(writer)
+        self._write_lock_metrics(writer)
+        self._write_plugin_metrics(writer)
+        self._write_sync_metrics(writer)
+        request.setHeader('Content-Type', self.content_type)
+        return writer.getvalue()
+
+    def _write_tftp_metrics(self, writer):
+        writer.gauge('tftp_transfers_in_flight', 'Number of TFTP transfers in progress.',
+                     [({}, transfer_stats.in_flight)])
+        writer.counter('tftp_transfers_total', 'Number of TFTP transfers started.',
+                       [({}, transfer_stats.started)])
+        writer.counter('tftp_transfers_completed_total', 'Number of TFTP transfers completed.',
+                       [({}, transfer_stats.completed)])
+        writer.counter('tftp_retries_total', 'Number of TFTP retransmissions after a timeout.',
+                       [({}, transfer_stats.retries)])
+        writer.counter('tftp_timeouts_total', 'Number of TFTP transfers aborted after too many retries.',
+                       [({}, transfer_stats.timeouts)])
+        writer.histogram('tftp_transfer_retransmissions', 'Number of TFTP datagrams sent again per transfer.',
+                         [({}, transfer_stats.retransmissions)])
+        block_cache_stats = block_cache.stats()
+        writer.gauge('tftp_block_cache_bytes', 'Size of the DATA datagrams in the TFTP block cache.',
+                     [({}, block_cache_stats[u'size'])])
+        writer.gauge('tftp_block_cache_entries', 'Number of files and blksizes in the TFTP block cache.',
+                     [({}, block_cache_stats[u'entries'])])
+        writer.counter('tftp_block_cache_hits_total', 'Number of TFTP transfers served from the block cache.',
+                       [({}, block_cache_stats[u'hits'])])
+        writer.counter('tftp_block_cache_misses_total', 'Number of TFTP transfers not found in the block cache.',
+                       [({}, block_cache_stats[u'misses'])])
+
+    def _write_request_metrics(self, writer):
+        writer.counter('http_responses_total', 'Number of HTTP responses to devices by plugin and status.',
+                       [({'plugin': plugin_id, 'status': status}, count)
+                        for request_type, plugin_id, status, count in self._request_stats.responses()
+                        if request_type == 'http'])
+        writer.histogram('request_stage_duration_seconds',
+                         'Duration of the stages of the processing of the requests of devices.',
+                         [({'request_type': request_type, 'plugin': plugin_id, 'stage': stage}, histogram)
+                          for request_type, plugin_id, stage, histogram in self._request_stats.histograms()])
+        lookup_stats = self._app.dev_lookup_stats()
+        writer.counter('device_lookups_total', 'Number of device lookups by result.',
+                       [({'result': 'hit'}, lookup_stats[u'hits']),
+                        ({'result': 'miss'}, lookup_stats[u'misses'])])
+        cache = self._app.pg_association_cache
+        writer.counter('plugin_association_cache_lookups_total',
+                       'Number of plugin association score cache lookups by result.',
+                       [({'result': 'hit'}, cache.hits),
+                        ({'result': 'miss'}, cache.misses)])
+        if self._dev_update_coalescer is not None:
+            update_stats = self._dev_update_coalescer.stats()
+            writer.counter('device_update_requests_total',
+                           'Number of device updates requested while processing the requests of devices.',
+                           [({}, update_stats[u'requested'])])
+            writer.counter('device_updates_total',
+                           'Number of device updates requested while processing the requests of devices by result.',
+                           [({'result': 'coalesced'}, update_stats[u'coalesced']),
+                            ({'result': 'skipped'}, update_stats[u'skipped']),
+                            ({'result': 'persisted'}, update_stats[u'persisted'])])
+
+    def _write_collection_metrics(self, writer):
+        collection_stats = sorted(self._app.collection_stats().iteritems())
+        writer.gauge('collection_documents', 'Number of documents of the collections.',
+                     [({'collection': name}, stats[u'documents'])
+                      for name, stats in collection_stats])
+        writer.gauge('collection_index_entries', 'Number of distinct values of the collection indexes.',
+                     [({'collection': name, 'index': index}, nb_entries)
+                      for name, stats in collection_stats
+                      for index, nb_entries in sorted(stats[u'indexes'].iteritems())])
+        writer.gauge('device_lookup_index_entries', 'Number of entries of the device lookup index.',
+                     [({}, dict(collection_stats)[u'devices'][u'lookup_entries'])])
+        writer.gauge('raw_config_cache_entries', 'Number of entries of the raw config cache.',
+                     [({}, dict(collection_stats)[u'configs'][u'raw_config_cache_entries'])])
+
+    def _write_lock_metrics(self, writer):
+        lock_stats = sorted(self._app.lock_stats().iteritems())
+        writer.counter('lock_acquisitions_total', 'Number of lock acquisitions by operation.',
+                       [({'operation': operation}, stats[u'count']) for operation, stats in lock_stats])
+        writer.counter('lock_wait_seconds_total', 'Time spent waiting for locks by operation.',
+                       [({'operation': operation}, stats[u'wait_time']) for operation, stats in lock_stats])
+        writer.counter('lock_hold_seconds_total', 'Time spent holding locks by operation.',
+                       [({'operation': operation}, stats[u'hold_time']) for operation, stats in lock_stats])
+        writer.gauge('lock_max_wait_seconds', 'Longest time spent waiting for locks by operation.',
+                     [({'operation': operation}, stats[u'max_wait_time']) for operation, stats in lock_stats])
+        writer.gauge('lock_max_hold_seconds', 'Longest time spent holding locks by operation.',
+                     [({'operation': operation}, stats[u'max_hold_time']) for operation, stats in lock_stats])
+
+    def _write_plugin_metrics(self, writer):
+        writer.histogram('plugin_configure_duration_seconds',
+                         'Duration of the configuration of devices by plugin.',
+                         [({'plugin': plugin_id}, histogram)
+                          for plugin_id, histogram in sorted(self._app.pg_configure_durations().iteritems())])
+
+    def _write_sync_metrics(self, writer):
+        writer.histogram('sync_call_duration_seconds',
+                         'Duration of the calls to the synchronize service by method.',
+                         [({'method': name}, histogram)
+                          for name, histogram in sorted(sync_call_durations.iteritems())])
+
+
+def new_authenticated_server_resource(app, dhcp_request_processing_service, request_stats=None,
+                                      dev_update_coalescer=None):
     """Create and return a new server resource that will be accessible only
     by authenticated users.
     """
-    server_resource = ServerResource(app, dhcp_request_processing_service)
+    if request_stats is None:
+        request_stats = RequestStats()
+    server_resource = ServerResource(app, dhcp_request_processing_service, request_stats)
+    server_resource.putChild('metrics', MetricsResource(app, request_stats, dev_update_coalescer))
     return server_resource
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Streaming of JSON responses.
+
+Large lists of documents are encoded and written to the request a few
+documents at a time, instead of building the whole JSON string in memory.
+The producer is a streaming (push) producer, so that it stops writing when
+the transport buffers are full.
+
+"""
+
+import functools
+import json
+import logging
+from provd.rest.server.util import parse_accept
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implements
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MIME_TYPE = 'application/x-ndjson'
+
+_json_dumps = functools.partial(json.dumps, separators=(',', ':'))
+
+
+def accept_ndjson(request):
+    """Return true if the client explicitly accepts an NDJSON response."""
+    accept = request.getHeader('Accept')
+    if accept is None:
+        return False
+    return NDJSON_MIME_TYPE in parse_accept(accept)
+
+
+class JsonListProducer(object):
+    """Write a list of documents to a request, either as a JSON object
+    {key: [document, ...]} or, if ndjson is true, as one JSON document per
+    line.
+
+    """
+
+    implements(IPushProducer)
+
+    chunk_size = 200
+
+    def __init__(self, request, key, documents, ndjson=False, clock=reactor):
+        self._request = request
+        self._key = key
+        self._documents = iter(documents)
+        self._ndjson = ndjson
+        self._clock = clock
+        self._first = True
+        self._paused = False
+        self._stopped = False
+        self._delayed_call = None
+
+    def start(self):
+        self._request.registerProducer(self, True)
+        if not self._ndjson:
+            self._request.write('{%s:[' % _json_dumps(self._key))
+        self._schedule()
+
+    def _schedule(self):
+        if self._delayed_call is None and not self._paused and not self._stopped:
+            self._delayed_call = self._clock.callLater(0, self._produce)
+
+    def _produce(self):
+        # Write the next chunk of documents, then give the reactor a chance
+        # to run before writing the next one.
+        self._delayed_call = None
+        try:
+            chunk = self._next_chunk()
+        except Exception:
+            # the response can't be completed, so the connection is closed
+            # for the client to see that the response is truncated
+            logger.error('Error while streaming %s', self._key, exc_info=True)
+            self._abort()
+            return
+        if chunk:
+            self._request.write(chunk)
+        if self._documents is None:
+            self._finish()
+        else:
+            self._schedule()
+
+    def _next_chunk(self):
+        # Return the next chunk to write. The documents iterator is set to
+        # None once it's exhausted.
+        chunk = []
+        for document in self._documents:
+            if self._ndjson:
+                chunk.append(_json_dumps(document))
+                chunk.append('\n')
+            else:
+                if self._first:
+                    self._first = False
+                else:
+                    chunk.append(',')
+                chunk.append(_json_dumps(document))
+            if len(chunk) >= 2 * self.chunk_size:
+                return ''.join(chunk)
+        self._documents = None
+        if not self._ndjson:
+            chunk.append(']}')
+        return ''.join(chunk)
+
+    def _finish(self):
+        self._stopped = True
+        self._request.unregisterProducer()
+        self._request.finish()
+
+    def _abort(self):
+        self._stopped = True
+        self._request.unregisterProducer()
+        self._request.loseConnection()
+
+    def pauseProducing(self):
+        self._paused = True
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+
+    def resumeProducing(self):
+        self._paused = False
+        self._schedule()
+
+    def stopProducing(self):
+        # the connection has been lost
+        logger.debug('Connection lost while streaming %s', self._key)
+        self._stopped = True
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+
+
+def deferred_respond_json_list(request, key, documents, ndjson=False):
+    """Stream the documents to the request, which must not be finished."""
+    JsonListProducer(request, key, documents, ndjson).start()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import unittest
+
+from hamcrest import assert_that, equal_to, none
+from twisted.internet.task import Clock
+
+from provd.rest.server.stream import JsonListProducer
+
+
+class _FakeRequest(object):
+
+    def __init__(self):
+        self.producer = None
+        self.written = []
+        self.finished = False
+        self.connection_lost = False
+        # simulate a transport whose buffers are full after every write
+        self.pause_on_write = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+        if self.pause_on_write and self.producer is not None:
+            self.producer.pauseProducing()
+
+    def finish(self):
+        self.finished = True
+
+    def loseConnection(self):
+        self.connection_lost = True
+
+    def content(self):
+        return ''.join(self.written)
+
+
+class TestJsonListProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.request = _FakeRequest()
+        self.documents = [{u'id': unicode(i)} for i in xrange(5)]
+
+    def _new_producer(self, documents, ndjson=False):
+        producer = JsonListProducer(self.request, u'devices', documents, ndjson, self.clock)
+        producer.chunk_size = 2
+        return producer
+
+    def _run(self):
+        self.clock.advance(0)
+
+    def test_json(self):
+        self._new_producer(iter(self.documents)).start()
+        self._run()
+
+        assert_that(json.loads(self.request.content()), equal_to({u'devices': self.documents}))
+        assert_that(self.request.finished)
+        assert_that(self.request.producer, none())
+
+    def test_json_empty(self):
+        self._new_producer(iter([])).start()
+        self._run()
+
+        assert_that(self.request.content(), equal_to('{"devices":[]}'))
+        assert_that(self.request.finished)
+
+    def test_ndjson(self):
+        self._new_producer(iter(self.documents), ndjson=True).start()
+        self._run()
+
+        lines = self.request.content().splitlines()
+        assert_that([json.loads(line) for line in lines], equal_to(self.documents))
+        assert_that(self.request.finished)
+
+    def test_pause_and_resume(self):
+        self.request.pause_on_write = True
+        producer = self._new_producer(iter(self.documents), ndjson=True)
+        producer.start()
+
+        self._run()
+        assert_that(self.request.content().count('\n'), equal_to(2))
+        producer.resumeProducing()
+        self._run()
+        assert_that(self.request.content().count('\n'), equal_to(4))
+        assert_that(self.request.finished, equal_to(False))
+        producer.resumeProducing()
+        self._run()
+        assert_that(self.request.content().count('\n'), equal_to(5))
+        assert_that(self.request.finished)
+
+    def test_stop_producing(self):
+        self.request.pause_on_write = True
+        producer = self._new_producer(iter(self.documents), ndjson=True)
+        producer.start()
+        self._run()
+
+        producer.stopProducing()
+        producer.resumeProducing()
+        self._run()
+
+        assert_that(self.request.content().count('\n'), equal_to(2))
+        assert_that(self.request.finished, equal_to(False))
+        assert_that(self.clock.getDelayedCalls(), equal_to([]))
+
+    def test_error_closes_the_connection(self):
+        documents = self.documents[:3] + [{u'id': object()}]
+        self._new_producer(iter(documents), ndjson=True).start()
+        self._run()
+
+        assert_that(self.request.content().count('\n'), equal_to(2))
+        assert_that(self.request.connection_lost)
+        assert_that(self.request.finished, equal_to(False))
+        assert_that(self.request.producer, none())
+        assert_that(self.clock.getDelayedCalls(), equal_to([]))
@@ -13,14 +13,16 @@ Things to note:
   request (WRQ) as for now.
 - netascii mode is not supported -- only octet mode is.
 - mail mode is, of course, not supported, since it's deprecated.
-- support the blksize option (RFC2348).
+- support the blksize option (RFC2348), the timeout and tsize options
+  (RFC2349) and the windowsize option (RFC7440). The tsize option is only
+  answered if the size of the file object can be known.
 - use zero-based wraparound when transferring files taking more than
   65535 blocks to transfer.
-- it's not using an adaptive timeout.
-- although it would be theorically possible to run the TFTP service on
-  a different datagram service than UDP, currently it is not because
-  of a hard-coded call to reactor.listenUDP in the code after a request
-  is accepted.
+- use an adaptive timeout (see provd.servers.tftp.rtt), unless the client
+  asks for a fixed one with the timeout option.
+- transfers are run by a transfer engine, either listening on a new UDP
+  port for every transfer or multiplexing every transfer over a small pool
+  of UDP ports (see provd.servers.tftp.engine).
 
 """
 
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""In-memory cache of the DATA datagrams of the files served by TFTP.
+
+When many devices fetch the same file, for example a firmware image, the
+DATA datagrams of the file are built once per blksize and kept in memory, so
+that the next transfers of the file send the same datagrams without reading
+the file again.
+
+The file is never read at once: the datagrams of a file that is not cached
+are recorded while the file is read by a transfer, one block at a time, and
+are added to the cache once the whole file has been read.
+
+The cached datagrams of a file are identified by the path of the file, its
+version, i.e. its modification time, size and inode number, and the
+blksize. The cache is bounded by a memory budget,
+the least recently used files being evicted first.
+
+"""
+
+import errno
+import logging
+import os
+import struct
+from collections import OrderedDict
+from provd.servers.tftp.packet import OP_DATA
+
+logger = logging.getLogger(__name__)
+
+_UINT16_STRUCT = struct.Struct('!H')
+
+
+def _build_data_dgram(blk_no, buf):
+    return OP_DATA + _UINT16_STRUCT.pack(blk_no % 65536) + buf
+
+
+def build_data_dgrams(fobj, blksize):
+    """Return the list of the DATA datagrams of the content of fobj."""
+    dgrams = []
+    while True:
+        buf = fobj.read(blksize)
+        dgrams.append(_build_data_dgram(len(dgrams) + 1, buf))
+        if len(buf) != blksize:
+            return dgrams
+
+
+def file_version(stat_result):
+    """Return the version of a file from its stat result, which changes when
+    the file is modified or replaced.
+
+    """
+    return stat_result.st_mtime, stat_result.st_size, stat_result.st_ino
+
+
+class BlockCache(object):
+    """A cache of the DATA datagrams of files, using at most max_size bytes
+    of datagrams. A max_size of 0 disables the cache.
+
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (path, version, blksize) -> dgrams, least recently used first
+        self._entries = OrderedDict()
+        # path -> (version, set of blksizes) of the cached datagrams
+        self._paths = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self._evict(0)
+
+    def contains(self, path, version):
+        """Return true if some datagrams of this version of the file are
+        cached, whatever their blksize.
+
+        """
+        path_entry = self._paths.get(path)
+        return path_entry is not None and path_entry[0] == version
+
+    def _remove(self, key):
+        path, version, blksize = key
+        self.size -= _dgrams_size(self._entries.pop(key))
+        blksizes = self._paths[path][1]
+        blksizes.discard(blksize)
+        if not blksizes:
+            del self._paths[path]
+
+    def _evict(self, needed_size):
+        while self._entries and self.size + needed_size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _add(self, key, dgrams):
+        path, version, blksize = key
+        if key in self._entries:
+            # already added by another transfer of the file
+            return
+        path_entry = self._paths.get(path)
+        if path_entry is not None and path_entry[0] != version:
+            # the file has been modified, remove the datagrams of the
+            # previous version
+            for old_blksize in list(path_entry[1]):
+                self._remove((path, path_entry[0], old_blksize))
+        dgrams_size = _dgrams_size(dgrams)
+        self._evict(dgrams_size)
+        self._entries[key] = dgrams
+        self._paths.setdefault(path, (version, set()))[1].add(blksize)
+        self.size += dgrams_size
+
+    def get_dgrams(self, path, version, blksize):
+        """Return the list of the DATA datagrams of the file, or None if
+        they are not cached.
+
+        version is the version of the file (see file_version).
+
+        """
+        key = (path, version, blksize)
+        dgrams = self._entries.pop(key, None)
+        if dgrams is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = dgrams
+        return dgrams
+
+    def fits(self, size, blksize):
+        """Return true if the datagrams of a file of the given size fit in
+        the cache.
+
+        """
+        # size of the data plus the 4-byte header of every datagram
+        return size + 4 * (size // blksize + 1) <= self.max_size
+
+    def add_dgrams(self, path, version, blksize, dgrams):
+        """Add the list of the DATA datagrams of the file, if they fit in
+        the cache.
+
+        """
+        if _dgrams_size(dgrams) > self.max_size:
+            return
+        self._add((path, version, blksize), dgrams)
+
+    def stats(self):
+        return {
+            u'entries': len(self._entries),
+            u'size': self.size,
+            u'max_size': self.max_size,
+            u'hits': self.hits,
+            u'misses': self.misses,
+        }
+
+
+def _dgrams_size(dgrams):
+    return sum(len(dgram) for dgram in dgrams)
+
+
+# shared by every TFTP file service
+block_cache = BlockCache()
+
+
+class CachedFile(object):
+    """A file object of a file which DATA datagrams can be taken from a block
+    cache.
+
+    The file is only opened if it's read, or if its datagrams are not in the
+    cache. An EnvironmentError is raised if the file has been removed or
+    modified since stat_result was taken when it's opened.
+
+    If the datagrams are not in the cache, the DATA datagrams of the blocks
+    read are recorded and added to the cache once the last block has been
+    read, as long as the file is read sequentially from its beginning, one
+    block at a time.
+
+    """
+
+    def __init__(self, cache, path, stat_result, fobj=None):
+        self._cache = cache
+        self._path = path
+        self._version = file_version(stat_result)
+        self._size = stat_result.st_size
+        self._fobj = fobj
+        self._pos = 0
+        # (blksize, list of the DATA datagrams of the blocks read so far)
+        self._recording = None
+        self.closed = False
+
+    def _open(self):
+        if self._fobj is None:
+            fobj = open(self._path, 'rb')
+            if file_version(os.fstat(fobj.fileno())) != self._version:
+                fobj.close()
+                raise IOError(errno.ESTALE, 'File modified since requested', self._path)
+            fobj.seek(self._pos)
+            self._fobj = fobj
+        return self._fobj
+
+    def data_dgrams(self, blksize):
+        """Return the list of the DATA datagrams of the whole file, or None
+        if they are not available.
+
+        """
+        if self._pos != 0:
+            return None
+        dgrams = self._cache.get_dgrams(self._path, self._version, blksize)
+        if dgrams is None:
+            if self._cache.fits(self._size, blksize):
+                self._recording = blksize, []
+            elif self._cache.enabled:
+                logger.debug('Not caching the datagrams of %s: bigger than the cache', self._path)
+        return dgrams
+
+    def read(self, n=-1):
+        buf = self._open().read(n)
+        self._pos += len(buf)
+        if self._recording is not None:
+            self._record(n, buf)
+        return buf
+
+    def _record(self, n, buf):
+        blksize, dgrams = self._recording
+        if n != blksize:
+            self._recording = None
+            return
+        dgrams.append(_build_data_dgram(len(dgrams) + 1, buf))
+        if len(buf) != blksize:
+            self._recording = None
+            self._cache.add_dgrams(self._path, self._version, blksize, dgrams)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        self._recording = None
+        if self._fobj is not None:
+            self._fobj.seek(offset)
+
+    def close(self):
+        self.closed = True
+        if self._fobj is not None:
+            self._fobj.close()
@@ -5,10 +5,10 @@
 """Manage the transfer between two host."""
 
 
-# TODO RFC1122 says we must use an adaptive timeout...
-
+import errno
 import struct
 import logging
+from provd.metrics import Histogram
 from provd.servers.tftp.packet import *
 from twisted.internet import reactor
 from twisted.internet.protocol import DatagramProtocol
@@ -31,26 +31,71 @@ def _unpack_to_uint16(string):
     return _UINT16_STRUCT.unpack(string)[0]
 
 
+RETRANSMISSIONS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class TransferStats(object):
+    """Counters of the TFTP transfers."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.started = 0
+        self.completed = 0
+        self.retries = 0
+        self.timeouts = 0
+        # number of datagrams retransmitted per transfer
+        self.retransmissions = Histogram(RETRANSMISSIONS_BUCKETS)
+
+
+# shared by every connection
+transfer_stats = TransferStats()
+
+
 class _AbstractConnection(DatagramProtocol):
     """Represent a connection from the point of view of the server.
     
     The '_blk_no' instance attribute MUST be supplied in derived class.
     This value should be equal to the first value of the block number field.
     This value should be modified by the derived class such that it always
-    reflect the block number we are waiting in the next ACK packet.
+    reflect the block number of the last datagram returned by _next_dgram.
     
     The '_next_dgram' method MUST be overridden in derived class. It should
     return the next datagram to send to the client. This is usually a DATA
-    packet, but it could also be an OACK packet.
+    packet, but it could also be an OACK packet, which is always sent in a
+    window of its own.
+    
+    Up to 'windowsize' datagrams are sent before waiting for an ACK (see
+    RFC 7440). When the client acknowledges a block of the window, the next
+    window starts right after this block, so the unacknowledged datagrams of
+    the window are sent again. With the default windowsize of 1, this is the
+    lock-step transfer of RFC 1350.
     
     The '_close' method MAY be overridden in derived class. It will be called
     once after the connection is closed, in any circumstances.
     
+    The 'call_later' instance attribute is the function used to schedule the
+    retransmissions, with the same signature as reactor.callLater. It MAY be
+    replaced before the connection is started, for example by a transfer
+    engine using a timer wheel. The 'seconds' instance attribute is the
+    function returning the current time.
+    
+    The 'rto_estimator' instance attribute MAY be set to an RTO estimator
+    (see provd.servers.tftp.rtt) before the connection is started, in which
+    case the retransmission timeout adapts to the measured round-trip times
+    and doubles every time it expires. Otherwise, the timeout is always
+    'timeout' seconds. In both cases, the connection is closed once it has
+    waited 'max_retries' * 'timeout' seconds without any progress.
+    
+    The 'retransmissions' instance attribute is the number of datagrams
+    that have been sent again.
+    
     """
 
     blksize = 512
     timeout = 4
     max_retries = 4
+    windowsize = 1
+    rto_estimator = None
 
     def __init__(self, addr):
         """Create a new connection with a remote host.
@@ -59,12 +104,24 @@ class _AbstractConnection(DatagramProtocol):
         
         """
         self._addr = addr
+        self._started = False
         self._closed = False
         self._dup_ack = False
-        self._last_dgram = None
+        # list of (blk_no, dgram) sent but not yet acknowledged
+        self._window = []
+        self._no_more_dgram = False
         self._last_blk_no = None
         self._retry_cnt = 0
+        # seconds waited without any progress
+        self._stall_time = 0
+        # time at which the window has been sent, or None if it has been sent
+        # again, since the round-trip time of a retransmitted datagram is
+        # ambiguous (Karn's algorithm)
+        self._rtt_start_time = None
         self._timeout_timer = None
+        self.call_later = reactor.callLater
+        self.seconds = reactor.seconds
+        self.retransmissions = 0
 
     def _close(self):
         """Close this connection.
@@ -87,41 +144,82 @@ class _AbstractConnection(DatagramProtocol):
             self._cancel_timeout()
             self._close()
             self._closed = True
-            self.transport.stopListening()
+            if self._started:
+                transfer_stats.in_flight -= 1
+                transfer_stats.retransmissions.observe(self.retransmissions)
+                if self.rto_estimator is not None:
+                    self.rto_estimator.finish()
+                logger.debug('TFTP transfer to %s closed after %s retransmissions',
+                             self._addr, self.retransmissions)
+            # the transport is None if the connection is closed because the
+            # port has been stopped
+            if self.transport is not None:
+                self.transport.stopListening()
 
     def _cancel_timeout(self):
         if self._timeout_timer:
             self._retry_cnt = 0
+            self._stall_time = 0
             self._timeout_timer.cancel()
             self._timeout_timer = None
 
+    def _current_timeout(self):
+        if self.rto_estimator is None:
+            return self.timeout
+        return self.rto_estimator.rto
+
     def _set_timeout(self):
-        self._timeout_timer = reactor.callLater(self.timeout, self._timeout_expired)
+        self._timeout_timer = self.call_later(self._current_timeout(), self._timeout_expired)
 
     def _timeout_expired(self):
         logger.info('Timeout has expired with current retry count %s', self._retry_cnt)
         self._timeout_timer = None
         self._retry_cnt += 1
-        if self._retry_cnt >= self.max_retries:
+        self._stall_time += self._current_timeout()
+        if self._stall_time >= self.max_retries * self.timeout:
+            transfer_stats.timeouts += 1
             self.__do_close()
         else:
-            self._send_last_dgram()
-
-    def _send_dgram(self, dgram):
-        self.transport.write(dgram, self._addr)
-        self._set_timeout()
-
-    def _send_next_dgram(self):
-        try:
-            dgram = self._next_dgram()
-        except _NoMoreDatagramError:
-            self.__do_close()
+            transfer_stats.retries += 1
+            if self.rto_estimator is not None:
+                self.rto_estimator.backoff()
+            self._send_window()
+
+    def _send_window(self):
+        """Send again the datagrams of the window, then fill the window with
+        new datagrams.
+        
+        """
+        if self._window:
+            self._rtt_start_time = None
+            for _, dgram in self._window:
+                self.transport.write(dgram, self._addr)
+            self.retransmissions += len(self._window)
         else:
-            self._send_dgram(dgram)
-            self._last_dgram = dgram
-
-    def _send_last_dgram(self):
-        self._send_dgram(self._last_dgram)
+            self._rtt_start_time = self.seconds()
+        self._fill_window()
+
+    def _fill_window(self):
+        window = self._window
+        while not self._no_more_dgram and len(window) < self.windowsize:
+            if window and window[0][1][:2] == OP_OACK:
+                break
+            try:
+                dgram = self._next_dgram()
+            except _NoMoreDatagramError:
+                self._no_more_dgram = True
+            except EnvironmentError as e:
+                logger.warning('Error while reading the transferred file: %s', e)
+                self._handle_file_error(e)
+                return
+            else:
+                window.append((self._blk_no, dgram))
+                self.transport.write(dgram, self._addr)
+        if window:
+            self._set_timeout()
+        else:
+            transfer_stats.completed += 1
+            self.__do_close()
 
     def _handle_wrong_tid(self, addr):
         dgram = build_dgram(err_packet(ERR_UNKNWN_TID, 'Unknown TID'))
@@ -138,20 +236,37 @@ class _AbstractConnection(DatagramProtocol):
         self.transport.write(dgram, self._addr)
         self.__do_close()
 
+    def _handle_file_error(self, e):
+        """Called when the content to transfer could not be read."""
+        if e.errno == errno.ENOENT:
+            dgram = build_dgram(err_packet(ERR_FNF, 'File not found'))
+        else:
+            dgram = build_dgram(err_packet(ERR_UNDEF, 'Error while reading file'))
+        self.transport.write(dgram, self._addr)
+        self.__do_close()
+
     def _handle_ack(self, pkt):
         blk_no = _unpack_to_uint16(pkt['blkno'])
-        if blk_no == self._blk_no:
+        window = self._window
+        # position of the acknowledged block in the window, taking the block
+        # number rollover into account
+        offset = (blk_no - window[0][0]) % 65536 if window else None
+        if offset is not None and offset < len(window):
+            if self._rtt_start_time is not None and self.rto_estimator is not None:
+                self.rto_estimator.sample(self.seconds() - self._rtt_start_time)
             self._last_blk_no = blk_no
             self._dup_ack = False
             self._cancel_timeout()
-            self._send_next_dgram()
+            del window[:offset + 1]
+            self._send_window()
         elif blk_no == self._last_blk_no:
             if not self._dup_ack:
                 self._dup_ack = True
                 self._cancel_timeout()
-                self._send_last_dgram()
+                self._send_window()
         else:
-            self._handle_illegal_pkt('Illegal block number')
+            # reordered or stale ACKs are ignored (see RFC 7440)
+            logger.debug('Ignoring ACK of block %s outside of the window', blk_no)
 
     def datagramReceived(self, dgram, addr):
         if not self._closed:
@@ -175,34 +290,53 @@ class _AbstractConnection(DatagramProtocol):
                         self._handle_illegal_pkt()
 
     def startProtocol(self):
-        self._send_next_dgram()
+        self._started = True
+        transfer_stats.started += 1
+        transfer_stats.in_flight += 1
+        self._send_window()
 
     def stopProtocol(self):
         self.__do_close()
 
 
-class RFC1350Connection(_AbstractConnection):
+class _FileConnection(_AbstractConnection):
+    """A connection transmitting the content of a file object.
+    
+    If the file object has a 'data_dgrams' method (see
+    provd.servers.tftp.blockcache), the DATA datagrams it returns are sent
+    instead of reading the file.
+    
+    """
+
     def __init__(self, addr, fobj):
-        """Create a new RFC1350 connection.
-        
-        addr -- the address of the remote host.
-        fobj -- a file-object that is going to be transmitted. This object will call its close method.
-         
-        """
         _AbstractConnection.__init__(self, addr)
         self._fobj = fobj
-        self._blk_no = 0
         self._last_buf = None
+        self._data_dgrams = None
+        self._data_dgram_idx = 0
 
     def _close(self):
         self._fobj.close()
 
-    def _next_dgram(self):
+    def _next_data_dgram(self):
+        if self._data_dgrams is None and self._last_buf is None:
+            data_dgrams = getattr(self._fobj, 'data_dgrams', None)
+            if data_dgrams is not None:
+                self._data_dgrams = data_dgrams(self.blksize)
+        if self._data_dgrams is not None:
+            if self._data_dgram_idx == len(self._data_dgrams):
+                raise _NoMoreDatagramError()
+            dgram = self._data_dgrams[self._data_dgram_idx]
+            self._data_dgram_idx += 1
+            self._blk_no = (self._blk_no + 1) % 65536
+            return dgram
+
         buf = self._fobj.read(self.blksize)
-        if not buf and self._blk_no != 0 and len(self._last_buf) != self.blksize:
+        if not buf and self._last_buf is not None and len(self._last_buf) != self.blksize:
             # no more datagram if:
             # - there's no more content to be read from the file (not buf)
-            # - at least one datagram has been sent (self._blk_no != 0)
+            # - at least one datagram has been sent (self._last_buf is not None,
+            #   since the block number wraps around to 0)
             # - the last block we sent was not the size of blksize
             raise _NoMoreDatagramError()
         else:
@@ -212,7 +346,22 @@ class RFC1350Connection(_AbstractConnection):
             return dgram
 
 
-class RFC2347Connection(_AbstractConnection):
+class RFC1350Connection(_FileConnection):
+    def __init__(self, addr, fobj):
+        """Create a new RFC1350 connection.
+        
+        addr -- the address of the remote host.
+        fobj -- a file-object that is going to be transmitted. This object will call its close method.
+         
+        """
+        _FileConnection.__init__(self, addr, fobj)
+        self._blk_no = 0
+
+    def _next_dgram(self):
+        return self._next_data_dgram()
+
+
+class RFC2347Connection(_FileConnection):
     def __init__(self, addr, fobj, oack_dgram):
         """Create a new RFC2347 connection.
         
@@ -221,29 +370,13 @@ class RFC2347Connection(_AbstractConnection):
         oack_dgram -- an option acknowledgement datagram
         
         """
-        _AbstractConnection.__init__(self, addr)
-        self._fobj = fobj
+        _FileConnection.__init__(self, addr, fobj)
         self._oack_dgram = oack_dgram
         self._blk_no = -1
-        self._last_buf = None
-
-    def _close(self):
-        self._fobj.close()
 
     def _next_dgram(self):
         if self._blk_no == -1:
             self._blk_no += 1
             return self._oack_dgram
         else:
-            buf = self._fobj.read(self.blksize)
-            if not buf and self._blk_no != 0 and len(self._last_buf) != self.blksize:
-                # no more datagram if:
-                # - there's no more content to be read from the file (not buf)
-                # - at least one datagram has been sent (self._blk_no != 0)
-                # - the last block we sent was not the size of blksize
-                raise _NoMoreDatagramError()
-            else:
-                self._last_buf = buf
-                self._blk_no = (self._blk_no + 1) % 65536
-                dgram = build_dgram(data_packet(_pack_from_uint16(self._blk_no), buf))
-                return dgram
+            return self._next_data_dgram()
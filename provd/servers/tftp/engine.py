@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Transfer engines.
+
+A transfer engine runs the connections (see provd.servers.tftp.connection)
+used to send the files of the accepted read requests to the clients.
+
+The default engine listens on a new UDP port for every transfer. The
+multiplexed engine runs every transfer over a small pool of UDP ports bound
+once, dispatching the received datagrams to the connections by client
+address, and schedules the retransmissions of every connection on a shared
+timer wheel.
+
+"""
+
+import heapq
+import logging
+import math
+from provd.servers.tftp.packet import build_dgram, err_packet, ERR_UNKNWN_TID
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import DatagramProtocol
+
+logger = logging.getLogger(__name__)
+
+
+class TransferError(Exception):
+    """Raised when a transfer can't be started."""
+    pass
+
+
+class DefaultTransferEngine(object):
+    """Engine listening on a new UDP port for every transfer."""
+
+    def __init__(self, reactor=reactor):
+        self._reactor = reactor
+
+    def start(self):
+        pass
+
+    def stop(self):
+        return defer.succeed(None)
+
+    def start_transfer(self, addr, connection):
+        self._reactor.listenUDP(0, connection)
+
+
+class _WheelTimer(object):
+
+    __slots__ = ['_wheel', 'tick', 'fun', 'args', 'called', 'cancelled']
+
+    def __init__(self, wheel, tick, fun, args):
+        self._wheel = wheel
+        self.tick = tick
+        self.fun = fun
+        self.args = args
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self._wheel._remove(self)
+
+
+class TimerWheel(object):
+    """Schedule delayed calls with a fixed resolution, using a single
+    delayed call of the reactor for all of them.
+
+    The call_later method has the same signature as the one of the reactor,
+    and returns an object with a cancel and an active method.
+
+    """
+
+    def __init__(self, resolution=0.1, clock=reactor):
+        self._resolution = resolution
+        self._clock = clock
+        # map tick to the set of timers expiring at this tick
+        self._slots = {}
+        # heap of the ticks having a slot
+        self._ticks = []
+        self._delayed_call = None
+        self._delayed_call_tick = None
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots.itervalues())
+
+    def call_later(self, delay, fun, *args):
+        tick = int(math.ceil((self._clock.seconds() + delay) / self._resolution))
+        timer = _WheelTimer(self, tick, fun, args)
+        slot = self._slots.get(tick)
+        if slot is None:
+            slot = self._slots[tick] = set()
+            heapq.heappush(self._ticks, tick)
+        slot.add(timer)
+        if self._delayed_call_tick is None or tick < self._delayed_call_tick:
+            self._schedule(tick)
+        return timer
+
+    def _remove(self, timer):
+        slot = self._slots.get(timer.tick)
+        if slot is not None:
+            slot.discard(timer)
+            if not slot:
+                # the tick is left in the heap, and skipped when it expires
+                del self._slots[timer.tick]
+
+    def _schedule(self, tick):
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+        delay = max(0, tick * self._resolution - self._clock.seconds())
+        self._delayed_call = self._clock.callLater(delay, self._on_tick)
+        self._delayed_call_tick = tick
+
+    def _on_tick(self):
+        self._delayed_call = None
+        self._delayed_call_tick = None
+        now_tick = int(math.floor(self._clock.seconds() / self._resolution + 1e-9))
+        expired_timers = []
+        while self._ticks and self._ticks[0] <= now_tick:
+            tick = heapq.heappop(self._ticks)
+            expired_timers.extend(self._slots.pop(tick, ()))
+        for timer in expired_timers:
+            # a timer might have been cancelled by a previous timer
+            if timer.cancelled:
+                continue
+            timer.called = True
+            try:
+                timer.fun(*timer.args)
+            except Exception:
+                logger.error('Error in timer function %s', timer.fun, exc_info=True)
+        # timers might have been added by the timer functions
+        if self._ticks and self._delayed_call_tick != self._ticks[0]:
+            self._schedule(self._ticks[0])
+
+    def stop(self):
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+            self._delayed_call_tick = None
+
+
+class _MultiplexedTransport(object):
+    # The transport of a connection, writing on the pool port the connection
+    # has been assigned to.
+
+    def __init__(self, pool_port, addr):
+        self._pool_port = pool_port
+        self._addr = addr
+
+    def write(self, dgram, addr):
+        self._pool_port.transport.write(dgram, addr)
+
+    def getHost(self):
+        return self._pool_port.transport.getHost()
+
+    def stopListening(self):
+        self._pool_port.remove_connection(self._addr)
+
+
+class _PoolPort(DatagramProtocol):
+    # A UDP port of the pool, dispatching the received datagrams to the
+    # connections by client address.
+
+    def __init__(self):
+        self.connections = {}
+
+    def add_connection(self, addr, connection):
+        self.connections[addr] = connection
+        connection.makeConnection(_MultiplexedTransport(self, addr))
+
+    def remove_connection(self, addr):
+        connection = self.connections.pop(addr, None)
+        if connection is not None:
+            connection.doStop()
+
+    def datagramReceived(self, dgram, addr):
+        connection = self.connections.get(addr)
+        if connection is None:
+            logger.info('Datagram received with wrong TID')
+            self.transport.write(build_dgram(err_packet(ERR_UNKNWN_TID, 'Unknown TID')), addr)
+        else:
+            connection.datagramReceived(dgram, addr)
+
+    def stopProtocol(self):
+        for addr in self.connections.keys():
+            self.remove_connection(addr)
+
+
+class MultiplexedTransferEngine(object):
+    """Engine running every transfer over a pool of UDP ports.
+
+    Each transfer is assigned to the pool port with the fewest transfers
+    that is not already used by a transfer with the same client address.
+
+    """
+
+    def __init__(self, nb_ports=4, interface='', reactor=reactor, timer_wheel=None):
+        if nb_ports < 1:
+            raise ValueError('invalid number of ports: %s' % nb_ports)
+        if timer_wheel is None:
+            timer_wheel = TimerWheel(clock=reactor)
+        self._nb_ports = nb_ports
+        self._interface = interface
+        self._reactor = reactor
+        self._timer_wheel = timer_wheel
+        self._pool_ports = []
+        self._listening_ports = []
+
+    def start(self):
+        for _ in xrange(self._nb_ports):
+            pool_port = _PoolPort()
+            listening_port = self._reactor.listenUDP(0, pool_port, interface=self._interface)
+            self._pool_ports.append(pool_port)
+            self._listening_ports.append(listening_port)
+        logger.info('Running TFTP transfers over ports %s',
+                    ', '.join(str(port.getHost().port) for port in self._listening_ports))
+
+    def stop(self):
+        self._timer_wheel.stop()
+        dlist = [defer.maybeDeferred(port.stopListening) for port in self._listening_ports]
+        self._pool_ports = []
+        self._listening_ports = []
+        return defer.DeferredList(dlist)
+
+    def nb_transfers(self):
+        return sum(len(pool_port.connections) for pool_port in self._pool_ports)
+
+    def start_transfer(self, addr, connection):
+        candidates = [pool_port for pool_port in self._pool_ports
+                      if addr not in pool_port.connections]
+        if not candidates:
+            raise TransferError('no pool port available for %s' % (addr,))
+        pool_port = min(candidates, key=lambda pool_port: len(pool_port.connections))
+        connection.call_later = self._timer_wheel.call_later
+        connection.seconds = self._reactor.seconds
+        pool_port.add_connection(addr, connection)
+
+
+def new_transfer_engine(type, nb_ports=4):
+    """Return a new transfer engine of the given type, either 'default' or
+    'multiplexed'.
+
+    """
+    if type == 'default':
+        return DefaultTransferEngine()
+    elif type == 'multiplexed':
+        return MultiplexedTransferEngine(nb_ports)
+    else:
+        raise ValueError('unknown TFTP engine type %r' % type)
@@ -42,8 +42,44 @@ def _parse_option_blksize(string):
         return blksize
 
 
+def _parse_option_windowsize(string):
+    try:
+        windowsize = int(string)
+    except ValueError:
+        raise PacketError('invalid windowsize value - not a number')
+    else:
+        if windowsize < 1 or windowsize > 65535:
+            raise PacketError('invalid windowsize value - out of range')
+        return windowsize
+
+
+def _parse_option_timeout(string):
+    try:
+        timeout = int(string)
+    except ValueError:
+        raise PacketError('invalid timeout value - not a number')
+    else:
+        if timeout < 1 or timeout > 255:
+            raise PacketError('invalid timeout value - out of range')
+        return timeout
+
+
+def _parse_option_tsize(string):
+    try:
+        tsize = int(string)
+    except ValueError:
+        raise PacketError('invalid tsize value - not a number')
+    else:
+        if tsize < 0:
+            raise PacketError('invalid tsize value - out of range')
+        return tsize
+
+
 _PARSE_OPT_MAP = {
     'blksize': _parse_option_blksize,
+    'timeout': _parse_option_timeout,
+    'tsize': _parse_option_tsize,
+    'windowsize': _parse_option_windowsize,
 }
 
 def _parse_request(dgram):
@@ -3,14 +3,33 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
+import os
 from provd.servers.tftp.connection import RFC2347Connection, RFC1350Connection
+from provd.servers.tftp.engine import DefaultTransferEngine, TransferError
 from provd.servers.tftp.packet import *
-from twisted.internet import reactor
+from provd.servers.tftp.rtt import SubnetRTTCache
 from twisted.internet.protocol import DatagramProtocol
 
 logger = logging.getLogger(__name__)
 
 
+def _file_size(fobj):
+    # Return the number of bytes left to be read from the file object, or
+    # None if it can't be known.
+    try:
+        return os.fstat(fobj.fileno()).st_size - fobj.tell()
+    except (AttributeError, EnvironmentError, ValueError):
+        pass
+    try:
+        pos = fobj.tell()
+        fobj.seek(0, os.SEEK_END)
+        size = fobj.tell()
+        fobj.seek(pos)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    return size - pos
+
+
 class _Response(object):
     def __init__(self, freject, faccept):
         self._answered = False
@@ -36,12 +55,44 @@ class _Response(object):
 
 
 class TFTPProtocol(DatagramProtocol):
-    def __init__(self):
+    # the highest windowsize accepted when negotiating the windowsize option
+    # (see RFC 7440); a client requesting a bigger one is answered with this
+    # value
+    max_windowsize = 64
+
+    def __init__(self, engine=None, rtt_cache=None):
+        # engine is the transfer engine used to run the connections of the
+        # accepted requests, and rtt_cache the subnet RTT cache used to
+        # create the RTO estimator of the connections
         self._service = None
+        self._engine = DefaultTransferEngine() if engine is None else engine
+        if rtt_cache is None:
+            rtt_cache = SubnetRTTCache(RFC1350Connection.timeout)
+        self._rtt_cache = rtt_cache
 
     def set_tftp_request_processing_service(self, tftp_request_processing_service):
         self._service = tftp_request_processing_service
 
+    def _negotiate_options(self, options, fobj):
+        # Return a tuple (oack_options, connection_attrs), where oack_options
+        # are the options of the OACK packet and connection_attrs are the
+        # attributes to set on the connection.
+        connection_attrs = {}
+        if 'blksize' in options:
+            connection_attrs['blksize'] = options['blksize']
+        if 'timeout' in options:
+            connection_attrs['timeout'] = options['timeout']
+        if 'windowsize' in options:
+            connection_attrs['windowsize'] = min(options['windowsize'], self.max_windowsize)
+        oack_options = dict((name, str(value)) for name, value in connection_attrs.iteritems())
+        if 'tsize' in options:
+            tsize = _file_size(fobj)
+            if tsize is None:
+                logger.debug('Ignoring TFTP tsize option: unknown file size')
+            else:
+                oack_options['tsize'] = str(tsize)
+        return oack_options, connection_attrs
+
     def _handle_rrq(self, pkt, addr):
         if self._service is None:
             dgram = build_dgram(err_packet(ERR_UNDEF, 'service unavailable'))
@@ -61,15 +112,25 @@ class TFTPProtocol(DatagramProtocol):
                 self.transport.write(build_dgram(err_packet(errcode, errmsg)), addr)
             def on_accept(fobj):
                 logger.info('TFTP read request accepted')
-                if 'blksize' in pkt['options']:
-                    blksize = pkt['options']['blksize']
-                    logger.debug('Using TFTP blksize of %s', blksize)
-                    oack_dgram = build_dgram(oack_packet({'blksize': str(blksize)}))
+                oack_options, connection_attrs = self._negotiate_options(pkt['options'], fobj)
+                if oack_options:
+                    logger.debug('Using TFTP options %s', oack_options)
+                    oack_dgram = build_dgram(oack_packet(oack_options))
                     connection = RFC2347Connection(addr, fobj, oack_dgram)
-                    connection.blksize = blksize
+                    for name, value in connection_attrs.iteritems():
+                        setattr(connection, name, value)
                 else:
                     connection = RFC1350Connection(addr, fobj)
-                reactor.listenUDP(0, connection)
+                if 'timeout' not in connection_attrs:
+                    # the retransmission timeout is only adaptive if the
+                    # client has not asked for a fixed one
+                    connection.rto_estimator = self._rtt_cache.new_estimator(addr[0])
+                try:
+                    self._engine.start_transfer(addr, connection)
+                except TransferError as e:
+                    logger.warning('Could not start TFTP transfer: %s', e)
+                    fobj.close()
+                    self.transport.write(build_dgram(err_packet(ERR_UNDEF, 'server busy')), addr)
             request = {'address': addr, 'packet': pkt}
             response = _Response(on_reject, on_accept)
             self._service.handle_read_request(request, response)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Adaptive retransmission timeout of the TFTP connections.
+
+The retransmission timeout (RTO) of a connection is computed from the
+smoothed round-trip time (SRTT) and the round-trip time variation (RTTVAR)
+as described in RFC 6298. Round-trip times are not measured on retransmitted
+datagrams (Karn's algorithm) and the RTO is doubled every time it expires.
+
+The SRTT and RTTVAR of the finished transfers are remembered per subnet, so
+that the next transfers from the same subnet start with a learned RTO
+instead of the default one.
+
+"""
+
+import socket
+import struct
+from collections import OrderedDict
+
+# gains of the SRTT and RTTVAR (see RFC 6298)
+_ALPHA = 0.125
+_BETA = 0.25
+_K = 4
+# weight of the SRTT and RTTVAR of a finished transfer in the learned values
+# of its subnet
+_SUBNET_GAIN = 0.25
+
+
+class RTOEstimator(object):
+    """Estimate the retransmission timeout of a connection.
+
+    The rto attribute is the current retransmission timeout, in seconds.
+
+    """
+
+    # RFC 6298 recommends a minimum RTO of 1 second, which also avoids
+    # spurious retransmissions when devices are slow to ACK
+    min_rto = 1.0
+    max_rto = 16.0
+
+    def __init__(self, rto, srtt=None, rttvar=None, on_finish=None):
+        """
+        rto -- the initial RTO, used until a round-trip time is measured
+        srtt, rttvar -- the learned SRTT and RTTVAR, if any
+        on_finish -- a callable object taking the estimator as argument,
+          called by the finish method if a round-trip time has been measured
+
+        """
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.nb_samples = 0
+        self._on_finish = on_finish
+        if srtt is None:
+            self.rto = rto
+        else:
+            self._update_rto()
+
+    def _update_rto(self):
+        rto = self.srtt + _K * self.rttvar
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    def sample(self, rtt):
+        """Update the RTO with a round-trip time measured on a datagram
+        that has not been retransmitted.
+
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - _BETA) * self.rttvar + _BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - _ALPHA) * self.srtt + _ALPHA * rtt
+        self.nb_samples += 1
+        self._update_rto()
+
+    def backoff(self):
+        """Double the RTO, after it has expired."""
+        self.rto = min(self.rto * 2, self.max_rto)
+
+    def finish(self):
+        if self._on_finish is not None and self.nb_samples:
+            self._on_finish(self)
+
+
+def _subnet_of(ip, prefix_len):
+    mask = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0] & mask
+    except socket.error:
+        return ip
+
+
+class SubnetRTTCache(object):
+    """Remember the SRTT and RTTVAR of the finished transfers per subnet,
+    keeping at most max_entries subnets.
+
+    """
+
+    def __init__(self, default_rto, prefix_len=24, max_entries=1024):
+        self._default_rto = default_rto
+        self._prefix_len = prefix_len
+        self._max_entries = max_entries
+        # subnet -> (srtt, rttvar), least recently updated first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, ip):
+        """Return the learned (srtt, rttvar) tuple of the subnet of ip, or
+        None.
+
+        """
+        return self._entries.get(_subnet_of(ip, self._prefix_len))
+
+    def update(self, ip, srtt, rttvar):
+        subnet = _subnet_of(ip, self._prefix_len)
+        entry = self._entries.pop(subnet, None)
+        if entry is not None:
+            srtt = (1 - _SUBNET_GAIN) * entry[0] + _SUBNET_GAIN * srtt
+            rttvar = (1 - _SUBNET_GAIN) * entry[1] + _SUBNET_GAIN * rttvar
+        elif len(self._entries) >= self._max_entries:
+            self._entries.popitem(last=False)
+        self._entries[subnet] = (srtt, rttvar)
+
+    def new_estimator(self, ip):
+        """Return a new RTO estimator for a connection with ip, starting
+        with the learned values of its subnet.
+
+        """
+        def on_finish(estimator):
+            self.update(ip, estimator.srtt, estimator.rttvar)
+
+        entry = self.get(ip)
+        if entry is None:
+            return RTOEstimator(self._default_rto, on_finish=on_finish)
+        return RTOEstimator(self._default_rto, entry[0], entry[1], on_finish=on_finish)
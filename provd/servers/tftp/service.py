@@ -7,6 +7,7 @@
 
 import os
 import StringIO
+from provd.servers.tftp import blockcache
 from provd.servers.tftp.packet import ERR_FNF
 from zope.interface import Interface
 
@@ -23,7 +24,9 @@ class ITFTPReadService(Interface):
         
         response is an object with the following methods:
           accept -- call this method with a file-like object you
-            want to transfer if you accept the request.
+            want to transfer if you accept the request. The size of the
+            file, sent to the clients asking for it, is known if the
+            file object has a fileno method or supports seek and tell.
           reject -- call this method with an errcode (2-byte string)
             and an error message if you reject the request. This will
             send an error packet to the client.
@@ -68,10 +71,18 @@ class TFTPFileService(object):
     It also rejects any request that makes reference to the parent directory
     once normalized. For example, a request for filename 'bar/../../foo.txt'
     will be rejected even if 'foo.txt' exist in the parent directory.
+    
+    If the block cache is enabled, the DATA datagrams of the served files
+    are taken from the block cache (see provd.servers.tftp.blockcache), and
+    the files are only opened if their datagrams are not cached. By default,
+    the block cache shared by every file service is used.
       
     """
-    def __init__(self, path):
+    def __init__(self, path, block_cache=None):
         self._path = os.path.abspath(path)
+        if block_cache is None:
+            block_cache = blockcache.block_cache
+        self._block_cache = block_cache
 
     def handle_read_request(self, request, response):
         rq_orig_path = request['packet']['filename']
@@ -79,6 +90,19 @@ class TFTPFileService(object):
         rq_final_path = os.path.normpath(os.path.join(self._path, rq_stripped_path))
         if not rq_final_path.startswith(self._path):
             response.reject(ERR_FNF, 'Invalid filename')
+        elif self._block_cache.enabled:
+            try:
+                stat_result = os.stat(rq_final_path)
+                if self._block_cache.contains(rq_final_path, blockcache.file_version(stat_result)):
+                    fobj = None
+                else:
+                    fobj = open(rq_final_path, 'rb')
+                    stat_result = os.fstat(fobj.fileno())
+            except EnvironmentError:
+                response.reject(ERR_FNF, 'File not found')
+            else:
+                response.accept(blockcache.CachedFile(self._block_cache, rq_final_path,
+                                                      stat_result, fobj))
         else:
             try:
                 fobj = open(rq_final_path, 'rb')
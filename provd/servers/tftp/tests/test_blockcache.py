@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from hamcrest import assert_that, equal_to, has_entries, none, same_instance
+from mock import Mock
+from twisted.internet.task import Clock
+
+from provd.servers.tftp.blockcache import BlockCache, CachedFile, build_data_dgrams
+from provd.servers.tftp.connection import RFC1350Connection
+from provd.servers.tftp.service import TFTPFileService
+
+
+class TestBuildDataDgrams(unittest.TestCase):
+
+    def test_build(self):
+        dgrams = build_data_dgrams(StringIO('abcdefghij'), 4)
+
+        assert_that(dgrams, equal_to(['\x00\x03\x00\x01abcd', '\x00\x03\x00\x02efgh',
+                                      '\x00\x03\x00\x03ij']))
+
+    def test_build_multiple_of_blksize(self):
+        dgrams = build_data_dgrams(StringIO('abcd'), 4)
+
+        assert_that(dgrams, equal_to(['\x00\x03\x00\x01abcd', '\x00\x03\x00\x02']))
+
+    def test_build_empty(self):
+        dgrams = build_data_dgrams(StringIO(''), 4)
+
+        assert_that(dgrams, equal_to(['\x00\x03\x00\x01']))
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = BlockCache(100)
+
+    def _add(self, path, version, content, blksize):
+        self.cache.add_dgrams(path, version, blksize, build_data_dgrams(StringIO(content), blksize))
+
+    def test_get_dgrams_miss_then_hit(self):
+        dgrams = build_data_dgrams(StringIO('x' * 10), 4)
+
+        assert_that(self.cache.get_dgrams('/a', 1.0, 4), none())
+        self.cache.add_dgrams('/a', 1.0, 4, dgrams)
+
+        assert_that(self.cache.get_dgrams('/a', 1.0, 4), same_instance(dgrams))
+        assert_that(self.cache.stats(), has_entries({u'entries': 1, u'size': 22,
+                                                      u'hits': 1, u'misses': 1}))
+
+    def test_get_dgrams_per_blksize(self):
+        self._add('/a', 1.0, 'x' * 10, 4)
+        self._add('/a', 1.0, 'x' * 10, 8)
+
+        assert_that(len(self.cache), equal_to(2))
+        assert_that(self.cache.contains('/a', 1.0))
+
+    def test_add_dgrams_twice(self):
+        dgrams = build_data_dgrams(StringIO('x' * 10), 4)
+        self.cache.add_dgrams('/a', 1.0, 4, dgrams)
+
+        self._add('/a', 1.0, 'x' * 10, 4)
+
+        assert_that(self.cache.get_dgrams('/a', 1.0, 4), same_instance(dgrams))
+        assert_that(self.cache.size, equal_to(22))
+
+    def test_modified_file_replaces_previous_version(self):
+        self._add('/a', 1.0, 'x' * 10, 4)
+        self._add('/a', 1.0, 'x' * 10, 8)
+
+        self._add('/a', 2.0, 'y' * 10, 4)
+
+        assert_that(len(self.cache), equal_to(1))
+        assert_that(self.cache.contains('/a', 1.0), equal_to(False))
+        assert_that(self.cache.contains('/a', 2.0))
+        assert_that(self.cache.size, equal_to(22))
+
+    def test_least_recently_used_evicted(self):
+        self._add('/a', 1.0, 'a' * 40, 40)
+        self._add('/b', 1.0, 'b' * 40, 40)
+        self.cache.get_dgrams('/a', 1.0, 40)
+
+        self._add('/c', 1.0, 'c' * 40, 40)
+
+        assert_that(self.cache.contains('/a', 1.0))
+        assert_that(self.cache.contains('/b', 1.0), equal_to(False))
+        assert_that(self.cache.contains('/c', 1.0))
+        assert_that(self.cache.size, equal_to(96))
+
+    def test_file_bigger_than_cache(self):
+        assert_that(self.cache.fits(200, 4), equal_to(False))
+
+        self._add('/a', 1.0, 'x' * 200, 4)
+
+        assert_that(len(self.cache), equal_to(0))
+
+    def test_disabled(self):
+        cache = BlockCache(0)
+
+        assert_that(cache.fits(0, 4), equal_to(False))
+
+    def test_set_max_size_evicts(self):
+        self._add('/a', 1.0, 'a' * 40, 40)
+
+        self.cache.set_max_size(10)
+
+        assert_that(len(self.cache), equal_to(0))
+        assert_that(self.cache.size, equal_to(0))
+
+
+class TestTFTPFileService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = BlockCache(1024 * 1024)
+        self.service = TFTPFileService(self.tmp_dir, self.cache)
+        with open(os.path.join(self.tmp_dir, 'foo'), 'wb') as fobj:
+            fobj.write('x' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _request(self, filename):
+        response = Mock()
+        self.service.handle_read_request({'packet': {'filename': filename}}, response)
+        return response
+
+    def _transfer(self, fobj, blksize=512):
+        transport = Mock()
+        connection = RFC1350Connection(('10.0.0.1', 1024), fobj)
+        connection.blksize = blksize
+        connection.call_later = Clock().callLater
+        connection.makeConnection(transport)
+        blk_no = 0
+        while not transport.stopListening.called:
+            blk_no += 1
+            connection.datagramReceived('\x00\x04' + chr(blk_no >> 8) + chr(blk_no & 0xff),
+                                        ('10.0.0.1', 1024))
+        return [call_args[0][0] for call_args in transport.write.call_args_list]
+
+    def test_file_not_found(self):
+        response = self._request('bar')
+
+        assert_that(response.reject.called)
+
+    def test_cached_transfer(self):
+        fobj1 = self._request('foo').accept.call_args[0][0]
+        dgrams1 = self._transfer(fobj1)
+        fobj2 = self._request('foo').accept.call_args[0][0]
+        dgrams2 = self._transfer(fobj2)
+        dgrams3 = self._transfer(self._request('foo').accept.call_args[0][0])
+
+        assert_that(dgrams2, equal_to(dgrams1))
+        assert_that(len(dgrams1), equal_to(2))
+        assert_that(dgrams3[0], same_instance(dgrams2[0]))
+        assert_that(fobj2._fobj, none())
+        assert_that(self.cache.stats(), has_entries({u'hits': 2, u'misses': 1}))
+
+    def test_cached_transfer_multiple_of_blksize(self):
+        dgrams1 = self._transfer(self._request('foo').accept.call_args[0][0], blksize=500)
+        dgrams2 = self._transfer(self._request('foo').accept.call_args[0][0], blksize=500)
+
+        assert_that(dgrams2, equal_to(dgrams1))
+        assert_that(dgrams1[2], equal_to('\x00\x03\x00\x03'))
+        assert_that(self.cache.stats(), has_entries({u'hits': 1, u'misses': 1}))
+
+    def test_uncompleted_transfer_not_cached(self):
+        fobj = self._request('foo').accept.call_args[0][0]
+        fobj.data_dgrams(512)
+        fobj.read(512)
+        fobj.close()
+
+        assert_that(len(self.cache), equal_to(0))
+
+    def test_modified_file_with_same_mtime(self):
+        path = os.path.join(self.tmp_dir, 'foo')
+        mtime = os.stat(path).st_mtime
+        self._transfer(self._request('foo').accept.call_args[0][0])
+        with open(path, 'wb') as fobj:
+            fobj.write('y' * 600)
+        os.utime(path, (mtime, mtime))
+
+        dgrams = self._transfer(self._request('foo').accept.call_args[0][0])
+
+        assert_that(dgrams[1], equal_to('\x00\x03\x00\x02' + 'y' * 88))
+        assert_that(self.cache.stats(), has_entries({u'entries': 1, u'hits': 0, u'misses': 2}))
+
+    def test_cached_file_removed_before_transfer(self):
+        self._transfer(self._request('foo').accept.call_args[0][0])
+        fobj = self._request('foo').accept.call_args[0][0]
+        os.remove(os.path.join(self.tmp_dir, 'foo'))
+
+        dgrams = self._transfer(fobj, blksize=100)
+
+        assert_that(dgrams, equal_to(['\x00\x05\x00\x01File not found\x00']))
+
+    def test_cached_transfer_same_as_uncached(self):
+        fobj = self._request('foo').accept.call_args[0][0]
+        uncached_dgrams = self._transfer(open(os.path.join(self.tmp_dir, 'foo'), 'rb'), blksize=100)
+
+        assert_that(self._transfer(fobj, blksize=100), equal_to(uncached_dgrams))
+
+
+class TestCachedFile(unittest.TestCase):
+
+    def test_read_and_size(self):
+        fobj = tempfile.NamedTemporaryFile()
+        fobj.write('abcdef')
+        fobj.flush()
+        cached_file = CachedFile(BlockCache(0), fobj.name, os.stat(fobj.name))
+
+        cached_file.seek(0, os.SEEK_END)
+        assert_that(cached_file.tell(), equal_to(6))
+        cached_file.seek(0)
+        assert_that(cached_file.read(4), equal_to('abcd'))
+        assert_that(cached_file.data_dgrams(4), none())
+        cached_file.close()
+        assert_that(cached_file.closed)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import struct
+import unittest
+from StringIO import StringIO
+
+from hamcrest import assert_that, contains, equal_to
+from twisted.internet.task import Clock
+
+from provd.servers.tftp.connection import RFC1350Connection, RFC2347Connection
+from provd.servers.tftp.packet import build_dgram, oack_packet, parse_dgram, OP_OACK
+from provd.servers.tftp.rtt import RTOEstimator
+
+ADDR = ('10.0.0.1', 1024)
+
+
+def _ack_dgram(blk_no):
+    return '\x00\x04' + struct.pack('!H', blk_no)
+
+
+class _FakeTransport(object):
+
+    def __init__(self):
+        self.written = []
+        self.stopped = False
+
+    def write(self, dgram, addr):
+        if dgram[:2] == OP_OACK:
+            # OACK datagrams can't be parsed
+            self.written.append({'opcode': OP_OACK})
+        else:
+            self.written.append(parse_dgram(dgram))
+
+    def stopListening(self):
+        self.stopped = True
+
+    def pop_blk_nos(self):
+        blk_nos = [struct.unpack('!H', pkt['blkno'])[0] for pkt in self.written]
+        self.written = []
+        return blk_nos
+
+
+class TestConnectionWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = _FakeTransport()
+
+    def _start(self, content, windowsize, blksize=8, rto_estimator=None):
+        connection = RFC1350Connection(ADDR, StringIO(content))
+        connection.blksize = blksize
+        connection.windowsize = windowsize
+        connection.rto_estimator = rto_estimator
+        connection.call_later = self.clock.callLater
+        connection.seconds = self.clock.seconds
+        connection.makeConnection(self.transport)
+        return connection
+
+    def test_lock_step_by_default(self):
+        connection = self._start('x' * 20, 1)
+
+        assert_that(self.transport.pop_blk_nos(), contains(1))
+        connection.datagramReceived(_ack_dgram(1), ADDR)
+        assert_that(self.transport.pop_blk_nos(), contains(2))
+        connection.datagramReceived(_ack_dgram(2), ADDR)
+        assert_that(self.transport.pop_blk_nos(), contains(3))
+        connection.datagramReceived(_ack_dgram(3), ADDR)
+        assert_that(self.transport.stopped)
+
+    def test_sends_a_window_of_blocks(self):
+        connection = self._start('x' * 40, 4)
+
+        assert_that(self.transport.pop_blk_nos(), contains(1, 2, 3, 4))
+        connection.datagramReceived(_ack_dgram(4), ADDR)
+        assert_that(self.transport.pop_blk_nos(), contains(5, 6))
+        connection.datagramReceived(_ack_dgram(6), ADDR)
+        assert_that(self.transport.stopped)
+
+    def test_partial_ack_restarts_window_after_acked_block(self):
+        connection = self._start('x' * 80, 4)
+        self.transport.pop_blk_nos()
+
+        connection.datagramReceived(_ack_dgram(2), ADDR)
+
+        assert_that(self.transport.pop_blk_nos(), contains(3, 4, 5, 6))
+
+    def test_timeout_resends_window(self):
+        connection = self._start('x' * 80, 4)
+        self.transport.pop_blk_nos()
+
+        self.clock.advance(connection.timeout)
+
+        assert_that(self.transport.pop_blk_nos(), contains(1, 2, 3, 4))
+        assert_that(connection.retransmissions, equal_to(4))
+
+    def test_duplicate_ack_resends_window_once(self):
+        connection = self._start('x' * 80, 2)
+        connection.datagramReceived(_ack_dgram(2), ADDR)
+        self.transport.pop_blk_nos()
+
+        connection.datagramReceived(_ack_dgram(2), ADDR)
+        connection.datagramReceived(_ack_dgram(2), ADDR)
+
+        assert_that(self.transport.pop_blk_nos(), contains(3, 4))
+
+    def test_ack_outside_window_is_ignored(self):
+        connection = self._start('x' * 80, 4)
+        self.transport.written = []
+
+        connection.datagramReceived(_ack_dgram(7), ADDR)
+
+        assert_that(self.transport.written, equal_to([]))
+        assert_that(self.transport.stopped, equal_to(False))
+
+    def test_reordered_ack_is_ignored(self):
+        connection = self._start('x' * 64, 4)
+        self.transport.pop_blk_nos()
+        connection.datagramReceived(_ack_dgram(4), ADDR)
+        assert_that(self.transport.pop_blk_nos(), contains(5, 6, 7, 8))
+
+        connection.datagramReceived(_ack_dgram(3), ADDR)
+
+        assert_that(self.transport.pop_blk_nos(), equal_to([]))
+        connection.datagramReceived(_ack_dgram(8), ADDR)
+        assert_that(self.transport.pop_blk_nos(), contains(9))
+        connection.datagramReceived(_ack_dgram(9), ADDR)
+        assert_that(self.transport.stopped)
+
+    def test_block_number_rollover(self):
+        # 65537 full blocks, then an empty one
+        connection = self._start('x' * 65537, 64, blksize=1)
+        blk_nos = []
+        while not self.transport.stopped:
+            sent = self.transport.pop_blk_nos()
+            blk_nos.extend(sent)
+            connection.datagramReceived(_ack_dgram(sent[-1]), ADDR)
+
+        assert_that(len(blk_nos), equal_to(65538))
+        assert_that(blk_nos[65534:], contains(65535, 0, 1, 2))
+
+    def test_oack_is_sent_alone(self):
+        oack_dgram = build_dgram(oack_packet({'windowsize': '4'}))
+        connection = RFC2347Connection(ADDR, StringIO('x' * 40), oack_dgram)
+        connection.blksize = 8
+        connection.windowsize = 4
+        connection.call_later = self.clock.callLater
+        connection.makeConnection(self.transport)
+
+        assert_that(len(self.transport.written), equal_to(1))
+        assert_that(self.transport.written[0]['opcode'], equal_to(OP_OACK))
+        self.transport.written = []
+        connection.datagramReceived(_ack_dgram(0), ADDR)
+        assert_that(self.transport.pop_blk_nos(), contains(1, 2, 3, 4))
+
+
+class TestConnectionTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = _FakeTransport()
+
+    def _start(self, rto_estimator=None):
+        connection = RFC1350Connection(ADDR, StringIO('x' * 80))
+        connection.blksize = 8
+        connection.rto_estimator = rto_estimator
+        connection.call_later = self.clock.callLater
+        connection.seconds = self.clock.seconds
+        connection.makeConnection(self.transport)
+        return connection
+
+    def test_fixed_timeout_gives_up_after_max_retries(self):
+        connection = self._start()
+
+        for _ in xrange(connection.max_retries - 1):
+            self.clock.advance(connection.timeout)
+            assert_that(self.transport.stopped, equal_to(False))
+        self.clock.advance(connection.timeout)
+        assert_that(self.transport.stopped)
+        assert_that(connection.retransmissions, equal_to(connection.max_retries - 1))
+
+    def test_rtt_is_sampled_on_ack(self):
+        rto_estimator = RTOEstimator(4)
+        connection = self._start(rto_estimator)
+
+        self.clock.advance(0.2)
+        connection.datagramReceived(_ack_dgram(1), ADDR)
+
+        assert_that(rto_estimator.srtt, equal_to(0.2))
+        assert_that(self.clock.getDelayedCalls()[0].getTime(), equal_to(0.2 + rto_estimator.rto))
+
+    def test_rtt_is_not_sampled_on_retransmitted_block(self):
+        rto_estimator = RTOEstimator(1)
+        connection = self._start(rto_estimator)
+
+        self.clock.advance(1)
+        connection.datagramReceived(_ack_dgram(1), ADDR)
+
+        assert_that(rto_estimator.nb_samples, equal_to(0))
+        assert_that(rto_estimator.rto, equal_to(2))
+
+    def test_timeout_backs_off_until_max_wait(self):
+        rto_estimator = RTOEstimator(0.5)
+        connection = self._start(rto_estimator)
+
+        # timeouts after 0.5, 1, 2, 4 and 8 seconds, then giving up after
+        # having waited max_retries * timeout seconds
+        for delay in [0.5, 1, 2, 4, 8]:
+            self.clock.advance(delay)
+            assert_that(self.transport.stopped, equal_to(False))
+        self.clock.advance(16)
+        assert_that(self.transport.stopped)
+        assert_that(connection.retransmissions, equal_to(5))
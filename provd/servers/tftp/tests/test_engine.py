@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+from StringIO import StringIO
+
+from hamcrest import assert_that, contains, equal_to, has_length
+from mock import Mock
+from twisted.internet.task import Clock
+
+from provd.servers.tftp.connection import RFC1350Connection
+from provd.servers.tftp.engine import MultiplexedTransferEngine, TimerWheel, TransferError
+from provd.servers.tftp.packet import parse_dgram, OP_DATA, OP_ERR, ERR_UNKNWN_TID
+
+ADDR1 = ('10.0.0.1', 1024)
+ADDR2 = ('10.0.0.2', 1024)
+ACK1_DGRAM = '\x00\x04\x00\x01'
+
+
+class _FakePort(object):
+
+    def __init__(self, protocol, port):
+        self.protocol = protocol
+        self.port = port
+        self.written = []
+        protocol.makeConnection(self)
+
+    def write(self, dgram, addr):
+        self.written.append((parse_dgram(dgram), addr))
+
+    def getHost(self):
+        return Mock(port=self.port)
+
+    def stopListening(self):
+        self.protocol.doStop()
+
+
+class _FakeReactor(Clock):
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.ports = []
+
+    def listenUDP(self, port, protocol, interface=''):
+        port = _FakePort(protocol, 10000 + len(self.ports))
+        self.ports.append(port)
+        return port
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(resolution=0.1, clock=self.clock)
+        self.calls = []
+
+    def test_call_later(self):
+        self.wheel.call_later(0.25, self.calls.append, 1)
+
+        self.clock.advance(0.2)
+        assert_that(self.calls, equal_to([]))
+        self.clock.advance(0.1)
+        assert_that(self.calls, equal_to([1]))
+        assert_that(self.wheel, has_length(0))
+
+    def test_call_later_uses_a_single_delayed_call(self):
+        self.wheel.call_later(1, self.calls.append, 1)
+        self.wheel.call_later(0.5, self.calls.append, 2)
+        self.wheel.call_later(2, self.calls.append, 3)
+
+        assert_that(self.clock.getDelayedCalls(), has_length(1))
+        self.clock.advance(0.5)
+        self.clock.advance(0.5)
+        self.clock.advance(1)
+        assert_that(self.calls, equal_to([2, 1, 3]))
+
+    def test_cancel(self):
+        timer = self.wheel.call_later(1, self.calls.append, 1)
+
+        timer.cancel()
+        self.clock.advance(1)
+
+        assert_that(self.calls, equal_to([]))
+        assert_that(timer.active(), equal_to(False))
+        assert_that(self.wheel, has_length(0))
+
+    def test_call_later_from_timer_function(self):
+        def fun():
+            self.calls.append(1)
+            self.wheel.call_later(1, self.calls.append, 2)
+
+        self.wheel.call_later(1, fun)
+        self.clock.advance(1)
+        self.clock.advance(1)
+
+        assert_that(self.calls, equal_to([1, 2]))
+
+    def test_stop(self):
+        self.wheel.call_later(1, self.calls.append, 1)
+
+        self.wheel.stop()
+
+        assert_that(self.clock.getDelayedCalls(), has_length(0))
+
+
+class TestMultiplexedTransferEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = _FakeReactor()
+        self.engine = MultiplexedTransferEngine(2, reactor=self.reactor)
+        self.engine.start()
+
+    def _new_connection(self, addr, content='foo'):
+        return RFC1350Connection(addr, StringIO(content))
+
+    def test_start_binds_the_pool_ports(self):
+        assert_that(self.reactor.ports, has_length(2))
+
+    def test_start_transfer(self):
+        self.engine.start_transfer(ADDR1, self._new_connection(ADDR1))
+
+        port = self.reactor.ports[0]
+        assert_that(port.written, has_length(1))
+        pkt, addr = port.written[0]
+        assert_that(pkt['opcode'], equal_to(OP_DATA))
+        assert_that(pkt['data'], equal_to('foo'))
+        assert_that(addr, equal_to(ADDR1))
+        assert_that(self.engine.nb_transfers(), equal_to(1))
+
+    def test_start_transfer_spreads_transfers(self):
+        self.engine.start_transfer(ADDR1, self._new_connection(ADDR1))
+        self.engine.start_transfer(ADDR2, self._new_connection(ADDR2))
+
+        assert_that([len(port.written) for port in self.reactor.ports], contains(1, 1))
+
+    def test_start_transfer_same_addr_on_different_ports(self):
+        self.engine.start_transfer(ADDR1, self._new_connection(ADDR1))
+        self.engine.start_transfer(ADDR1, self._new_connection(ADDR1))
+
+        assert_that([len(port.written) for port in self.reactor.ports], contains(1, 1))
+        self.assertRaises(TransferError, self.engine.start_transfer, ADDR1,
+                          self._new_connection(ADDR1))
+
+    def test_transfer_completes(self):
+        self.engine.start_transfer(ADDR1, self._new_connection(ADDR1))
+        port = self.reactor.ports[0]
+
+        port.protocol.datagramReceived(ACK1_DGRAM, ADDR1)
+
+        assert_that(self.engine.nb_transfers(), equal_to(0))
+
+    def test_unknown_tid(self):
+        port = self.reactor.ports[0]
+
+        port.protocol.datagramReceived(ACK1_DGRAM, ADDR1)
+
+        pkt, addr = port.written[0]
+        assert_that(pkt['opcode'], equal_to(OP_ERR))
+        assert_that(pkt['errcode'], equal_to(ERR_UNKNWN_TID))
+        assert_that(addr, equal_to(ADDR1))
+
+    def test_retransmission_uses_timer_wheel(self):
+        connection = self._new_connection(ADDR1)
+        self.engine.start_transfer(ADDR1, connection)
+        port = self.reactor.ports[0]
+
+        self.reactor.advance(connection.timeout)
+
+        assert_that(port.written, has_length(2))
+        assert_that(port.written[1], equal_to(port.written[0]))
+
+    def test_stop_closes_transfers(self):
+        fobj = StringIO('foo')
+        self.engine.start_transfer(ADDR1, RFC1350Connection(ADDR1, fobj))
+
+        d = self.engine.stop()
+
+        assert_that(d.result, contains((True, None), (True, None)))
+        assert_that(fobj.closed, equal_to(True))
+        assert_that(self.engine.nb_transfers(), equal_to(0))
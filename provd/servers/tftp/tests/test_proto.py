@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from hamcrest import assert_that, equal_to, instance_of, none
+from mock import Mock
+
+from provd.servers.tftp.connection import RFC1350Connection, RFC2347Connection
+from provd.servers.tftp.proto import TFTPProtocol
+
+ADDR = ('10.0.0.1', 1024)
+
+
+def _rrq_dgram(options):
+    return '\x00\x01fname\x00octet\x00' + ''.join('%s\x00%s\x00' % item for item in options)
+
+
+def _oack_options(connection):
+    tokens = connection._oack_dgram[2:].split('\x00')[:-1]
+    return dict(zip(tokens[::2], tokens[1::2]))
+
+
+class _FakeService(object):
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+
+    def handle_read_request(self, request, response):
+        response.accept(self.fobj)
+
+
+class TestTFTPProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = Mock()
+        self.protocol = TFTPProtocol(self.engine)
+        self.protocol.makeConnection(Mock())
+
+    def _request(self, fobj, options=()):
+        self.protocol.set_tftp_request_processing_service(_FakeService(fobj))
+        self.protocol.datagramReceived(_rrq_dgram(options), ADDR)
+        return self.engine.start_transfer.call_args[0][1]
+
+    def test_no_option(self):
+        connection = self._request(StringIO('foo'))
+
+        assert_that(connection, instance_of(RFC1350Connection))
+
+    def test_tsize_of_string(self):
+        connection = self._request(StringIO('foobar'), [('tsize', '0')])
+
+        assert_that(connection, instance_of(RFC2347Connection))
+        assert_that(_oack_options(connection), equal_to({'tsize': '6'}))
+
+    def test_tsize_of_file(self):
+        fobj = tempfile.TemporaryFile()
+        fobj.write('x' * 1000)
+        fobj.seek(0)
+
+        connection = self._request(fobj, [('tsize', '0')])
+
+        assert_that(_oack_options(connection), equal_to({'tsize': '1000'}))
+
+    def test_tsize_of_unknown_size(self):
+        fobj = Mock(spec=['read', 'close'])
+
+        connection = self._request(fobj, [('tsize', '0')])
+
+        assert_that(connection, instance_of(RFC1350Connection))
+
+    def test_timeout(self):
+        connection = self._request(StringIO('foo'), [('timeout', '2'), ('blksize', '1024')])
+
+        assert_that(_oack_options(connection), equal_to({'timeout': '2', 'blksize': '1024'}))
+        assert_that(connection.timeout, equal_to(2))
+        assert_that(connection.blksize, equal_to(1024))
+
+    def test_windowsize_is_capped(self):
+        connection = self._request(StringIO('foo'), [('windowsize', '1000')])
+
+        assert_that(_oack_options(connection), equal_to({'windowsize': '64'}))
+        assert_that(connection.windowsize, equal_to(64))
+
+    def test_adaptive_timeout(self):
+        connection = self._request(StringIO('foo'))
+
+        assert_that(connection.rto_estimator.rto, equal_to(connection.timeout))
+
+    def test_no_adaptive_timeout_with_timeout_option(self):
+        connection = self._request(StringIO('foo'), [('timeout', '2')])
+
+        assert_that(connection.rto_estimator, none())
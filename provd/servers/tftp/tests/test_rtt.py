@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from hamcrest import assert_that, close_to, equal_to, none
+
+from provd.servers.tftp.rtt import RTOEstimator, SubnetRTTCache
+
+
+class TestRTOEstimator(unittest.TestCase):
+
+    def test_initial_rto(self):
+        estimator = RTOEstimator(4)
+
+        assert_that(estimator.rto, equal_to(4))
+
+    def test_first_sample(self):
+        estimator = RTOEstimator(4)
+
+        estimator.sample(0.4)
+
+        assert_that(estimator.srtt, close_to(0.4, 1e-9))
+        assert_that(estimator.rttvar, close_to(0.2, 1e-9))
+        assert_that(estimator.rto, close_to(1.2, 1e-9))
+
+    def test_next_samples(self):
+        estimator = RTOEstimator(4)
+        estimator.sample(0.4)
+
+        estimator.sample(1.2)
+
+        assert_that(estimator.srtt, close_to(0.5, 1e-9))
+        assert_that(estimator.rttvar, close_to(0.35, 1e-9))
+        assert_that(estimator.rto, close_to(1.9, 1e-9))
+
+    def test_rto_is_bounded(self):
+        estimator = RTOEstimator(4)
+
+        estimator.sample(0.001)
+        assert_that(estimator.rto, equal_to(1.0))
+        estimator.sample(100)
+        assert_that(estimator.rto, equal_to(RTOEstimator.max_rto))
+
+    def test_backoff(self):
+        estimator = RTOEstimator(4)
+
+        estimator.backoff()
+        assert_that(estimator.rto, equal_to(8))
+        estimator.backoff()
+        estimator.backoff()
+        assert_that(estimator.rto, equal_to(RTOEstimator.max_rto))
+
+    def test_learned_values(self):
+        estimator = RTOEstimator(4, 0.5, 0.25)
+
+        assert_that(estimator.rto, close_to(1.5, 1e-9))
+
+    def test_finish_without_sample(self):
+        finished = []
+        estimator = RTOEstimator(4, on_finish=finished.append)
+
+        estimator.finish()
+
+        assert_that(finished, equal_to([]))
+
+
+class TestSubnetRTTCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SubnetRTTCache(4)
+
+    def test_new_estimator_without_learned_values(self):
+        estimator = self.cache.new_estimator('10.0.0.1')
+
+        assert_that(estimator.rto, equal_to(4))
+
+    def test_learned_values_are_per_subnet(self):
+        estimator = self.cache.new_estimator('10.0.0.1')
+        estimator.sample(0.4)
+        estimator.finish()
+
+        assert_that(self.cache.new_estimator('10.0.0.2').rto, close_to(1.2, 1e-9))
+        assert_that(self.cache.new_estimator('10.0.1.1').rto, equal_to(4))
+
+    def test_update_smooths_learned_values(self):
+        self.cache.update('10.0.0.1', 0.2, 0.1)
+
+        self.cache.update('10.0.0.1', 0.6, 0.1)
+
+        srtt, rttvar = self.cache.get('10.0.0.1')
+        assert_that(srtt, close_to(0.3, 1e-9))
+        assert_that(rttvar, close_to(0.1, 1e-9))
+
+    def test_max_entries(self):
+        cache = SubnetRTTCache(4, max_entries=2)
+
+        cache.update('10.0.0.1', 0.1, 0.1)
+        cache.update('10.0.1.1', 0.1, 0.1)
+        cache.update('10.0.0.1', 0.1, 0.1)
+        cache.update('10.0.2.1', 0.1, 0.1)
+
+        assert_that(len(cache), equal_to(2))
+        assert_that(cache.get('10.0.1.1'), none())
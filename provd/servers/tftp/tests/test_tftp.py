@@ -22,3 +22,23 @@ class TestTFTP(unittest.TestCase):
         datagram = '\x00\x05\x00\x01'
 
         self.assertRaises(PacketError, parse_dgram, datagram)
+
+    def test_parse_rrq_windowsize_option(self):
+        pkt = parse_dgram('\x00\x01fname\x00octet\x00windowsize\x0016\x00')
+
+        self.assertEqual({'windowsize': 16}, pkt['options'])
+
+    def test_parse_rrq_invalid_windowsize_option_raise_error(self):
+        self.assertRaises(PacketError, parse_dgram, '\x00\x01fname\x00octet\x00windowsize\x000\x00')
+        self.assertRaises(PacketError, parse_dgram, '\x00\x01fname\x00octet\x00windowsize\x0065536\x00')
+        self.assertRaises(PacketError, parse_dgram, '\x00\x01fname\x00octet\x00windowsize\x00a\x00')
+
+    def test_parse_rrq_tsize_and_timeout_options(self):
+        pkt = parse_dgram('\x00\x01fname\x00octet\x00tsize\x000\x00timeout\x002\x00')
+
+        self.assertEqual({'tsize': 0, 'timeout': 2}, pkt['options'])
+
+    def test_parse_rrq_invalid_timeout_option_raise_error(self):
+        self.assertRaises(PacketError, parse_dgram, '\x00\x01fname\x00octet\x00timeout\x000\x00')
+        self.assertRaises(PacketError, parse_dgram, '\x00\x01fname\x00octet\x00timeout\x00256\x00')
+        self.assertRaises(PacketError, parse_dgram, '\x00\x01fname\x00octet\x00tsize\x00-1\x00')
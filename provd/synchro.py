@@ -6,6 +6,7 @@
 
 
 import logging
+import time
 from collections import deque
 from twisted.internet import defer
 
@@ -145,3 +146,185 @@ class DeferredRWLock(object):
         logger.debug('Releasing write lock %d of RWLock %s', self._writing - 1, self)
         self._writing -= 1
         self._reschedule()
+
+
+class DeferredKeyedLock(object):
+    """A set of locks, one for each key, for event driven systems.
+
+    Locks are created when first acquired and are discarded once released
+    if no one is waiting for them, so that any number of keys can be used.
+
+    """
+    def __init__(self):
+        self._locks = {}
+
+    def acquire(self, key):
+        """Return a deferred that will fire with None once the lock for the
+        given key has been acquired.
+
+        """
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+        d = lock.acquire()
+        d.addCallback(lambda _: None)
+        return d
+
+    def release(self, key):
+        try:
+            lock = self._locks[key]
+        except KeyError:
+            raise InvalidLockUsage('lock %r released while not locked' % (key,))
+        lock.release()
+        # a waiter might have acquired and released the lock in the meantime
+        if not lock.locked and self._locks.get(key) is lock:
+            del self._locks[key]
+
+    def locked(self, key):
+        return key in self._locks
+
+    def run(self, key, f, *args, **kwargs):
+        def execute(_):
+            d = defer.maybeDeferred(f, *args, **kwargs)
+            d.addBoth(release)
+            return d
+
+        def release(r):
+            self.release(key)
+            return r
+
+        d = self.acquire(key)
+        d.addCallback(execute)
+        return d
+
+
+class LockStats(object):
+    """Statistics about the time an operation spent waiting for and holding
+    its locks, in seconds.
+
+    """
+    def __init__(self):
+        self.count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.hold_time = 0.0
+        self.max_hold_time = 0.0
+
+    def add(self, wait_time, hold_time):
+        self.count += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.hold_time += hold_time
+        self.max_hold_time = max(self.max_hold_time, hold_time)
+
+    def as_dict(self):
+        return {
+            u'count': self.count,
+            u'wait_time': self.wait_time,
+            u'max_wait_time': self.max_wait_time,
+            u'hold_time': self.hold_time,
+            u'max_hold_time': self.max_hold_time,
+        }
+
+
+class LockManager(object):
+    """A global read-write lock combined with a set of per-entity locks.
+
+    Operations acquire the global lock, in read or write mode, and then the
+    locks of the entities they operate on. An entity lock is identified by a
+    (kind, key) tuple, for example (u'device', device_id).
+
+    Entity locks are always acquired in the same order, i.e. by kind, in the
+    order the kinds have been given, and then by key, so that operations
+    acquiring the locks of many entities can't deadlock. Operations already
+    holding entity locks can acquire other entity locks as long as they
+    respect this order.
+
+    The time spent waiting for and holding the locks is recorded for each
+    operation.
+
+    """
+
+    READ = 'read'
+    WRITE = 'write'
+
+    def __init__(self, kinds, timer=time.time):
+        self.rw_lock = DeferredRWLock()
+        self._kind_orders = dict((kind, i) for i, kind in enumerate(kinds))
+        self._keyed_locks = dict((kind, DeferredKeyedLock()) for kind in kinds)
+        self._timer = timer
+        self.stats = {}
+
+    def _sort_entities(self, entities):
+        kind_orders = self._kind_orders
+        return sorted(set(entities), key=lambda (kind, key): (kind_orders[kind], key))
+
+    def _global_lock(self, mode):
+        if mode is None:
+            return None
+        elif mode == self.READ:
+            return self.rw_lock.read_lock
+        elif mode == self.WRITE:
+            return self.rw_lock.write_lock
+        else:
+            raise ValueError('invalid lock mode %r' % mode)
+
+    def acquire(self, entities):
+        """Return a deferred that will fire with the sorted list of entities
+        once the locks of all the given entities have been acquired.
+
+        """
+        entities = self._sort_entities(entities)
+        d = defer.succeed(None)
+        for kind, key in entities:
+            d.addCallback(lambda _, kind=kind, key=key: self._keyed_locks[kind].acquire(key))
+        d.addCallback(lambda _: entities)
+        return d
+
+    def release(self, entities):
+        for kind, key in entities:
+            self._keyed_locks[kind].release(key)
+
+    def locked(self, entity):
+        kind, key = entity
+        return self._keyed_locks[kind].locked(key)
+
+    def run(self, operation, mode, entities, f, *args, **kwargs):
+        """Acquire the global lock in the given mode, i.e. READ, WRITE or
+        None to not acquire it, then the locks of the given entities, and
+        call f. The locks are released once the deferred returned by f has
+        fired.
+
+        """
+        global_lock = self._global_lock(mode)
+        entities = self._sort_entities(entities)
+        start_time = self._timer()
+
+        def execute(_):
+            acquired_time = self._timer()
+            d = defer.maybeDeferred(f, *args, **kwargs)
+            d.addBoth(release, acquired_time)
+            return d
+
+        def release(r, acquired_time):
+            self.release(entities)
+            if global_lock is not None:
+                global_lock.release()
+            self._add_stats(operation, acquired_time - start_time,
+                            self._timer() - acquired_time)
+            return r
+
+        if global_lock is None:
+            d = self.acquire(entities)
+        else:
+            d = global_lock.acquire()
+            d.addCallback(lambda _: self.acquire(entities))
+        d.addCallback(execute)
+        return d
+
+    def _add_stats(self, operation, wait_time, hold_time):
+        try:
+            stats = self.stats[operation]
+        except KeyError:
+            stats = self.stats[operation] = LockStats()
+        stats.add(wait_time, hold_time)
@@ -6,6 +6,8 @@
 
 
 import logging
+import time
+from provd.metrics import Histogram
 from twisted.internet import defer, threads
 from wazo_amid_client import Client as AmidClient
 
@@ -13,6 +15,9 @@ logger = logging.getLogger(__name__)
 
 _SYNC_SERVICE = None
 _AMID_client = None
+# map the name of the sync service methods to the histogram of the duration
+# of their calls
+sync_call_durations = {}
 
 
 def get_AMID_client(**config):
@@ -107,6 +112,21 @@ def standard_sip_synchronize(device, event='check-sync', extra_vars=None):
     return defer.fail(SynchronizeException('not enough information to synchronize device'))
 
 
+def _call_sync_service(name, fun, *args):
+    # name is the name of the sync service call in the metrics
+    start_time = time.time()
+
+    def observe_duration(result):
+        histogram = sync_call_durations.get(name)
+        if histogram is None:
+            histogram = sync_call_durations[name] = Histogram()
+        histogram.observe(time.time() - start_time)
+        return result
+    d = threads.deferToThread(fun, *args)
+    d.addBoth(observe_duration)
+    return d
+
+
 def _synchronize_by_peer(device, event, ami_sync_service, extra_vars=None):
     peer = device.get(u'remote_state_sip_username')
     if not peer:
@@ -117,7 +137,7 @@ def _synchronize_by_peer(device, event, ami_sync_service, extra_vars=None):
     if is_autoprov:
         return None
 
-    return threads.deferToThread(ami_sync_service.sip_notify_by_peer, peer, event, extra_vars)
+    return _call_sync_service('sip_notify_by_peer', ami_sync_service.sip_notify_by_peer, peer, event, extra_vars)
 
 
 def _synchronize_by_ip(device, event, ami_sync_service, extra_vars=None):
@@ -125,4 +145,4 @@ def _synchronize_by_ip(device, event, ami_sync_service, extra_vars=None):
     if not ip:
         return None
 
-    return threads.deferToThread(ami_sync_service.sip_notify_by_ip, ip, event, extra_vars)
+    return _call_sync_service('sip_notify_by_ip', ami_sync_service.sip_notify_by_ip, ip, event, extra_vars)
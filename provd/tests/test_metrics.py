@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from hamcrest import assert_that, contains, equal_to, has_entries
+from provd.metrics import Histogram, MetricsWriter, RequestStats
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram([0.1, 1.0])
+
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+
+        assert_that(histogram.count, equal_to(4))
+        assert_that(histogram.sum, equal_to(2.65))
+        assert_that(histogram.cumulative_counts(), contains((0.1, 2), (1.0, 3), (float('inf'), 4)))
+
+    def test_as_dict(self):
+        histogram = Histogram([0.1])
+        histogram.observe(0.5)
+
+        assert_that(histogram.as_dict(), equal_to({
+            u'count': 1,
+            u'sum': 0.5,
+            u'buckets': [{u'le': u'0.1', u'count': 0}, {u'le': u'+Inf', u'count': 1}],
+        }))
+
+
+class TestRequestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.request_stats = RequestStats(timer=lambda: self.now, buckets=[1.0])
+
+    def test_trace(self):
+        trace = self.request_stats.new_trace(u'http')
+        self.now = 0.5
+        trace.mark(u'extract')
+        self.now = 2.0
+        trace.mark(u'serve')
+        trace.plugin_id = u'foo'
+        trace.finish()
+        trace.finish()
+
+        stats = self.request_stats.as_list()
+
+        assert_that(stats, contains(has_entries({u'request_type': u'http', u'plugin': u'foo'})))
+        stages = stats[0][u'stages']
+        assert_that(sorted(stages), equal_to([u'extract', u'serve', u'total']))
+        assert_that(stages[u'extract'], has_entries({u'count': 1, u'sum': 0.5}))
+        assert_that(stages[u'serve'], has_entries({u'count': 1, u'sum': 1.5}))
+        assert_that(stages[u'total'], has_entries({u'count': 1, u'sum': 2.0}))
+
+    def test_as_list_sorted(self):
+        self.request_stats.observe(u'tftp', None, u'total', 1.0)
+        self.request_stats.observe(u'http', u'foo', u'total', 1.0)
+        self.request_stats.observe(u'http', None, u'total', 1.0)
+
+        stats = self.request_stats.as_list()
+
+        assert_that([(s[u'request_type'], s[u'plugin']) for s in stats],
+                    equal_to([(u'http', None), (u'http', u'foo'), (u'tftp', None)]))
+
+    def test_responses(self):
+        trace = self.request_stats.new_trace(u'http')
+        trace.status = 404
+        trace.finish()
+        self.request_stats.new_trace(u'tftp').finish()
+
+        assert_that(self.request_stats.responses(), equal_to([(u'http', None, 404, 1)]))
+
+
+class TestMetricsWriter(unittest.TestCase):
+
+    def test_counter(self):
+        writer = MetricsWriter()
+
+        writer.counter('requests_total', 'Number of requests.',
+                       [({'plugin': u'foo"bar', 'status': 200}, 2), ({'plugin': None, 'status': 404}, 1)])
+
+        assert_that(writer.getvalue(), equal_to(
+            '# HELP provd_requests_total Number of requests.\n'
+            '# TYPE provd_requests_total counter\n'
+            'provd_requests_total{plugin="foo\\"bar",status="200"} 2\n'
+            'provd_requests_total{plugin="",status="404"} 1\n'
+        ))
+
+    def test_histogram(self):
+        histogram = Histogram([0.5])
+        histogram.observe(0.25)
+        writer = MetricsWriter()
+
+        writer.histogram('duration_seconds', 'Duration.', [({'stage': u'extract'}, histogram)])
+
+        assert_that(writer.getvalue(), equal_to(
+            '# HELP provd_duration_seconds Duration.\n'
+            '# TYPE provd_duration_seconds histogram\n'
+            'provd_duration_seconds_bucket{le="0.5",stage="extract"} 1\n'
+            'provd_duration_seconds_bucket{le="+Inf",stage="extract"} 1\n'
+            'provd_duration_seconds_sum{stage="extract"} 0.25\n'
+            'provd_duration_seconds_count{stage="extract"} 1\n'
+        ))
@@ -2,11 +2,12 @@
 # Copyright (C) 2011-2014 Avencall
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-# NOTE: these tests are not automated (yet). You need to manually check
+# NOTE: the DeferredRWLock tests are not automated (yet). You need to manually check
 #       the output of each test and compare it with the expected output...
 
 import time
-from provd.synchro import DeferredRWLock
+import unittest
+from provd.synchro import DeferredKeyedLock, DeferredRWLock, LockManager
 from twisted.internet import defer
 from twisted.internet import reactor
 
@@ -151,3 +152,101 @@ def rw_lock_tests():
 if __name__ == '__main__':
     rw_lock_tests()
     reactor.run()
+
+
+class TestDeferredKeyedLock(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = DeferredKeyedLock()
+
+    def test_acquire_different_keys(self):
+        d1 = self.lock.acquire(u'a')
+        d2 = self.lock.acquire(u'b')
+
+        self.assertTrue(d1.called)
+        self.assertTrue(d2.called)
+
+    def test_acquire_same_key(self):
+        self.lock.acquire(u'a')
+        d = self.lock.acquire(u'a')
+
+        self.assertFalse(d.called)
+        self.lock.release(u'a')
+        self.assertTrue(d.called)
+        self.lock.release(u'a')
+        self.assertFalse(self.lock.locked(u'a'))
+
+    def test_run_releases_on_error(self):
+        d = self.lock.run(u'a', lambda: 1 / 0)
+        d.addErrback(lambda failure: failure.trap(ZeroDivisionError))
+
+        self.assertFalse(self.lock.locked(u'a'))
+
+
+class TestLockManager(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.locks = LockManager([u'device', u'config'], timer=lambda: self.now)
+
+    def test_acquire_sorts_entities(self):
+        d = self.locks.acquire([(u'config', u'b'), (u'device', u'z'), (u'config', u'a')])
+
+        entities = []
+        d.addCallback(entities.extend)
+        self.assertEqual([(u'device', u'z'), (u'config', u'a'), (u'config', u'b')], entities)
+
+    def test_run_different_entities(self):
+        d1 = defer.Deferred()
+        self.locks.run('op', LockManager.READ, [(u'device', u'a')], lambda: d1)
+        calls = []
+        self.locks.run('op', LockManager.READ, [(u'device', u'b')], calls.append, 2)
+
+        self.assertEqual([2], calls)
+
+    def test_run_same_entity(self):
+        d1 = defer.Deferred()
+        self.locks.run('op', LockManager.READ, [(u'device', u'a')], lambda: d1)
+        calls = []
+        self.locks.run('op', LockManager.READ, [(u'config', u'b'), (u'device', u'a')],
+                       calls.append, 2)
+
+        self.assertEqual([], calls)
+        self.assertFalse(self.locks.locked((u'config', u'b')))
+        d1.callback(None)
+        self.assertEqual([2], calls)
+        self.assertFalse(self.locks.locked((u'device', u'a')))
+
+    def test_run_write_waits_for_readers(self):
+        d1 = defer.Deferred()
+        self.locks.run('op', LockManager.READ, [(u'device', u'a')], lambda: d1)
+        calls = []
+        self.locks.run('op', LockManager.WRITE, [], calls.append, 2)
+
+        self.assertEqual([], calls)
+        d1.callback(None)
+        self.assertEqual([2], calls)
+
+    def test_run_records_stats(self):
+        d1 = defer.Deferred()
+        self.locks.run('op1', LockManager.READ, [(u'device', u'a')], lambda: d1)
+        self.now = 1.0
+        self.locks.run('op2', None, [(u'device', u'a')], lambda: None)
+        self.now = 3.0
+        d1.callback(None)
+
+        self.assertEqual({u'count': 1, u'wait_time': 0.0, u'max_wait_time': 0.0,
+                          u'hold_time': 3.0, u'max_hold_time': 3.0},
+                         self.locks.stats['op1'].as_dict())
+        self.assertEqual({u'count': 1, u'wait_time': 2.0, u'max_wait_time': 2.0,
+                          u'hold_time': 0.0, u'max_hold_time': 0.0},
+                         self.locks.stats['op2'].as_dict())
+
+    def test_run_releases_on_error(self):
+        d = self.locks.run('op', LockManager.WRITE, [(u'device', u'a')], lambda: 1 / 0)
+        d.addErrback(lambda failure: failure.trap(ZeroDivisionError))
+
+        self.assertFalse(self.locks.locked((u'device', u'a')))
+        calls = []
+        self.locks.run('op', LockManager.WRITE, [], calls.append, 2)
+        self.assertEqual([2], calls)
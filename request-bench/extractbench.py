@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import re
+import shutil
+import tempfile
+import time
+
+from provd.devices.device import DeviceCollection
+from provd.devices.ident import (
+    AllPluginsDeviceInfoExtractor,
+    CollaboratingDeviceInfoExtractor,
+    KnownDeviceInfoExtractor,
+    LastSeenUpdater,
+    StandardDeviceInfoExtractor,
+    VotingUpdater,
+)
+from provd.persist.id import numeric_id_generator
+from provd.persist.json_backend import new_json_collection
+from twisted.internet import defer
+
+
+class _HTTPDeviceInfoExtractor(object):
+    # similar to the extractors of the plugins, i.e. match the user agent
+    # and the filename with regular expressions
+
+    def __init__(self, vendor, declare_prefixes):
+        if declare_prefixes:
+            self.user_agent_prefixes = ['%s-' % vendor]
+        self._vendor = vendor
+        self._ua_regex = re.compile(r'^%s-(\w+)/([\d.]+) ([\da-f]{12})$' % vendor)
+        self._filename_regex = re.compile(r'^([\da-f]{12})\.cfg$')
+
+    def extract(self, request, request_type):
+        dev_info = {}
+        ua = request.getHeader('User-Agent')
+        if ua:
+            m = self._ua_regex.match(ua)
+            if m:
+                dev_info[u'vendor'] = self._vendor
+                dev_info[u'model'] = m.group(1).decode('ascii')
+                dev_info[u'version'] = m.group(2).decode('ascii')
+        m = self._filename_regex.match(request.path.rsplit('/', 1)[-1])
+        if m and dev_info:
+            dev_info[u'mac'] = u':'.join(m.group(1)[i:i + 2] for i in xrange(0, 12, 2)).decode('ascii')
+        return defer.succeed(dev_info)
+
+
+class _Plugin(object):
+
+    def __init__(self, vendor, declare_prefixes=False):
+        self.http_dev_info_extractor = _HTTPDeviceInfoExtractor(vendor, declare_prefixes)
+        self.tftp_dev_info_extractor = None
+        self.dhcp_dev_info_extractor = None
+
+
+class _PluginManager(dict):
+
+    def attach(self, observer):
+        pass
+
+
+class _App(object):
+
+    nat = 0
+
+    def __init__(self, dev_collection):
+        self._dev_collection = dev_collection
+
+    def dev_lookup(self, key, value):
+        return self._dev_collection.lookup(key, value)
+
+
+class _Request(object):
+
+    def __init__(self, ip, path, ua):
+        self._ip = ip
+        self.path = path
+        self._ua = ua
+
+    def getClientIP(self):
+        return self._ip
+
+    def getHeader(self, name):
+        if name == 'User-Agent':
+            return self._ua
+        return None
+
+
+def _result(deferred):
+    results = []
+    deferred.addBoth(results.append)
+    result = results[0]
+    if hasattr(result, 'raiseException'):
+        result.raiseException()
+    return result
+
+
+def _new_info_extractor(app, known_device):
+    def xtor_factory(xtors):
+        return CollaboratingDeviceInfoExtractor(VotingUpdater, xtors)
+
+    std_xtor = StandardDeviceInfoExtractor()
+    all_pg_xtor = AllPluginsDeviceInfoExtractor(xtor_factory, app.pg_mgr)
+    if known_device:
+        all_pg_xtor = KnownDeviceInfoExtractor(app, all_pg_xtor)
+    return CollaboratingDeviceInfoExtractor(LastSeenUpdater, [all_pg_xtor, std_xtor])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--plugins', type=int, default=40,
+                        help='number of loaded plugins')
+    parser.add_argument('-d', '--devices', type=int, default=10000,
+                        help='number of devices')
+    parser.add_argument('-r', '--requests', type=int, default=20000,
+                        help='number of requests to process')
+
+    parsed_args = parser.parse_args()
+
+    vendors = ['Vendor%s' % n for n in xrange(parsed_args.plugins)]
+    directory = tempfile.mkdtemp(prefix='extractbench-')
+    try:
+        collection = DeviceCollection(new_json_collection(directory, numeric_id_generator()))
+        requests = []
+        for n in xrange(parsed_args.devices):
+            vendor = vendors[n % len(vendors)]
+            mac = ''.join('%02x' % ((n >> shift) & 0xff) for shift in (40, 32, 24, 16, 8, 0))
+            ip = '10.%s.%s.%s' % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)
+            collection.insert({
+                u'mac': u':'.join(mac[i:i + 2] for i in xrange(0, 12, 2)).decode('ascii'),
+                u'ip': ip.decode('ascii'),
+                u'vendor': vendor.decode('ascii'),
+                u'model': u'Model%s' % (n % 10),
+                u'plugin': u'plugin-%s' % vendor.lower(),
+                u'configured': True,
+                u'tenant_uuid': u'00000000-0000-0000-0000-000000000000',
+            })
+            requests.append(_Request(ip, '/%s.cfg' % mac, '%s-Model%s/1.0 %s' % (vendor, n % 10, mac)))
+        # a few requests from unknown devices
+        requests.append(_Request('192.168.0.1', '/000000000000.cfg', 'Vendor0-Model0/1.0 000000000000'))
+        app = _App(collection)
+
+        nb_requests = parsed_args.requests
+        for name, declare_prefixes, known_device in [('all plugins', False, False),
+                                                     ('prefix index', True, False),
+                                                     ('known device', False, True)]:
+            app.pg_mgr = _PluginManager((u'plugin-%s' % vendor.lower(), _Plugin(vendor, declare_prefixes))
+                                        for vendor in vendors)
+            info_extractor = _new_info_extractor(app, known_device)
+            start_time = time.time()
+            for n in xrange(nb_requests):
+                request = requests[n % len(requests)]
+                _result(info_extractor.extract(request, 'http'))
+            elapsed = time.time() - start_time
+            print '%-14s %.1f us/request (%s plugins)' % (name, elapsed / nb_requests * 1e6,
+                                                          parsed_args.plugins)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
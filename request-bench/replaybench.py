@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import gc
+import json
+import shutil
+import tempfile
+import time
+
+from provd.devices.device import DeviceCollection
+from provd.devices.ident import (
+    AddDeviceRetriever,
+    AddInfoDeviceUpdater,
+    CollaboratingDeviceInfoExtractor,
+    CompositeDeviceUpdater,
+    DynamicDeviceUpdater,
+    FirstCompositeDeviceRetriever,
+    IpDeviceRetriever,
+    LastSeenUpdater,
+    MacDeviceRetriever,
+    RequestProcessingService,
+    StandardDeviceInfoExtractor,
+)
+from provd.persist.id import numeric_id_generator
+from provd.persist.json_backend import new_json_collection
+from twisted.internet import defer
+
+
+class _HTTPRequest(object):
+
+    def __init__(self, ip, path, ua):
+        self._ip = ip
+        self.path = path
+        self._ua = ua
+
+    def getClientIP(self):
+        return self._ip
+
+    def getHeader(self, name):
+        if name == 'User-Agent':
+            return self._ua
+        return None
+
+
+def _new_request(captured_request):
+    # a captured request is a dictionary with a "type" key and the
+    # attributes of the request
+    request_type = captured_request[u'type']
+    if request_type == u'http':
+        request = _HTTPRequest(captured_request[u'ip'].encode('ascii'),
+                               captured_request[u'path'].encode('ascii'),
+                               captured_request.get(u'user_agent', u'').encode('ascii') or None)
+    elif request_type == u'tftp':
+        request = {
+            'address': (captured_request[u'ip'].encode('ascii'), 69),
+            'packet': {'filename': captured_request[u'filename'].encode('ascii')},
+        }
+    else:
+        raise ValueError('unsupported request type %r' % request_type)
+    return request, request_type.encode('ascii')
+
+
+def _generate_captured_requests(nb_devices):
+    captured_requests = []
+    for n in xrange(nb_devices):
+        mac = ''.join('%02x' % ((n >> shift) & 0xff) for shift in (40, 32, 24, 16, 8, 0))
+        ip = '10.%s.%s.%s' % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)
+        # what a phone usually does when it boots
+        captured_requests.append({u'type': u'tftp', u'ip': ip, u'filename': u'%s.cfg' % mac})
+        captured_requests.append({u'type': u'http', u'ip': ip, u'path': u'/%s.cfg' % mac,
+                                  u'user_agent': u'Phone/1.0'})
+        captured_requests.append({u'type': u'http', u'ip': ip, u'path': u'/firmware.bin',
+                                  u'user_agent': u'Phone/1.0'})
+    return captured_requests
+
+
+class _PluginManager(dict):
+
+    def attach(self, observer):
+        pass
+
+
+class _App(object):
+    # the subset of the application used while processing requests, with
+    # every operation completing synchronously like the in-memory backends
+
+    nat = 0
+
+    def __init__(self, dev_collection):
+        self._dev_collection = dev_collection
+        self.pg_mgr = _PluginManager()
+
+    def dev_lookup(self, key, value):
+        return self._dev_collection.lookup(key, value)
+
+    def dev_find(self, selector):
+        return self._dev_collection.find(selector)
+
+    def dev_find_one(self, selector):
+        return self._dev_collection.find_one(selector)
+
+    def dev_insert(self, device):
+        device.setdefault(u'configured', False)
+        device.setdefault(u'tenant_uuid', u'00000000-0000-0000-0000-000000000000')
+        return self._dev_collection.insert(device)
+
+    def dev_update(self, device, pre_update_hook=None):
+        return self._dev_collection.update(device)
+
+    def cfg_retrieve(self, id):
+        return defer.succeed(None)
+
+
+def _new_process_service(app):
+    info_extractor = CollaboratingDeviceInfoExtractor(LastSeenUpdater, [StandardDeviceInfoExtractor()])
+    retriever = FirstCompositeDeviceRetriever([MacDeviceRetriever(app),
+                                               IpDeviceRetriever(app),
+                                               AddDeviceRetriever(app)])
+    updater = CompositeDeviceUpdater([AddInfoDeviceUpdater(),
+                                      DynamicDeviceUpdater([u'ip', u'version'], True)])
+    return RequestProcessingService(app, info_extractor, retriever, updater)
+
+
+class _DeferredCounter(object):
+    # count the deferreds created while processing the requests
+
+    def __init__(self):
+        self.count = 0
+        self._orig_init = defer.Deferred.__init__
+
+    def __enter__(self):
+        orig_init = self._orig_init
+
+        def __init__(deferred, *args, **kwargs):
+            self.count += 1
+            orig_init(deferred, *args, **kwargs)
+        defer.Deferred.__init__ = __init__
+        return self
+
+    def __exit__(self, *args):
+        defer.Deferred.__init__ = self._orig_init
+
+
+def _replay(process_service, requests, nb_requests):
+    errors = []
+    for n in xrange(nb_requests):
+        request, request_type = requests[n % len(requests)]
+        process_service.process(request, request_type).addErrback(errors.append)
+    if errors:
+        errors[0].raiseException()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--devices', type=int, default=1000,
+                        help='number of devices of the generated request mix')
+    parser.add_argument('-r', '--requests', type=int, default=50000,
+                        help='number of requests to process')
+    parser.add_argument('-c', '--capture',
+                        help='file of captured requests to replay, one JSON object per line')
+    parser.add_argument('--save-capture',
+                        help='save the generated request mix to this file')
+
+    parsed_args = parser.parse_args()
+
+    if parsed_args.capture:
+        with open(parsed_args.capture) as fobj:
+            captured_requests = [json.loads(line) for line in fobj if line.strip()]
+    else:
+        captured_requests = _generate_captured_requests(parsed_args.devices)
+        if parsed_args.save_capture:
+            with open(parsed_args.save_capture, 'w') as fobj:
+                for captured_request in captured_requests:
+                    fobj.write(json.dumps(captured_request) + '\n')
+    requests = [_new_request(captured_request) for captured_request in captured_requests]
+
+    directory = tempfile.mkdtemp(prefix='replaybench-')
+    try:
+        app = _App(DeviceCollection(new_json_collection(directory, numeric_id_generator())))
+        process_service = _new_process_service(app)
+        # first pass, to create the devices
+        _replay(process_service, requests, len(requests))
+
+        nb_requests = parsed_args.requests
+        gc.collect()
+        start_time = time.time()
+        _replay(process_service, requests, nb_requests)
+        elapsed = time.time() - start_time
+        print '%.0f requests/s (%.1f us/request)' % (nb_requests / elapsed,
+                                                     elapsed / nb_requests * 1e6)
+
+        nb_requests = min(nb_requests, 10000)
+        with _DeferredCounter() as counter:
+            _replay(process_service, requests, nb_requests)
+        print '%.1f deferreds/request' % (float(counter.count) / nb_requests)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure the throughput of the TFTP server for different window sizes.
+
+A TFTP server and a client negotiating the windowsize option (RFC 7440) are
+run in the same process over the loopback interface. The client can delay its
+ACKs to simulate the round-trip time of a WAN link.
+
+"""
+
+import argparse
+import struct
+import time
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from provd.servers.tftp.engine import new_transfer_engine
+from provd.servers.tftp.proto import TFTPProtocol
+
+_UINT16_STRUCT = struct.Struct('!H')
+
+
+class _FileService(object):
+
+    def __init__(self, content):
+        self._content = content
+
+    def handle_read_request(self, request, response):
+        response.accept(StringIO(self._content))
+
+
+class _Client(DatagramProtocol):
+
+    def __init__(self, server_addr, blksize, windowsize, delay, timeout=1.0):
+        self._server_addr = server_addr
+        self._blksize = blksize
+        self._windowsize = windowsize
+        self._delay = delay
+        self._timeout = timeout
+        self._transfer_addr = None
+        self._blk_no = 0
+        self._nb_in_window = 0
+        self._timer = None
+        self.size = 0
+        self.retries = 0
+        self.done = defer.Deferred()
+
+    def startProtocol(self):
+        options = {'blksize': self._blksize, 'windowsize': self._windowsize}
+        rrq = '\x00\x01bench\x00octet\x00' + ''.join('%s\x00%s\x00' % item for item in options.iteritems())
+        self.transport.write(rrq, self._server_addr)
+
+    def _send_ack(self, blk_no, last=False):
+        dgram = '\x00\x04' + _UINT16_STRUCT.pack(blk_no)
+        if self._delay:
+            reactor.callLater(self._delay, self._write_ack, dgram, last)
+        else:
+            self._write_ack(dgram, last)
+        if not last:
+            self._reset_timer()
+
+    def _write_ack(self, dgram, last):
+        self.transport.write(dgram, self._transfer_addr)
+        if last:
+            self.transport.stopListening()
+
+    def _reset_timer(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = reactor.callLater(self._timeout, self._timeout_expired)
+
+    def _timeout_expired(self):
+        self.retries += 1
+        self._send_ack(self._blk_no)
+
+    def _finish(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self.done.callback(self)
+
+    def datagramReceived(self, dgram, addr):
+        opcode = dgram[:2]
+        self._transfer_addr = addr
+        if opcode == '\x00\x06':
+            # OACK
+            self._send_ack(0)
+        elif opcode == '\x00\x03':
+            blk_no = _UINT16_STRUCT.unpack(dgram[2:4])[0]
+            if blk_no != (self._blk_no + 1) % 65536:
+                # out of order block, acknowledge the last block received in
+                # order so that the server starts a new window after it
+                self._nb_in_window = 0
+                self._send_ack(self._blk_no)
+                return
+            self._blk_no = blk_no
+            self._nb_in_window += 1
+            data_len = len(dgram) - 4
+            self.size += data_len
+            if data_len < self._blksize:
+                self._send_ack(blk_no, last=True)
+                self._finish()
+            elif self._nb_in_window >= self._windowsize:
+                self._nb_in_window = 0
+                self._send_ack(blk_no)
+        else:
+            print 'Unexpected datagram: %r' % dgram[:64]
+            self.transport.stopListening()
+            self._finish()
+
+
+@defer.inlineCallbacks
+def run_bench(parsed_args):
+    content = 'x' * parsed_args.size
+    engine = new_transfer_engine(parsed_args.engine)
+    engine.start()
+    protocol = TFTPProtocol(engine)
+    protocol.max_windowsize = max(parsed_args.windowsizes)
+    protocol.set_tftp_request_processing_service(_FileService(content))
+    server_port = reactor.listenUDP(0, protocol, interface='127.0.0.1')
+    server_addr = ('127.0.0.1', server_port.getHost().port)
+    print '%10s %10s %12s %8s' % ('windowsize', 'time (s)', 'KiB/s', 'retries')
+    try:
+        for windowsize in parsed_args.windowsizes:
+            client = _Client(server_addr, parsed_args.blksize, windowsize, parsed_args.delay)
+            start_time = time.time()
+            reactor.listenUDP(0, client, interface='127.0.0.1')
+            yield client.done
+            duration = time.time() - start_time
+            if client.size != len(content):
+                print 'Incomplete transfer: %s bytes received' % client.size
+            print '%10s %10.3f %12.1f %8s' % (windowsize, duration, client.size / 1024.0 / duration,
+                                               client.retries)
+    finally:
+        yield server_port.stopListening()
+        yield engine.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024,
+                        help='size of the transferred file in bytes')
+    parser.add_argument('--blksize', type=int, default=1428,
+                        help='blksize option of the requests')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='delay, in seconds, of the client ACKs')
+    parser.add_argument('--engine', default='default', choices=['default', 'multiplexed'],
+                        help='TFTP transfer engine of the server')
+    parser.add_argument('--windowsizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64],
+                        help='windowsize options of the requests')
+    parsed_args = parser.parse_args()
+
+    def on_error(failure):
+        failure.printTraceback()
+
+    d = run_bench(parsed_args)
+    d.addErrback(on_error)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+main()